@@ -0,0 +1,126 @@
+"""Request handling for the versioned JSON API (/api/v1/...).
+
+Errors are reported as {"error": {"code": ..., "message": ...}} so clients can
+branch on a stable code instead of parsing messages. Size and concurrency
+limits are checked before the body is read, so rejected requests cost
+almost nothing.
+"""
+import gzip
+import json
+import threading
+import zlib
+from contextlib import contextmanager
+
+# Response bodies are sent in pieces of this size
+CHUNK_SIZE = 64 * 1024
+
+class ApiError(Exception):
+    def __init__(self, status, code, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+        self.headers = headers or {}
+
+    def body(self):
+        return {'error': {'code': self.code, 'message': self.message}}
+
+class ClientLimiter:
+    """Caps the requests each client may have in progress in this process."""
+
+    def __init__(self, limit, retry_after=1):
+        self.limit = limit
+        self.retry_after = retry_after
+        self._active = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, client):
+        with self._lock:
+            if self._active.get(client, 0) >= self.limit:
+                raise ApiError(429, 'too_many_requests',
+                               f'At most {self.limit} concurrent requests per client',
+                               {'Retry-After': str(self.retry_after)})
+            self._active[client] = self._active.get(client, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[client] -= 1
+                if not self._active[client]:
+                    del self._active[client]
+
+def check_length(content_length, max_bytes):
+    """Reject a body from its Content-Length alone, before reading any of it."""
+    if content_length is not None and content_length > max_bytes:
+        raise ApiError(413, 'payload_too_large', f'Request body is larger than {max_bytes} bytes')
+
+def read_body(stream, content_encoding, max_bytes):
+    """Read at most max_bytes of the (decompressed) request body."""
+    encoding = (content_encoding or 'identity').lower()
+    if encoding == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif encoding != 'identity':
+        raise ApiError(415, 'unsupported_encoding', f'Unsupported Content-Encoding: {content_encoding}')
+    try:
+        # One byte past the limit tells an oversized body from one that fits exactly
+        data = stream.read(max_bytes + 1)
+    except (OSError, EOFError, zlib.error) as e:
+        raise ApiError(400, 'invalid_body', f'Could not decompress request body: {e}')
+    if len(data) > max_bytes:
+        raise ApiError(413, 'payload_too_large', f'Request body is larger than {max_bytes} bytes')
+    return data
+
+def parse_render_request(data, mimetype):
+    """Return (markdown, filename) from a JSON or raw markdown request body."""
+    filename = None
+    try:
+        if mimetype == 'application/json':
+            try:
+                payload = json.loads(data)
+            except ValueError as e:
+                raise ApiError(400, 'invalid_json', f'Request body is not valid JSON: {e}')
+            if not isinstance(payload, dict) or not isinstance(payload.get('markdown'), str):
+                raise ApiError(422, 'invalid_request', 'Expected a JSON object with a "markdown" string')
+            markdown = payload['markdown']
+            filename = payload.get('filename')
+            if filename is not None and not isinstance(filename, str):
+                raise ApiError(422, 'invalid_request', '"filename" must be a string')
+        elif mimetype in ('text/markdown', 'text/x-markdown', 'text/plain'):
+            markdown = data.decode('utf-8')
+        else:
+            raise ApiError(415, 'unsupported_media_type',
+                           'Send application/json or text/markdown')
+    except UnicodeDecodeError as e:
+        raise ApiError(400, 'invalid_encoding', f'Request body is not valid UTF-8: {e}')
+
+    if not markdown.strip():
+        raise ApiError(422, 'empty_document', 'No markdown provided')
+    return markdown, filename
+
+def parse_page_range(text):
+    """Return (first, last) from "3", "3-5" or "3-" (to the end), or None if text is empty."""
+    if not text:
+        return None
+    first, dash, last = text.partition('-')
+    try:
+        first = int(first)
+        last = (int(last) if last else None) if dash else first
+    except ValueError:
+        raise ApiError(422, 'invalid_pages', f'Invalid page range "{text}"; expected e.g. 1, 3-5 or 3-')
+    if first < 1 or (last is not None and last < first):
+        raise ApiError(422, 'invalid_pages', f'Invalid page range "{text}"')
+    return first, last
+
+def iter_chunks(pdf):
+    """Yield a cached PDF (bytes or an open file, closed at the end) in CHUNK_SIZE pieces."""
+    if isinstance(pdf, bytes):
+        for start in range(0, len(pdf), CHUNK_SIZE):
+            yield pdf[start:start + CHUNK_SIZE]
+        return
+    with pdf as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
@@ -1,28 +1,101 @@
+import gc
+import hmac
+import io
 import os
-from flask import Flask, render_template, request, send_file, redirect, url_for, flash, jsonify
-from generate_pdf import parse_markdown, PDF, process_text_formatting, format_bullet_text, render_formatted_text
-import uuid
-import re
+import select
+import socket
+import tempfile
+from flask import Flask, Request, render_template, request, send_file, redirect, url_for, flash, jsonify
+from pdf_cache import cache_key, MemoryCache, DiskCache, TieredCache
+from render_engine import RenderEngine, EngineBusy, RenderTimeout, RenderCancelled
+from generate_pdf import PageOutOfRange, warm_up
+import metrics
+from jobs import JobStore, run_job, DONE, FAILED
+from batch import read_batch_inputs, iter_batch_zip
+from api import (ApiError, ClientLimiter, check_length, read_body, parse_render_request, parse_page_range,
+                 iter_chunks)
+from preview import PreviewStore
+import leader
 from flask_cors import CORS
-import requests
-import time
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
 
 load_dotenv()
 
+# Uploads are kept in memory and only spooled to a temporary file above this size
+SPOOL_THRESHOLD = int(os.environ.get('SPOOL_THRESHOLD_BYTES', 1024 * 1024))
+
+class SpoolingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD, mode='rb+')
+
 app = Flask(__name__)
+app.request_class = SpoolingRequest
+# Reverse proxies in front of the app; only then is X-Forwarded-For trusted,
+# and only as many hops of it as there are proxies that set it
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
 app.secret_key = os.environ.get('SECRET_KEY', 'development-key')
 
 CORS(app)
-UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'output'
+JOBS_FOLDER = 'jobs'
 ALLOWED_EXTENSIONS = {'md', 'markdown', 'txt'}
 
 # Create necessary directories
-os.makedirs(os.path.join(os.path.dirname(__file__), UPLOAD_FOLDER), exist_ok=True)
 os.makedirs(os.path.join(os.path.dirname(__file__), OUTPUT_FOLDER), exist_ok=True)
 
+# Rendered PDFs are cached by content hash: per worker in memory, and shared
+# between workers in the output folder
+pdf_cache = TieredCache(
+    MemoryCache(max_bytes=int(os.environ.get('PDF_CACHE_MEMORY_BYTES', 64 * 1024 * 1024)),
+                max_age=int(os.environ.get('PDF_CACHE_MAX_AGE', 24 * 3600))),
+    DiskCache(os.path.join(os.path.dirname(__file__), OUTPUT_FOLDER),
+              max_bytes=int(os.environ.get('PDF_CACHE_DISK_BYTES', 1024 * 1024 * 1024)),
+              max_age=int(os.environ.get('PDF_CACHE_MAX_AGE', 24 * 3600)))
+)
+
+# Rendering runs in a bounded process pool; small documents stay inline.
+# WEB_CONCURRENCY is gunicorn's default worker count, each with its own pool
+render_engine = RenderEngine(
+    max_workers=int(os.environ.get('RENDER_PROCESSES', 0)) or None,
+    max_queue=int(os.environ['RENDER_QUEUE_DEPTH']) if 'RENDER_QUEUE_DEPTH' in os.environ else None,
+    timeout=int(os.environ.get('RENDER_TIMEOUT', 120)),
+    inline_bytes=int(os.environ.get('RENDER_INLINE_BYTES', 64 * 1024)),
+    web_workers=int(os.environ.get('WEB_CONCURRENCY', 1)),
+    max_background=int(os.environ.get('RENDER_BACKGROUND_PROCESSES', 0)) or None,
+    max_backlog=int(os.environ.get('RENDER_BACKLOG', 64)),
+)
+
+# Background jobs for large documents, kept until the cleanup after JOB_MAX_AGE
+job_store = JobStore(os.path.join(os.path.dirname(__file__), JOBS_FOLDER))
+JOB_MAX_AGE = int(os.environ.get('JOB_MAX_AGE', 3600))
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 30 * 60))
+
+# Total markdown accepted by one /api/batch request, after unpacking ZIPs
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', 50 * 1024 * 1024))
+
+# /api/v1/render: largest accepted body (also after decompression) and
+# requests each client may have in progress per web worker
+API_MAX_BYTES = int(os.environ.get('API_MAX_BYTES', 10 * 1024 * 1024))
+api_limiter = ClientLimiter(int(os.environ.get('API_CLIENT_CONCURRENCY', 2)))
+
+# /api/v1/preview: sessions kept per web worker and the largest document
+# previewed (previews render in the web worker, not the render pool)
+preview_store = PreviewStore(max_sessions=int(os.environ.get('PREVIEW_SESSIONS', 32)),
+                             max_age=int(os.environ.get('PREVIEW_MAX_AGE', 600)))
+PREVIEW_MAX_BYTES = int(os.environ.get('PREVIEW_MAX_BYTES', 1024 * 1024))
+# Previews are laid out in the web worker, so they get a shorter limit than pooled renders
+PREVIEW_TIMEOUT = int(os.environ.get('PREVIEW_TIMEOUT', 10))
+
+# Held by the one process that runs the hourly cleanup (see leader.py)
+CLEANUP_LOCK = os.path.join(os.path.dirname(__file__), JOBS_FOLDER, 'cleanup.lock')
+
+# Functions listed in a ?profile=1 summary
+PROFILE_LIMIT = int(os.environ.get('PROFILE_LIMIT', 40))
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -30,210 +103,82 @@ def allowed_file(filename):
 def index():
     return render_template('index.html')
 
-def clean_text(text):
-    """Remove invisible or unsupported characters from the text."""
-    import unicodedata
-    cleaned_text = ''.join(
-        c for c in text if unicodedata.category(c)[0] != 'C'  # Remove control characters
-    )
-    return cleaned_text
-
-def generate_pdf_from_content(content):
-    """Helper function to generate PDF from markdown content"""
-    unique_id = str(uuid.uuid4())
-    pdf_filename = unique_id + '.pdf'
-    
-    # Parse markdown content
-    sections = parse_markdown(content)
-    
-    # Create PDF with better styling
-    pdf = PDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    
-    # Add a Unicode-compatible font
-    font_path = "NotoSans-Regular.ttf"
-    possible_paths = [
-        os.path.join(os.path.dirname(__file__), font_path),  # Current project directory
-        os.path.join(os.getcwd(), font_path),               # Current working directory
-        font_path                                           # Direct path
-    ]
-    
-    font_full_path = next((path for path in possible_paths if os.path.exists(path)), None)
-    if not font_full_path:
-        app.logger.error(f"Font file not found in any of the following locations: {possible_paths}")
-        raise FileNotFoundError(f"Font file not found in any of the following locations: {possible_paths}")
-    
-    pdf.add_font("NotoSans", "", font_full_path, uni=True)
-    pdf.add_font("NotoSans", "B", font_full_path, uni=True)
-    pdf.add_font("NotoSans", "I", font_full_path, uni=True)
-    
-    pdf.add_page()
-    
-    # Process each section
+def iter_upload_lines(file):
+    """Decode an uploaded file line by line straight from its request stream"""
+    file.stream.seek(0)
+    text = io.TextIOWrapper(file.stream, encoding='utf-8')
     try:
-        for section in sections:
-            if section["title"]:
-                title = clean_text(section["title"])
-                formatted_title = process_text_formatting(title)
-                title = ''.join(part[1] for part in formatted_title)
-                pdf.chapter_title(title, section["level"])
-            if section["type"] == "code":
-                code_content = "\n".join(section["content"])
-                cleaned_code = clean_text(code_content)
-                pdf.add_code_block(cleaned_code)
-            elif section["type"] == "hr":
-                pdf.add_horizontal_line()
-            elif section["type"] == "table":
-                pdf.add_table(section["content"])
-            else:
-                for line in section["content"]:
-                    try:
-                        # Clean the line of text
-                        line = clean_text(line)
-                        line = line.replace('***', '**')
-                        
-                        # Check if line is a bullet point
-                        bullet_match = None
-                        numbered_match = None
-                        table_match = None
-                        heading_match = None
-                        link_match = None
-                        image_match = None
-                        bold_match = None
-                        italic_match = None
-                        strikethrough_match = None
-                        code_match = None
-                        quote_match = None
-                        hr_match = None
-                        
-                        if isinstance(line, str):
-                            # Check if line is a bullet point
-                            bullet_match = re.match(r'^__BULLET__(\d+)__(.+)$', line)
-                            # Check if line is a numbered item
-                            numbered_match = re.match(r'^__NUMBERED__(\d+)__(\d+)__(.+)$', line)
-                            # Check if line is a table
-                            table_match = re.match(r'^__TABLE__(.+)$', line)
-                            # Check if line is a heading
-                            heading_match = re.match(r'^__HEADING__(\d+)__(.+)$', line)
-                            # Check if line is a link
-                            link_match = re.match(r'^__LINK__(.+)$', line)
-                            # Check if line is an image
-                            image_match = re.match(r'^__IMAGE__(.+)$', line)
-                            # Check if line is a bold text
-                            bold_match = re.match(r'^__BOLD__(.+)$', line)
-                            # Check if line is an italic text
-                            italic_match = re.match(r'^__ITALIC__(.+)$', line)
-                            # Check if line is a strikethrough text
-                            strikethrough_match = re.match(r'^__STRIKETHROUGH__(.+)$', line)
-                            # Check if line is a code block
-                            code_match = re.match(r'^__CODE__(.+)$', line)
-                            # Check if line is a quote
-                            quote_match = re.match(r'^__QUOTE__(.+)$', line)
-                            # Check if line is a horizontal line
-                            hr_match = re.match(r'^__HR__$', line)
-                        
-                        if bullet_match:
-                            indent_level = int(bullet_match.group(1))
-                            bullet_text = bullet_match.group(2)
-                            
-                            # Format the bullet text without HTML tags
-                            bullet_text = format_bullet_text(bullet_text)
-                            pdf.add_bullet_point(bullet_text, indent_level)
-                            continue
-                        
-                        elif numbered_match:
-                            indent_level = int(numbered_match.group(1))
-                            number = numbered_match.group(2)
-                            numbered_text = numbered_match.group(3)
-                            
-                            # Format the numbered text without HTML tags
-                            numbered_text = format_bullet_text(numbered_text)
-                            pdf.add_bullet_point(numbered_text, indent_level, number)
-                            continue
-                        
-                        elif table_match:
-                            table_data = table_match.group(1)
-                            pdf.add_table(table_data)
-                            continue
-                        
-                        elif heading_match:
-                            level = int(heading_match.group(1))
-                            heading_text = heading_match.group(2)
-                            
-                            heading_text = process_text_formatting(heading_text)
-                            pdf.add_heading(heading_text, level)
-                            continue
-                        
-                        elif link_match:
-                            link_text = link_match.group(1)
-                            
-                            link_text = process_text_formatting(link_text)
-                            pdf.add_link(link_text)
-                            continue
-                        
-                        elif image_match:
-                            image_path = image_match.group(1)
-                            pdf.add_image(image_path)
-                            continue
-                            
-                        elif bold_match:
-                            bold_text = bold_match.group(1)
-                            pdf.add_bold_text(bold_text)
-                            continue
-                        
-                        elif italic_match:
-                            italic_text = italic_match.group(1)
-                            pdf.add_italic_text(italic_text)
-                            continue
-                            
-                        elif strikethrough_match:
-                            strikethrough_text = strikethrough_match.group(1)
-                            pdf.add_strikethrough_text(strikethrough_text)
-                            continue
-                            
-                        elif code_match:
-                            code_text = code_match.group(1)
-                            pdf.add_code_text(code_text)
-                            continue
-                        
-                        elif quote_match:
-                            quote_text = quote_match.group(1)
-                            pdf.add_quote(quote_text)
-                            continue
-                            
-                        elif hr_match:
-                            pdf.add_horizontal_line()
-                            continue
-                            
-                        elif "*" in line or "**" in line or "***" in line:
-                            # Only process non-empty lines
-                            if isinstance(line, str) and line.strip():
-                                # Get the parts with style information
-                                formatted_parts = process_text_formatting(line)
-                                # Render the text with proper formatting
-                                render_formatted_text(pdf, formatted_parts)
-                            continue
-                        
-                        else:
-                            # Only process non-empty lines
-                            if isinstance(line, str) and line.strip():
-                                # Get the parts with style information
-                                formatted_parts = process_text_formatting(line)
-                                # Render the text with proper formatting
-                                render_formatted_text(pdf, formatted_parts)
-                            continue
-                    except Exception as e:
-                        app.logger.error(f"Error processing line '{line}': {str(e)}")
-                        raise
-    except Exception as e:
-        app.logger.error(f'Error processing section: {str(e)}')
-        raise Exception(f'Error processing section: {str(e)}')
-        
-    # Save PDF
-    pdf_path = os.path.join(os.path.dirname(__file__), OUTPUT_FOLDER, pdf_filename)
-    pdf.output(pdf_path)
+        yield from text
+    finally:
+        # Leave the underlying stream open for werkzeug to close
+        text.detach()
+
+def upload_size(file):
+    """Return the size in bytes of an uploaded file's stream"""
+    file.stream.seek(0, os.SEEK_END)
+    return file.stream.tell()
+
+def client_disconnected():
+    """Best-effort check whether the client has closed its connection"""
+    # Under asgi.py the event loop tracks the connection
+    is_disconnected = request.environ.get('markdownforge.client_disconnected')
+    if is_disconnected is not None:
+        return is_disconnected()
+    sock = request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # A readable socket with nothing to read has been closed by the peer
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return False
+
+def busy_response(e, is_ajax):
+    """503 with Retry-After when the render queue is full"""
+    body = jsonify({'error': str(e)}) if is_ajax else str(e)
+    return body, 503, {'Retry-After': str(e.retry_after)}
+
+def not_modified(key):
+    """Return a 304 response if the client already holds the PDF for key"""
+    # The key covers the markdown, renderer version and options, so a
+    # matching If-None-Match means the client has exactly this PDF
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+    return None
+
+def send_pdf(pdf, key, download_name):
+    """Send a cached PDF with its cache key as a strong ETag"""
+    if isinstance(pdf, bytes):
+        pdf = io.BytesIO(pdf)
+    return send_file(pdf,
+                     mimetype='application/pdf',
+                     as_attachment=True,
+                     download_name=download_name,
+                     etag=key)
+
+def is_admin():
+    """Whether the request carries ADMIN_KEY; admin endpoints are closed while it is unset"""
+    key = os.environ.get('ADMIN_KEY')
+    return bool(key) and hmac.compare_digest(request.headers.get('X-Admin-Key', '').encode(), key.encode())
+
+def profile_response(content, size):
+    """Render under cProfile in the render pool and return the stage timings and pstats summary"""
+    if not is_admin():
+        return {'status': 'unauthorized'}, 403
+    if size > API_MAX_BYTES:
+        return {'status': 'error', 'error': f'Document exceeds {API_MAX_BYTES} bytes'}, 413
     
-    return pdf_path
+    # Bypasses the cache, but not the render pool's queue limit and timeout
+    try:
+        report = render_engine.profile(content, PROFILE_LIMIT, is_cancelled=client_disconnected)
+    except EngineBusy as e:
+        return {'status': 'busy', 'error': str(e)}, 503, {'Retry-After': str(e.retry_after)}
+    except RenderTimeout as e:
+        return {'status': 'error', 'error': str(e)}, 504
+    return app.response_class(report, mimetype='text/plain')
 
 @app.route('/convert', methods=['POST'])
 def convert_file():
@@ -256,41 +201,33 @@ def convert_file():
     file = request.files['file']
         
     if file and allowed_file(file.filename):
-        # Generate unique filename to avoid collisions
-        unique_id = str(uuid.uuid4())
-        md_filename = unique_id + '.md'
-        
-        # Save uploaded markdown file
-        md_path = os.path.join(os.path.dirname(__file__), UPLOAD_FOLDER, md_filename)
-        file.save(md_path)
+        if request.args.get('profile') == '1':
+            return profile_response(iter_upload_lines(file), upload_size(file))
         
         # Convert to PDF
         try:
-            content = ''
-            with open(md_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            key = cache_key(iter_upload_lines(file))
+            response = not_modified(key)
+            if response:
+                return response
             
-            pdf_path = generate_pdf_from_content(content)
+            pdf = pdf_cache.get(key)
+            if pdf is None:
+                # Stream the upload through the parser instead of reading it whole
+                pdf = render_engine.render(iter_upload_lines(file), upload_size(file),
+                                           is_cancelled=client_disconnected)
+                pdf_cache.put(key, pdf)
             
             # Return the PDF file
-            return send_file(pdf_path, 
-                            mimetype='application/pdf',
-                            as_attachment=True, 
-                            download_name=file.filename.rsplit('.', 1)[0] + '.pdf')
+            return send_pdf(pdf, key, file.filename.rsplit('.', 1)[0] + '.pdf')
         
+        except EngineBusy as e:
+            return busy_response(e, is_ajax)
         except Exception as e:
             if is_ajax:
                 return jsonify({'error': f'Error converting file: {str(e)}'}), 500
             flash(f'Error converting file: {str(e)}')
             return redirect(url_for('index'))
-        finally:
-            # Clean up temporary files
-            try:
-                if os.path.exists(md_path):
-                    os.remove(md_path)
-                # We'll leave the PDF for the download and clean up later
-            except:
-                pass
     
     if is_ajax:
         return jsonify({'error': 'Invalid file format. Please upload a markdown file (.md, .markdown, .txt)'}), 400
@@ -313,16 +250,25 @@ def convert_text():
             flash('No markdown text provided')
             return redirect(url_for('index'))
 
-        # Generate PDF from the text
-        pdf_path = generate_pdf_from_content(markdown_text)
+        if request.args.get('profile') == '1':
+            return profile_response(markdown_text, len(markdown_text.encode('utf-8')))
+
+        key = cache_key(markdown_text)
+        response = not_modified(key)
+        if response:
+            return response
+
+        # Reuse an identical earlier conversion, or generate PDF from the text
+        pdf = pdf_cache.get(key)
+        if pdf is None:
+            pdf = render_engine.render(markdown_text, is_cancelled=client_disconnected)
+            pdf_cache.put(key, pdf)
 
         # Return the PDF file with a default name
-        return send_file(
-            pdf_path,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name='markdown-document.pdf'
-        )
+        return send_pdf(pdf, key, 'markdown-document.pdf')
+
+    except EngineBusy as e:
+        return busy_response(e, is_ajax)
 
     except KeyError as ke:
         app.logger.error(f'Missing form data: {str(ke)}')
@@ -338,6 +284,159 @@ def convert_text():
         flash(f'Error converting markdown: {str(e)}')
         return redirect(url_for('index'))
 
+def job_json(job):
+    """Public representation of a job record"""
+    data = {
+        'id': job['id'],
+        'status': job['status'],
+        'progress': {
+            'sections_done': job['sections_done'],
+            'sections_total': job['sections_total'],
+        },
+        'status_url': url_for('job_status', job_id=job['id']),
+    }
+    if job['status'] == DONE:
+        data['result_url'] = url_for('job_result', job_id=job['id'])
+    if job['error']:
+        data['error'] = job['error']
+    return data
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    file = request.files.get('file')
+    if file and file.filename:
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file format. Please upload a markdown file (.md, .markdown, .txt)'}), 400
+        job_id = job_store.create(file.filename.rsplit('.', 1)[0] + '.pdf')
+        file.save(job_store.input_path(job_id))
+    else:
+        markdown_text = request.form.get('markdown-text', '')
+        if not markdown_text.strip():
+            return jsonify({'error': 'No file or markdown text provided'}), 400
+        job_id = job_store.create('markdown-document.pdf')
+        with open(job_store.input_path(job_id), 'wb') as f:
+            f.write(markdown_text.encode('utf-8'))
+    
+    # Jobs wait for a free process instead of being rejected, unless the backlog is full
+    try:
+        render_engine.submit(run_job, job_store.directory, job_id, JOB_TIMEOUT)
+    except EngineBusy as e:
+        job_store.update(job_id, status=FAILED, error=str(e))
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+    
+    job = job_store.get(job_id)
+    return jsonify(job_json(job)), 202, {'Location': url_for('job_status', job_id=job_id)}
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_json(job))
+
+@app.route('/api/jobs/<job_id>/pdf')
+def job_result(job_id):
+    job = job_store.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != DONE:
+        return jsonify(job_json(job)), 409
+    return send_file(job_store.result_path(job_id),
+                     mimetype='application/pdf',
+                     as_attachment=True,
+                     download_name=job['download_name'])
+
+@app.route('/api/batch', methods=['POST'])
+def convert_batch():
+    uploads = [(f.filename, f.stream)
+               for f in request.files.getlist('files') + request.files.getlist('file')
+               if f.filename]
+    if not uploads:
+        return jsonify({'error': 'No files provided'}), 400
+    
+    entries = read_batch_inputs(uploads, allowed_file, BATCH_MAX_BYTES)
+    
+    # PDFs are streamed into the archive as each conversion finishes
+    return app.response_class(iter_batch_zip(entries, render_engine, render_engine.timeout, pdf_cache),
+                              mimetype='application/zip',
+                              headers={'Content-Disposition': 'attachment; filename=markdown-batch.zip'})
+
+def api_error_response(e):
+    return jsonify(e.body()), e.status, e.headers
+
+@app.route('/api/v1/render', methods=['POST'])
+def api_render():
+    try:
+        # Limits first: an oversized or excess request is turned away before its body is read
+        check_length(request.content_length, API_MAX_BYTES)
+        # The client's address; ProxyFix supplies it from X-Forwarded-For behind PROXY_HOPS proxies
+        with api_limiter.slot(request.remote_addr):
+            data = read_body(request.stream, request.headers.get('Content-Encoding'), API_MAX_BYTES)
+            markdown, filename = parse_render_request(data, request.mimetype)
+            filename = filename or request.args.get('filename') or 'markdown-document.pdf'
+            download_name = secure_filename(filename.rsplit('.', 1)[0] + '.pdf') or 'markdown-document.pdf'
+            pages = parse_page_range(request.args.get('pages'))
+            
+            key = cache_key(markdown, {'pages': list(pages)} if pages else None)
+            response = not_modified(key)
+            if response:
+                return response
+            
+            pdf = pdf_cache.get(key)
+            if pdf is None:
+                pdf = render_engine.render(markdown, is_cancelled=client_disconnected, pages=pages)
+                pdf_cache.put(key, pdf)
+    except ApiError as e:
+        return api_error_response(e)
+    except PageOutOfRange as e:
+        return api_error_response(ApiError(416, 'page_out_of_range', str(e)))
+    except EngineBusy as e:
+        return api_error_response(ApiError(503, 'busy', str(e), {'Retry-After': str(e.retry_after)}))
+    except RenderTimeout as e:
+        return api_error_response(ApiError(504, 'render_timeout', str(e)))
+    except RenderCancelled as e:
+        return api_error_response(ApiError(499, 'client_closed_request', str(e)))
+    except Exception as e:
+        app.logger.error(f'Error rendering markdown: {str(e)}')
+        return api_error_response(ApiError(500, 'render_failed', f'Error converting markdown: {str(e)}'))
+    
+    # No Content-Length, so the PDF goes out with chunked transfer encoding
+    response = app.response_class(iter_chunks(pdf), mimetype='application/pdf',
+                                  headers={'Content-Disposition': f'attachment; filename={download_name}'})
+    response.set_etag(key)
+    return response
+
+@app.route('/api/v1/preview', methods=['POST'])
+def api_preview():
+    try:
+        check_length(request.content_length, PREVIEW_MAX_BYTES)
+        with api_limiter.slot(request.remote_addr):
+            data = read_body(request.stream, request.headers.get('Content-Encoding'), PREVIEW_MAX_BYTES)
+            markdown, _ = parse_render_request(data, request.mimetype)
+            
+            # Unknown or expired sessions (or another worker's) start over with a full render
+            session_id, session = preview_store.session(request.headers.get('X-Preview-Session'))
+            with session.lock:
+                pdf, sections_rendered = session.render(markdown, PREVIEW_TIMEOUT)
+    except ApiError as e:
+        return api_error_response(e)
+    except RenderTimeout as e:
+        return api_error_response(ApiError(504, 'render_timeout', str(e)))
+    except Exception as e:
+        app.logger.error(f'Error rendering preview: {str(e)}')
+        return api_error_response(ApiError(500, 'render_failed', f'Error converting markdown: {str(e)}'))
+    
+    return app.response_class(pdf, mimetype='application/pdf', headers={
+        'X-Preview-Session': session_id,
+        'X-Preview-Sections-Rendered': str(sections_rendered),
+        'Cache-Control': 'no-store',
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    body, content_type = metrics.latest()
+    return app.response_class(body, content_type=content_type)
+
 @app.route('/health')
 def health_check():
     return {'status': 'healthy'}, 200
@@ -345,32 +444,15 @@ def health_check():
 # Cleanup task to remove old PDF files
 @app.route('/cleanup', methods=['POST'])
 def cleanup():
-    if request.headers.get('X-Admin-Key') != os.environ.get('ADMIN_KEY'):
+    if not is_admin():
         return {'status': 'unauthorized'}, 403
     
     try:
-        output_dir = os.path.join(os.path.dirname(__file__), OUTPUT_FOLDER)
-        upload_dir = os.path.join(os.path.dirname(__file__), UPLOAD_FOLDER)
+        # Evict cached PDFs by age and size
+        files_removed = pdf_cache.evict()
         
-        # Remove files older than 1 hour
-        import time
-        current_time = time.time()
-        one_hour = 3600
-        
-        # Clean output folder
-        files_removed = 0
-        for filename in os.listdir(output_dir):
-            file_path = os.path.join(output_dir, filename)
-            if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > one_hour:
-                os.remove(file_path)
-                files_removed += 1
-        
-        # Clean upload folder
-        for filename in os.listdir(upload_dir):
-            file_path = os.path.join(upload_dir, filename)
-            if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > one_hour:
-                os.remove(file_path)
-                files_removed += 1
+        # Expire finished and abandoned jobs
+        files_removed += job_store.expire(JOB_MAX_AGE)
         
         return {'status': 'success', 'files_removed': files_removed}, 200
     
@@ -380,31 +462,43 @@ def cleanup():
 def scheduled_cleanup():
     """Scheduled cleanup task to remove old files."""
     try:
-        output_dir = os.path.join(os.path.dirname(__file__), OUTPUT_FOLDER)
-        upload_dir = os.path.join(os.path.dirname(__file__), UPLOAD_FOLDER)
-        
-        current_time = time.time()
-        one_hour = 3600
-        
-        # Clean output folder
-        for filename in os.listdir(output_dir):
-            file_path = os.path.join(output_dir, filename)
-            if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > one_hour:
-                os.remove(file_path)
+        # Evict cached PDFs by age and size
+        pdf_cache.evict()
         
-        # Clean upload folder
-        for filename in os.listdir(upload_dir):
-            file_path = os.path.join(upload_dir, filename)
-            if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > one_hour:
-                os.remove(file_path)
+        # Expire finished and abandoned jobs
+        job_store.expire(JOB_MAX_AGE)
         
         app.logger.info("Scheduled cleanup completed successfully.")
     except Exception as e:
         app.logger.error(f"Error during scheduled cleanup: {str(e)}")
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(scheduled_cleanup, 'cron', hour=0, minute=0)
-scheduler.start()
+def _run_cleanup_scheduler():
+    # Imported here: only the leader runs a scheduler
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    scheduler = BlockingScheduler()
+    # Hourly, so the PDF cache size limit is enforced between request bursts
+    scheduler.add_job(scheduled_cleanup, 'cron', minute=0)
+    scheduler.start()
+
+def start_cleanup_scheduler():
+    """Run scheduled_cleanup hourly in exactly one process on this machine.
+
+    Called once a worker has booted (gunicorn.conf.py, or asgi.py for ASGI
+    workers), never at import: a --preload master would start the thread and
+    lose it at fork.
+    """
+    leader.elect(CLEANUP_LOCK, _run_cleanup_scheduler, name='cleanup leader')
+
+def preload():
+    """Build the shared state in a gunicorn --preload master before it forks.
+
+    Fonts, compiled regexes and caches are made once and shared by every
+    worker copy-on-write. gc.freeze() keeps the garbage collector from
+    writing to (and so copying) the pages they live on.
+    """
+    warm_up()
+    gc.freeze()
 
 if __name__ == '__main__':
+    start_cleanup_scheduler()
     app.run()
@@ -0,0 +1,210 @@
+"""ASGI entry point: network I/O on an event loop, Flask in a bounded thread pool.
+
+With sync workers a client uploading or downloading slowly holds a whole
+worker for the entire transfer. Here the request body is received
+asynchronously, spooled to memory or a temporary file, and only then is the
+Flask app run in a thread. The response is sent back asynchronously as well,
+so a thread is busy only while the app itself works. Slow and idle
+connections only cost a coroutine each.
+
+    gunicorn asgi:app -k uvicorn_worker.UvicornWorker
+    uvicorn asgi:app
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from api import ApiError
+from app import (app as flask_app, render_engine, start_cleanup_scheduler, SPOOL_THRESHOLD,
+                 API_MAX_BYTES, BATCH_MAX_BYTES, PREVIEW_MAX_BYTES)
+from generate_pdf import warm_up
+
+# Requests the Flask app handles at once in this process; renders beyond the
+# render pool's capacity are turned away by the pool itself
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 8))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+# Bodies are received in full before Flask sees them, so each route's own
+# size limit is enforced here as well, and everything else gets a ceiling
+# that keeps one upload from filling the disk
+ASGI_MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 512 * 1024 * 1024))
+BODY_LIMITS = {
+    '/api/v1/render': API_MAX_BYTES,
+    '/api/v1/preview': PREVIEW_MAX_BYTES,
+    '/api/batch': BATCH_MAX_BYTES,
+}
+
+class BodyTooLarge(Exception):
+    """The request body is larger than its route accepts."""
+
+def build_environ(scope, body):
+    """WSGI environ for an HTTP scope whose body has been received in full."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        # Repeated headers are joined as a proxy would
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+def content_length(scope):
+    """The Content-Length header of an HTTP scope, or None if absent or invalid."""
+    for name, value in scope['headers']:
+        if name.lower() == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+async def receive_body(receive, max_bytes):
+    """Receive the whole request body, spooling it to disk above SPOOL_THRESHOLD.
+
+    Raises BodyTooLarge as soon as more than max_bytes have arrived.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD, mode='w+b')
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > max_bytes:
+            body.close()
+            raise BodyTooLarge()
+        if size > SPOOL_THRESHOLD:
+            # Past the threshold the body is written to disk, which would block the event loop
+            await asyncio.to_thread(body.write, chunk)
+        else:
+            body.write(chunk)
+        if not message.get('more_body', False):
+            body.seek(0)
+            return body
+
+async def send_too_large(send, max_bytes):
+    # Same body as the API's own 413, ApiError's JSON
+    error = ApiError(413, 'payload_too_large', f'Request body is larger than {max_bytes} bytes')
+    await send({
+        'type': 'http.response.start',
+        'status': 413,
+        'headers': [(b'content-type', b'application/json'), (b'connection', b'close')],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(error.body()).encode('utf-8')})
+
+def run_wsgi(environ):
+    """Call the Flask app and return (status, headers, body iterable)."""
+    response = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response['status'] = status
+        response['headers'] = headers
+        return written.append
+
+    result = flask_app.wsgi_app(environ, start_response)
+    return response['status'], response['headers'], written, result
+
+async def http(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    max_bytes = BODY_LIMITS.get(scope['path'], ASGI_MAX_BODY_BYTES)
+    # Turned away from the header alone when it gives the size, before reading any of the body
+    length = content_length(scope)
+    if length is not None and length > max_bytes:
+        await send_too_large(send, max_bytes)
+        return
+    try:
+        body = await receive_body(receive, max_bytes)
+    except BodyTooLarge:
+        await send_too_large(send, max_bytes)
+        return
+    if body is None:
+        return
+
+    # Watch for the client going away while the app works, for render cancellation
+    disconnected = asyncio.Event()
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+    watcher = asyncio.create_task(watch())
+
+    environ = build_environ(scope, body)
+    environ['markdownforge.client_disconnected'] = disconnected.is_set
+    result = None
+    try:
+        status, headers, written, result = await loop.run_in_executor(executor, run_wsgi, environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        for chunk in written:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        # Each piece is produced in the pool (it may be a file read or a render)
+        # and sent from the event loop, so a slow reader holds no thread
+        iterator = iter(result)
+        while not disconnected.is_set():
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
+        body.close()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Same warm-up gunicorn.conf.py does for sync workers
+            warm_up()
+            render_engine.start()
+            start_cleanup_scheduler()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            render_engine.shutdown()
+            executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        await http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    else:
+        raise NotImplementedError(f"Unsupported ASGI scope type: {scope['type']}")
@@ -0,0 +1,181 @@
+"""Batch conversion of many markdown files into a streamed ZIP of PDFs.
+
+Identical inputs are rendered once, conversions run on the render pool, and
+each PDF is written to the archive as soon as it is ready, so the response
+starts flowing before the batch is finished and the ZIP is never held in
+memory as a whole. manifest.json, the last entry, records the outcome for
+every input file.
+"""
+import io
+import json
+import posixpath
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from pdf_cache import cache_key
+from render_engine import EngineBusy, render_with_timeout
+
+def _safe_name(name):
+    # Archive member names come from the client; keep them relative and inside the ZIP
+    name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+    return '/'.join(part for part in name.split('/') if part not in ('', '.', '..')) or 'document'
+
+def read_batch_inputs(uploads, is_markdown, max_bytes):
+    """Turn uploaded (filename, stream) pairs into (name, markdown, error) entries.
+
+    Files accepted by is_markdown are taken as they are and ZIP archives are
+    expanded; at most max_bytes of markdown is read across the whole batch.
+    """
+    entries = []
+    remaining = max_bytes
+
+    def add(name, read, size):
+        nonlocal remaining
+        if size is not None and size > remaining:
+            entries.append((name, None, 'Batch size limit exceeded'))
+            return
+        try:
+            data = read()
+            if len(data) > remaining:
+                entries.append((name, None, 'Batch size limit exceeded'))
+                return
+            remaining -= len(data)
+            entries.append((name, data.decode('utf-8'), None))
+        except UnicodeDecodeError as e:
+            entries.append((name, None, f'Not valid UTF-8: {e}'))
+
+    for filename, stream in uploads:
+        name = _safe_name(filename)
+        if name.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(stream) as archive:
+                    for info in archive.infolist():
+                        if info.is_dir() or not is_markdown(info.filename):
+                            continue
+                        # Read one byte past the limit so oversized members are caught
+                        add(_safe_name(info.filename),
+                            lambda info=info: archive.open(info).read(remaining + 1),
+                            info.file_size)
+            except zipfile.BadZipFile as e:
+                entries.append((name, None, f'Invalid ZIP archive: {e}'))
+        elif is_markdown(name):
+            add(name, lambda stream=stream: stream.read(remaining + 1), None)
+        else:
+            entries.append((name, None, 'Invalid file format. Please upload a markdown file (.md, .markdown, .txt)'))
+    return entries
+
+class _ChunkWriter(io.RawIOBase):
+    """Unseekable sink for ZipFile whose output is drained after each entry."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _output_names(entries):
+    # One PDF name per input, made unique when a.md and a.txt both appear
+    used = set()
+    names = []
+    for name, _, _ in entries:
+        base = name.rsplit('.', 1)[0]
+        candidate = base + '.pdf'
+        n = 2
+        while candidate in used:
+            candidate = f'{base}-{n}.pdf'
+            n += 1
+        used.add(candidate)
+        names.append(candidate)
+    return names
+
+def iter_batch_zip(entries, engine, timeout, cache=None):
+    """Render read_batch_inputs() entries and yield the ZIP archive in chunks."""
+    sink = _ChunkWriter()
+    archive = zipfile.ZipFile(sink, 'w')
+    output_names = _output_names(entries)
+    manifest = [None] * len(entries)
+
+    # Group inputs by content hash so duplicates are rendered once
+    by_key = {}
+    for index, (name, content, error) in enumerate(entries):
+        if error:
+            manifest[index] = {'source': name, 'status': 'error', 'error': error}
+        else:
+            by_key.setdefault(cache_key(content), []).append(index)
+
+    def write_result(key, pdf=None, error=None):
+        for index in by_key[key]:
+            name = entries[index][0]
+            if error:
+                manifest[index] = {'source': name, 'status': 'error', 'error': error}
+            else:
+                # PDFs are already compressed, so they are stored as-is
+                archive.writestr(output_names[index], pdf, compress_type=zipfile.ZIP_STORED)
+                manifest[index] = {'source': name, 'status': 'ok', 'output': output_names[index]}
+
+    misses = []
+    cached = {}
+    for key in by_key:
+        pdf = cache.get(key) if cache else None
+        if pdf is None:
+            misses.append(key)
+        else:
+            cached[key] = pdf
+    misses.reverse()  # Taken from the end, in input order
+
+    futures = {}
+    def submit_more():
+        # Only a few of the batch's renders wait in the engine at once, so one
+        # upload cannot fill its backlog
+        while misses and len(futures) < engine.max_background:
+            key = misses.pop()
+            try:
+                futures[engine.submit(render_with_timeout, entries[by_key[key][0]][1], timeout)] = key
+            except EngineBusy as e:
+                if futures:
+                    # Tried again once one of this batch's renders is done
+                    misses.append(key)
+                    return
+                write_result(key, error=str(e))
+
+    # Start rendering before writing anything, so the pool is busy while cache hits stream out
+    submit_more()
+    try:
+        for key, pdf in cached.items():
+            if not isinstance(pdf, bytes):
+                with pdf:
+                    pdf = pdf.read()
+            write_result(key, pdf)
+            yield sink.drain()
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                try:
+                    pdf = future.result()
+                except Exception as e:
+                    write_result(key, error=str(e))
+                else:
+                    if cache:
+                        cache.put(key, pdf)
+                    write_result(key, pdf)
+                yield sink.drain()
+            submit_more()
+    finally:
+        # The client may stop reading mid-batch; don't leave queued work behind
+        for future in futures:
+            future.cancel()
+
+    archive.writestr('manifest.json', json.dumps(manifest, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    archive.close()
+    yield sink.drain()
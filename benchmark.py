@@ -0,0 +1,1014 @@
+"""Benchmarks for the markdown to PDF conversion pipeline.
+
+Usage:
+    python benchmark.py suite [--sizes 1KB 64KB 1MB] [--output results.json]
+    python benchmark.py load [--requests 50] [--threads 4]
+    python benchmark.py serve [--target sync asgi] [--slow 50] [--fast 4] [--duration 30]
+    python benchmark.py compare baseline.json results.json [--threshold 0.10]
+    python benchmark.py dispatch [--lines 50000]
+    python benchmark.py size [--sizes 1KB 64KB]
+    python benchmark.py layout [--size 256KB]
+    python benchmark.py clean [--lines 20000]
+    python benchmark.py inline [--size 10000]
+    python benchmark.py memory [--mb 100]
+    python benchmark.py batch [--docs 32] [--lines 200] [--workers 1 4 8]
+    python benchmark.py preview [--size 300KB] [--edits 20]
+    python benchmark.py table [--rows 10000] [--columns 5]
+    python benchmark.py code [--lines 20000] [--language python]
+    python benchmark.py parallel [--chapters 40] [--size 2MB] [--workers 1 2 4 8]
+    python benchmark.py startup [--workers 4] [--mode default preload]
+    python benchmark.py cli [--files 2000] [--size 2KB] [--edits 10]
+    python benchmark.py parse [--corpora code lists] [--size 8MB]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+import time
+
+# Deterministic corpus generation
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua").split()
+
+def make_paragraph_line(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+def iter_mixed_lines(seed=0):
+    """Endless mostly-prose lines with headings, lists and the odd emphasis marker."""
+    rng = random.Random(seed)
+    while True:
+        roll = rng.random()
+        if roll < 0.05:
+            yield f"## {make_paragraph_line(rng, 4)}"
+        elif roll < 0.15:
+            yield f"- {make_paragraph_line(rng, 6)}"
+        elif roll < 0.20:
+            yield f"{rng.randint(1, 9)}. {make_paragraph_line(rng, 6)}"
+        elif roll < 0.25:
+            yield f"Some **bold** and *italic* {make_paragraph_line(rng, 6)}"
+        else:
+            yield make_paragraph_line(rng)
+
+def make_mixed_document(lines, seed=0):
+    return '\n'.join(itertools.islice(iter_mixed_lines(seed), lines))
+
+def write_mixed_corpus(path, size_bytes, seed=0):
+    """Write a mixed document of roughly size_bytes to path without holding it in memory."""
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for line in iter_mixed_lines(seed):
+            if written >= size_bytes:
+                break
+            f.write(line + '\n')
+            written += len(line) + 1
+
+# Corpus generators for the suite: each takes a seeded Random and yields lines forever
+def iter_prose_lines(rng):
+    while True:
+        yield f"# {make_paragraph_line(rng, 4)}"
+        for _ in range(rng.randint(5, 30)):
+            words = make_paragraph_line(rng, rng.randint(8, 30))
+            if rng.random() < 0.2:
+                words += f" **{rng.choice(WORDS)}** and *{rng.choice(WORDS)}*"
+            yield words
+            if rng.random() < 0.3:
+                yield ""
+
+def iter_list_lines(rng):
+    while True:
+        yield f"## {make_paragraph_line(rng, 3)}"
+        for i in range(rng.randint(5, 40)):
+            indent = '  ' * rng.randint(0, 3)
+            if rng.random() < 0.5:
+                yield f"{indent}- {make_paragraph_line(rng, rng.randint(3, 12))}"
+            else:
+                yield f"{indent}{i + 1}. {make_paragraph_line(rng, rng.randint(3, 12))}"
+
+def iter_code_lines(rng):
+    while True:
+        yield make_paragraph_line(rng)
+        yield "```python"
+        for _ in range(rng.randint(5, 60)):
+            name = '_'.join(rng.sample(WORDS, 2))
+            yield f"{'    ' * rng.randint(0, 3)}{name} = compute({rng.randint(0, 999)}, \"{rng.choice(WORDS)}\")"
+        yield "```"
+
+def iter_table_lines(rng):
+    while True:
+        columns = rng.randint(2, 6)
+        yield "| " + " | ".join(rng.choice(WORDS).title() for _ in range(columns)) + " |"
+        yield "|" + "---|" * columns
+        for _ in range(rng.randint(10, 200)):
+            yield "| " + " | ".join(make_paragraph_line(rng, rng.randint(1, 4)) for _ in range(columns)) + " |"
+        yield ""
+
+def iter_nested_lines(rng):
+    while True:
+        for level in range(1, 7):
+            yield f"{'#' * level} {make_paragraph_line(rng, 3)}"
+            for depth in range(12):
+                yield f"{'  ' * depth}- ***{rng.choice(WORDS)}*** **{rng.choice(WORDS)} *{rng.choice(WORDS)}***"
+
+def iter_marker_lines(rng):
+    makers = list(PATHOLOGICAL_LINES.values())
+    while True:
+        yield rng.choice(makers)(rng.randint(50, 2000))
+
+CORPORA = {
+    'prose': iter_prose_lines,
+    'lists': iter_list_lines,
+    'code': iter_code_lines,
+    'tables': iter_table_lines,
+    'nested': iter_nested_lines,
+    'markers': iter_marker_lines,
+}
+
+def make_corpus(kind, size_bytes, seed=0):
+    """Deterministic document of the given kind, cut at the first line past size_bytes."""
+    lines = []
+    size = 0
+    for line in CORPORA[kind](random.Random(seed)):
+        if size >= size_bytes:
+            break
+        lines.append(line)
+        size += len(line.encode('utf-8')) + 1
+    return '\n'.join(lines)
+
+def parse_size(text):
+    """'64KB' -> 65536"""
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    text = text.upper()
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+def _run_pipeline(content, stage_times):
+    """One full conversion, adding the time spent in each stage to stage_times."""
+    import generate_pdf
+
+    # process_text_formatting and render_formatted_text are looked up as module
+    # globals on every call, so wrapping them times every use inside build_pdf
+    originals = {}
+    def wrap(name, stage):
+        original = originals[name] = getattr(generate_pdf, name)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                stage_times[stage] += time.perf_counter() - start
+        setattr(generate_pdf, name, timed)
+
+    generate_pdf._tokenize_inline.cache_clear()
+    wrap('process_text_formatting', 'inline')
+    wrap('render_formatted_text', 'render_text')
+    try:
+        start = time.perf_counter()
+        pdf = generate_pdf.build_pdf(content)
+        stage_times['layout'] += time.perf_counter() - start
+        start = time.perf_counter()
+        data = pdf.output(dest='S')
+        stage_times['output'] += time.perf_counter() - start
+    finally:
+        for name, original in originals.items():
+            setattr(generate_pdf, name, original)
+    return len(data)
+
+def _measure(content, repeat, render):
+    """Best-of-repeat stage timings plus peak memory and output size for one document."""
+    from generate_pdf import parse_markdown, process_text_formatting, _tokenize_inline
+
+    best = {}
+    output_bytes = None
+    for _ in range(repeat):
+        stage_times = {'parse': 0.0, 'inline': 0.0, 'render_text': 0.0, 'layout': 0.0, 'output': 0.0}
+        start = time.perf_counter()
+        sections = parse_markdown(content)
+        stage_times['parse'] = time.perf_counter() - start
+        if render:
+            output_bytes = _run_pipeline(content, stage_times)
+        else:
+            # Too big to lay out in reasonable time: time the inline formatter on its own
+            _tokenize_inline.cache_clear()
+            start = time.perf_counter()
+            for section in sections:
+                if section['type'] == 'text':
+                    for block in section['content']:
+                        process_text_formatting(block.text)
+            stage_times['inline'] = time.perf_counter() - start
+            del stage_times['render_text'], stage_times['layout'], stage_times['output']
+        for stage, seconds in stage_times.items():
+            best[stage] = min(best.get(stage, seconds), seconds)
+        del sections
+
+    # Memory is measured in a separate pass, tracemalloc skews timings
+    tracemalloc.start()
+    if render:
+        _run_pipeline(content, dict.fromkeys(best, 0.0))
+    else:
+        parse_markdown(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {f'{stage}_s': round(seconds, 6) for stage, seconds in best.items()}
+    result['peak_bytes'] = peak
+    result['input_bytes'] = len(content.encode('utf-8'))
+    if output_bytes is not None:
+        result['output_bytes'] = output_bytes
+    return result
+
+def _metadata():
+    from generate_pdf import RENDERER_VERSION
+    return {
+        'renderer_version': RENDERER_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def _write_results(results, path):
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f"Results written to {path}")
+    else:
+        print(text)
+
+def bench_suite(args):
+    """Per-stage latency, peak memory and output size for every corpus and size."""
+    results = {'meta': _metadata(), 'results': {}}
+    max_render = parse_size(args.max_render)
+    for kind in args.corpora:
+        for size_text in args.sizes:
+            size = parse_size(size_text)
+            content = make_corpus(kind, size, seed=args.seed)
+            result = _measure(content, args.repeat, render=size <= max_render)
+            results['results'][f'{kind}/{size_text}'] = result
+            stages = '  '.join(f"{key[:-2]} {value * 1000:9.1f}ms" for key, value in result.items() if key.endswith('_s'))
+            print(f"{kind + '/' + size_text:16} {stages}  peak {result['peak_bytes'] / 2**20:7.1f} MiB", file=sys.stderr)
+    _write_results(results, args.output)
+
+def bench_load(args):
+    """Concurrent /convert_text requests through the Flask test client."""
+    from app import app
+
+    # Distinct documents per request so the PDF cache never short-circuits a render
+    documents = [make_corpus('prose', parse_size(args.size), seed=i) for i in range(args.requests)]
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    next_index = iter(range(args.requests))
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            start = time.perf_counter()
+            response = client.post('/convert_text', data={'markdown-text': documents[index]},
+                                   headers={'X-Requested-With': 'XMLHttpRequest'})
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if response.status_code == 200 else failures).append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+    load = {
+        'requests': args.requests,
+        'threads': args.threads,
+        'failures': len(failures),
+        'requests_per_s': round(len(latencies) / wall, 3),
+        'p50_s': percentile(0.50),
+        'p95_s': percentile(0.95),
+        'p99_s': percentile(0.99),
+        'mean_s': statistics.mean(latencies) if latencies else None,
+    }
+    _write_results({'meta': _metadata(), 'load': load}, args.output)
+
+# Server commands compared by the serve benchmark; {workers} and {port} are filled in
+SERVERS = {
+    'sync': 'gunicorn app:app --workers {workers} --bind 127.0.0.1:{port}',
+    'asgi': 'gunicorn asgi:app --worker-class uvicorn_worker.UvicornWorker --workers {workers} --bind 127.0.0.1:{port}',
+}
+
+async def _http_request(port, path, body, content_type, chunk_size=None, delay=0.0, read_delay=0.0):
+    """POST body and return (status, response size); with a delay, the body
+    is trickled chunk_size bytes at a time and the response read just as slowly."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write((f'POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n'
+                      f'Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n').encode('latin-1'))
+        if chunk_size:
+            for start in range(0, len(body), chunk_size):
+                writer.write(body[start:start + chunk_size])
+                await writer.drain()
+                await asyncio.sleep(delay)
+        else:
+            writer.write(body)
+        await writer.drain()
+        status_line = await reader.readline()
+        size = 0
+        while True:
+            data = await reader.read(chunk_size or 65536)
+            if not data:
+                break
+            size += len(data)
+            if read_delay:
+                await asyncio.sleep(read_delay)
+        return int(status_line.split()[1]) if status_line else 0, size
+    finally:
+        writer.close()
+
+async def _serve_load(port, args):
+    deadline = time.monotonic() + args.duration
+    latencies = []
+    statuses = {}
+    slow_body = make_corpus('prose', parse_size(args.slow_size), seed=1).encode('utf-8')
+
+    async def slow_client():
+        # Trickles its upload and reads its PDF slowly, the way a poor mobile link does
+        while time.monotonic() < deadline:
+            try:
+                await _http_request(port, '/api/v1/render', slow_body, 'text/markdown',
+                                    chunk_size=args.slow_chunk, delay=args.slow_delay,
+                                    read_delay=args.slow_delay)
+            except OSError:
+                await asyncio.sleep(args.slow_delay)
+
+    async def fast_client(client):
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            # Distinct documents so every request renders instead of hitting the cache
+            body = f'# Client {client} request {n}\n\n{make_paragraph_line(random.Random(n), 40)}\n'.encode('utf-8')
+            start = time.perf_counter()
+            try:
+                status, _ = await _http_request(port, '/api/v1/render', body, 'text/markdown')
+            except OSError:
+                status = 0
+            if time.monotonic() < deadline:
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    slow = [asyncio.create_task(slow_client()) for _ in range(args.slow)]
+    await asyncio.sleep(1)  # Let the slow clients occupy their connections first
+    await asyncio.gather(*(fast_client(i) for i in range(args.fast)))
+    for task in slow:
+        task.cancel()
+    await asyncio.gather(*slow, return_exceptions=True)
+    return latencies, statuses
+
+def _wait_for_server(port, process, timeout=60):
+    import socket
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'Server exited with status {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('Server did not start in time')
+
+def bench_serve(args):
+    """p50/p99 latency of fast clients sharing a server with slow uploaders/downloaders."""
+    results = {'meta': _metadata(), 'serve': {}}
+    # Every request comes from 127.0.0.1, so the per-client API limit must not apply
+    env = dict(os.environ, API_CLIENT_CONCURRENCY=str(args.slow + args.fast + 1))
+    for offset, target in enumerate(args.target):
+        # A fresh port per server, the previous one may still be shutting down
+        port = args.port + offset
+        command = SERVERS[target].format(workers=args.workers, port=port).split()
+        process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_server(port, process)
+            latencies, statuses = asyncio.run(_serve_load(port, args))
+        finally:
+            process.terminate()
+            process.wait()
+
+        latencies.sort()
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+        result = {
+            'requests': len(latencies),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'p50_s': percentile(0.50),
+            'p99_s': percentile(0.99),
+        }
+        results['serve'][target] = result
+        p50 = f"{result['p50_s'] * 1000:8.0f}ms" if latencies else '       -'
+        p99 = f"{result['p99_s'] * 1000:8.0f}ms" if latencies else '       -'
+        print(f"{target:5} {len(latencies):6} fast requests   p50 {p50}   p99 {p99}   status {result['statuses']}",
+              file=sys.stderr)
+    _write_results(results, args.output)
+
+def _worker_pids(pid):
+    # Gunicorn's workers are the master's child processes (Linux only)
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+def _memory_kib(pid):
+    """(RSS, PSS) of a process in KiB; PSS splits pages shared with other processes between them."""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                values[name] = int(rest.split()[0])
+    return values['Rss'], values['Pss']
+
+def bench_startup(args):
+    """Time until gunicorn serves requests, and memory per worker, with and without --preload."""
+    import urllib.request
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    # What every worker pays to import the app when it is not preloaded
+    output = subprocess.run([sys.executable, '-c', 'import time; start = time.perf_counter(); import app; '
+                             'print(time.perf_counter() - start)'], cwd=cwd, capture_output=True, text=True)
+    print(f"import app: {float(output.stdout.split()[-1]):.2f}s")
+    for offset, mode in enumerate(args.mode):
+        port = args.port + offset
+        command = SERVERS['sync'].format(workers=args.workers, port=port).split()
+        if mode == 'preload':
+            command.append('--preload')
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + 120
+            while True:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise SystemExit(f'{mode}: server did not start')
+                try:
+                    with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=5):
+                        pass
+                    if len(_worker_pids(process.pid)) == args.workers:
+                        break
+                except OSError:
+                    pass
+                time.sleep(0.05)
+            ready = time.perf_counter() - start
+            # Let every worker finish booting (render pools, fonts) before measuring
+            time.sleep(args.settle)
+            memory = [_memory_kib(pid) for pid in _worker_pids(process.pid)]
+            master = _memory_kib(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+        rss = statistics.mean(value[0] for value in memory) / 1024
+        pss = statistics.mean(value[1] for value in memory) / 1024
+        print(f"{mode:8} ready in {ready:.2f}s   per worker: RSS {rss:.1f} MiB, PSS {pss:.1f} MiB   "
+              f"master RSS {master[0] / 1024:.1f} MiB")
+
+def bench_cli(args):
+    """Wall-clock time of the markdownforge command on a docs tree: full build, no-op rebuild, a few edits."""
+    import shutil
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    root = tempfile.mkdtemp()
+    try:
+        docs, out = os.path.join(root, 'docs'), os.path.join(root, 'pdf')
+        kinds = sorted(CORPORA)
+        paths = []
+        for index in range(args.files):
+            directory = os.path.join(docs, f'part{index % 20}', f'chapter{index % 7}')
+            os.makedirs(directory, exist_ok=True)
+            paths.append(os.path.join(directory, f'page{index}.md'))
+            with open(paths[-1], 'w', encoding='utf-8') as f:
+                f.write(make_corpus(kinds[index % len(kinds)], parse_size(args.size), seed=args.seed + index))
+
+        def run(label):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-m', 'markdownforge', docs, '-o', out] +
+                                    (['--jobs', str(args.jobs)] if args.jobs else []),
+                                    cwd=cwd, capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+            if output.returncode:
+                raise SystemExit(output.stderr)
+            print(f"{label:8} {elapsed:6.2f}s   {output.stdout.strip().splitlines()[-1]}")
+
+        run('full')
+        run('no-op')
+        for path in random.Random(args.seed).sample(paths, min(args.edits, len(paths))):
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write('\nOne more line.\n')
+        run('edited')
+    finally:
+        shutil.rmtree(root)
+
+# Metrics where a larger value in the new run is a regression
+LOWER_IS_BETTER = ('_s', '_bytes')
+
+def _flatten(results):
+    metrics = {}
+    for name, values in results.get('results', {}).items():
+        for key, value in values.items():
+            if key != 'input_bytes' and key.endswith(LOWER_IS_BETTER) and value is not None:
+                metrics[f'{name} {key}'] = value
+    for key, value in results.get('load', {}).items():
+        if key.endswith('_s') and value is not None:
+            metrics[f'load {key}'] = value
+    return metrics
+
+def bench_compare(args):
+    """Fail when any metric grew by more than the threshold since the baseline."""
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = _flatten(json.load(f))
+    with open(args.current, encoding='utf-8') as f:
+        current = _flatten(json.load(f))
+
+    regressions = []
+    for name in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[name], current[name]
+        # Sub-millisecond timings are mostly noise
+        if name.endswith('_s') and max(before, after) < args.min_seconds:
+            continue
+        if before and after > before * (1 + args.threshold):
+            regressions.append((name, before, after))
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:40} {before:>14.6g} {after:>14.6g} {change:+7.1f}%")
+
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}:")
+        for name, before, after in regressions:
+            print(f"  {name}: {before:.6g} -> {after:.6g}")
+        sys.exit(1)
+    print(f"\nNo regressions beyond {args.threshold:.0%}")
+
+def bench_dispatch(args):
+    """Parse and lay out a document; PDF serialization is excluded."""
+    # Imported here so the corpus helpers stay usable without fpdf installed
+    from generate_pdf import build_pdf
+
+    content = make_mixed_document(args.lines)
+    start = time.perf_counter()
+    build_pdf(content)
+    elapsed = time.perf_counter() - start
+    print(f"{args.lines} lines in {elapsed:.2f}s ({args.lines / elapsed:,.0f} lines/sec)")
+
+# PDF methods whose calls make up most of the layout time
+LAYOUT_CALLS = ('cell', 'multi_cell', 'set_font', 'set_xy', 'set_x', 'ln', 'get_string_width')
+
+def check_deep_quotes():
+    """Exit non-zero if a deeply nested quote line is slow to lay out (depth
+    used to be unbounded, and 1000 levels took 20s for a 1.2 KB line)."""
+    from generate_pdf import build_pdf
+
+    for depth, length in ((1000, 200), (2000, 400)):
+        start = time.perf_counter()
+        pdf = build_pdf('>' * depth + ' ' + 'x' * length)
+        elapsed = time.perf_counter() - start
+        if elapsed > 1 or pdf.page > 1:
+            raise SystemExit(f'{depth} nested quotes: {elapsed:.2f}s, {pdf.page} pages')
+
+def bench_layout(args):
+    """fpdf calls per page and layout time on a prose document."""
+    from generate_pdf import PDF, build_pdf
+
+    check_deep_quotes()
+
+    counts = dict.fromkeys(LAYOUT_CALLS, 0)
+    def counted(name, method):
+        def wrapper(self, *a, **kw):
+            counts[name] += 1
+            return method(self, *a, **kw)
+        return wrapper
+    originals = {name: getattr(PDF, name) for name in LAYOUT_CALLS}
+    for name, method in originals.items():
+        setattr(PDF, name, counted(name, method))
+    try:
+        content = make_corpus('prose', parse_size(args.size), seed=args.seed)
+        start = time.perf_counter()
+        pdf = build_pdf(content)
+        elapsed = time.perf_counter() - start
+    finally:
+        for name, method in originals.items():
+            setattr(PDF, name, method)
+
+    calls = sum(counts.values())
+    print(f"{pdf.page} pages in {elapsed:.2f}s, {calls / pdf.page:.0f} fpdf calls per page")
+    for name, count in counts.items():
+        if count:
+            print(f"  {name:17} {count / pdf.page:8.1f}/page")
+
+def bench_size(args):
+    """PDF output size per corpus, with and without PDF 1.5 object streams."""
+    from generate_pdf import PDF, generate_pdf_from_content
+
+    results = {'meta': _metadata(), 'results': {}}
+    default = PDF.object_streams
+    try:
+        for kind in args.corpora:
+            for size_text in args.sizes:
+                content = make_corpus(kind, parse_size(size_text), seed=args.seed)
+                sizes = {}
+                for object_streams in (False, True):
+                    PDF.object_streams = object_streams
+                    sizes[object_streams] = len(generate_pdf_from_content(content))
+                results['results'][f'{kind}/{size_text}'] = {
+                    'output_bytes': sizes[False], 'output_objstm_bytes': sizes[True]}
+                print(f"{kind + '/' + size_text:16} {sizes[False]:>10,} bytes   "
+                      f"{sizes[True]:>10,} bytes with object streams", file=sys.stderr)
+    finally:
+        PDF.object_streams = default
+    _write_results(results, args.output)
+
+# Inputs that used to make process_text_formatting quadratic (or never return)
+PATHOLOGICAL_LINES = {
+    'underscores': lambda n: '_' * n,
+    'asterisks': lambda n: '*' * n,
+    'snake_case': lambda n: ('snake_case_' * n)[:n],
+    'unmatched_bold': lambda n: ('a **' * n)[:n],
+    'unmatched_italic': lambda n: ('x *y ' * n)[:n],
+    'bold_italic': lambda n: ('***bi*** ' * n)[:n],
+}
+
+def bench_inline(args):
+    """Time process_text_formatting at n and 10n characters; linear code scales ~10x."""
+    from generate_pdf import process_text_formatting, _tokenize_inline
+
+    for name, make_line in PATHOLOGICAL_LINES.items():
+        timings = []
+        for size in (args.size, args.size * 10):
+            line = make_line(size)
+            _tokenize_inline.cache_clear()
+            start = time.perf_counter()
+            process_text_formatting(line)
+            timings.append(time.perf_counter() - start)
+        ratio = timings[1] / timings[0] if timings[0] else float('inf')
+        print(f"{name:18} {args.size:>8} chars {timings[0] * 1000:8.2f}ms   "
+              f"{args.size * 10:>8} chars {timings[1] * 1000:8.2f}ms   x{ratio:.1f}")
+
+# Line generators for the clean_text benchmark, by script
+def make_cjk_line(rng, chars=40):
+    return ''.join(chr(rng.randint(0x4E00, 0x9FFF)) if rng.random() < 0.9 else rng.choice('，。、「」')
+                   for _ in range(chars))
+
+def make_emoji_line(rng, words=12):
+    # Zero-width joiners and variation selectors are format/mark characters, like real emoji text
+    emoji = ['\U0001F600', '\U0001F680', '\U0001F44D\U0001F3FD', '\U0001F469\u200d\U0001F4BB',
+             '\u2764\ufe0f', '\U0001F1EF\U0001F1F5']
+    return ' '.join(rng.choice(emoji) if rng.random() < 0.4 else rng.choice(WORDS) for _ in range(words))
+
+CLEAN_CORPORA = {
+    'ascii': make_paragraph_line,
+    'cjk': make_cjk_line,
+    'emoji': make_emoji_line,
+}
+
+def _reference_clean_text(text):
+    # The original per-character implementation, kept to check output is unchanged
+    import unicodedata
+    return ''.join(c for c in text if unicodedata.category(c)[0] != 'C')
+
+def bench_clean(args):
+    """clean_text lines/sec per script, against the original per-character version."""
+    from generate_pdf import clean_text
+
+    for name, make_line in CLEAN_CORPORA.items():
+        rng = random.Random(0)
+        lines = [make_line(rng) for _ in range(args.lines)]
+        # A few lines with tabs and control characters take the slow path
+        for i in range(0, len(lines), 50):
+            lines[i] = '\t' + lines[i] + '\x00\r'
+        clean_text('\x00')  # Exclude one-off table setup from the timing
+
+        timings = []
+        for fn in (_reference_clean_text, clean_text):
+            start = time.perf_counter()
+            results = [fn(line) for line in lines]
+            timings.append(time.perf_counter() - start)
+            if fn is _reference_clean_text:
+                expected = results
+        if results != expected:
+            raise SystemExit(f"{name}: clean_text output differs from the reference")
+        chars = sum(map(len, lines))
+        print(f"{name:6} {chars / timings[0] / 1e6:8.2f} Mchar/s before   "
+              f"{chars / timings[1] / 1e6:8.2f} Mchar/s after   x{timings[0] / timings[1]:.1f}")
+
+def bench_memory(args):
+    """Peak traced memory while parsing a large file, streamed vs read whole."""
+    from generate_pdf import iter_sections, parse_markdown
+
+    fd, path = tempfile.mkstemp(suffix='.md')
+    os.close(fd)
+    try:
+        write_mixed_corpus(path, args.mb * 1024 * 1024)
+
+        tracemalloc.start()
+        with open(path, encoding='utf-8') as f:
+            sections = sum(1 for _ in iter_sections(f))
+        streamed_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"streamed:   {sections} sections, peak {streamed_peak / 2**20:8.1f} MiB")
+
+        if not args.skip_eager:
+            tracemalloc.start()
+            with open(path, encoding='utf-8') as f:
+                sections = len(parse_markdown(f.read()))
+            eager_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"read whole: {sections} sections, peak {eager_peak / 2**20:8.1f} MiB")
+    finally:
+        os.remove(path)
+
+def bench_batch(args):
+    """Batch throughput in docs/sec for several render pool sizes."""
+    from batch import iter_batch_zip
+    from render_engine import RenderEngine
+
+    # Distinct seeds so deduplication doesn't skip any work
+    entries = [(f'doc{i}.md', make_mixed_document(args.lines, seed=i), None) for i in range(args.docs)]
+    for workers in args.workers:
+        engine = RenderEngine(max_workers=workers)
+        engine.start()
+        try:
+            start = time.perf_counter()
+            size = sum(len(chunk) for chunk in iter_batch_zip(entries, engine, engine.timeout))
+            elapsed = time.perf_counter() - start
+        finally:
+            engine.shutdown()
+        print(f"{workers} workers: {args.docs} docs in {elapsed:.2f}s "
+              f"({args.docs / elapsed:.1f} docs/sec, {size / 2**20:.1f} MiB zip)")
+
+def bench_preview(args):
+    """Preview refresh time after typing into a long document, against a full render."""
+    from generate_pdf import generate_pdf_from_content
+    from preview import PreviewSession
+
+    lines = make_corpus('prose', parse_size(args.size), seed=args.seed).split('\n')
+    start = time.perf_counter()
+    generate_pdf_from_content('\n'.join(lines))
+    full = time.perf_counter() - start
+
+    session = PreviewSession()
+    session.render('\n'.join(lines))
+    rng = random.Random(args.seed)
+    timings, rendered = [], []
+    for _ in range(args.edits):
+        # Type a word at the end of a random line
+        index = rng.randrange(len(lines))
+        lines[index] += ' ' + rng.choice(WORDS)
+        start = time.perf_counter()
+        pdf, sections = session.render('\n'.join(lines))
+        timings.append(time.perf_counter() - start)
+        rendered.append(sections)
+    print(f"full render {full * 1000:.0f}ms; preview after an edit: median {statistics.median(timings) * 1000:.1f}ms, "
+          f"max {max(timings) * 1000:.1f}ms, {statistics.mean(rendered):.1f} sections laid out on average")
+
+def bench_table(args):
+    """Parse and lay out one large pipe table; PDF serialization is excluded."""
+    from generate_pdf import build_pdf
+
+    rng = random.Random(args.seed)
+    lines = ["| " + " | ".join(rng.choice(WORDS).title() for _ in range(args.columns)) + " |",
+             "|" + "---|" * args.columns]
+    for _ in range(args.rows):
+        lines.append("| " + " | ".join(make_paragraph_line(rng, rng.randint(1, 6)) for _ in range(args.columns)) + " |")
+    start = time.perf_counter()
+    pdf = build_pdf('\n'.join(lines))
+    elapsed = time.perf_counter() - start
+    print(f"{args.rows} rows in {elapsed:.2f}s ({args.rows / elapsed:,.0f} rows/sec, {pdf.page} pages)")
+
+def iter_code_block(rng, lines, language):
+    yield f"```{language}"
+    for _ in range(lines):
+        name = '_'.join(rng.sample(WORDS, 2))
+        yield (f"{'    ' * rng.randint(0, 3)}{name} = compute({rng.randint(0, 999)}, \"{rng.choice(WORDS)}\")"
+               f"  # {make_paragraph_line(rng, rng.randint(0, 8))}")
+    yield "```"
+
+def check_code_page_breaks():
+    """Exit non-zero if a short code block starting near the foot of a page
+    is laid out over more than two pages (it used to leave a page with one row)."""
+    from generate_pdf import build_pdf
+
+    for filler in range(30, 50):
+        content = '\n'.join(make_paragraph_line(random.Random(0), 3) for _ in range(filler))
+        pdf = build_pdf(content + '\n```\n' + '\n'.join(f'code {i}' for i in range(5)) + '\n```')
+        if pdf.page > 2:
+            raise SystemExit(f'{filler} lines then a 5-line code block: {pdf.page} pages')
+
+def bench_code(args):
+    """Lay out one long fenced code block, and the parser and highlighter's peak memory on it."""
+    from generate_pdf import build_pdf, iter_sections
+    from highlight import highlight
+
+    check_code_page_breaks()
+
+    start = time.perf_counter()
+    pdf = build_pdf(iter_code_block(random.Random(args.seed), args.lines, args.language))
+    elapsed = time.perf_counter() - start
+    print(f"{args.lines} lines of {args.language or 'plain text'} in {elapsed:.2f}s "
+          f"({args.lines / elapsed:,.0f} lines/sec, {pdf.page} pages)")
+
+    tracemalloc.start()
+    state = None
+    # Another seed, so the highlighter's cache does not already hold the code
+    for section in iter_sections(iter_code_block(random.Random(args.seed + 1), args.lines, args.language)):
+        _, state = highlight(section["content"], section["language"], state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"parse and highlight peak {peak / 2**20:.1f} MiB")
+
+def bench_parse(args):
+    """Parser throughput in MB/s per corpus, best of a few runs; no layout."""
+    from generate_pdf import iter_sections
+
+    for kind in args.corpora:
+        content = make_corpus(kind, parse_size(args.size), seed=args.seed)
+        size = len(content.encode('utf-8'))
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            sections = sum(1 for _ in iter_sections(content))
+            timings.append(time.perf_counter() - start)
+        print(f"{kind:8} {size / min(timings) / 2**20:8.2f} MB/s   {sections} sections")
+
+def make_manual(chapters, size_bytes, seed=0):
+    """A document of # chapters, each a mix of the standard corpora."""
+    kinds = sorted(CORPORA)
+    parts = []
+    for chapter in range(chapters):
+        body = make_corpus(kinds[chapter % len(kinds)], size_bytes // chapters, seed=seed + chapter)
+        parts.append(f"# Chapter {chapter + 1}\n{body}")
+    return '\n'.join(parts)
+
+def bench_parallel(args):
+    """Wall-clock time of parallel layout by worker count, against laying out in order."""
+    from generate_pdf import generate_pdf_from_content
+    from parallel import generate_pdf_parallel
+
+    content = make_manual(args.chapters, parse_size(args.size), args.seed)
+    # Every timing is of a second run, with fonts loaded and the per-process caches filled
+    generate_pdf_from_content(content, chapter_level=1)
+    start = time.perf_counter()
+    expected = generate_pdf_from_content(content, chapter_level=1)
+    sequential = time.perf_counter() - start
+    print(f"in order: {sequential:.2f}s, {len(expected) / 2**20:.1f} MiB")
+    for workers in args.workers:
+        generate_pdf_parallel(content, workers)
+        start = time.perf_counter()
+        data = generate_pdf_parallel(content, workers)
+        elapsed = time.perf_counter() - start
+        # Only the creation date may differ
+        same = re.sub(rb'/CreationDate \(D:\d+\)', b'', data) == re.sub(rb'/CreationDate \(D:\d+\)', b'', expected)
+        print(f"{workers} workers: {elapsed:.2f}s (x{sequential / elapsed:.2f}), "
+              f"{'identical' if same else 'DIFFERENT'} output")
+        if not same:
+            sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="MarkdownForge benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    suite = subparsers.add_parser('suite', help='Per-stage timings on the standard corpora')
+    suite.add_argument('--corpora', nargs='+', choices=sorted(CORPORA), default=list(CORPORA))
+    suite.add_argument('--sizes', nargs='+', default=['1KB', '64KB', '256KB'],
+                       help='Document sizes, e.g. 1KB 64KB 1MB 50MB')
+    suite.add_argument('--max-render', default='4MB',
+                       help='Larger documents only time parsing and inline formatting')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--output', help='Write JSON results here instead of stdout')
+    suite.set_defaults(func=bench_suite)
+
+    load = subparsers.add_parser('load', help='Concurrent /convert_text requests via the Flask test client')
+    load.add_argument('--requests', type=int, default=50)
+    load.add_argument('--threads', type=int, default=4)
+    load.add_argument('--size', default='8KB')
+    load.add_argument('--output', help='Write JSON results here instead of stdout')
+    load.set_defaults(func=bench_load)
+
+    serve = subparsers.add_parser('serve', help='Sync vs ASGI server latency with slow clients present')
+    serve.add_argument('--target', nargs='+', choices=sorted(SERVERS), default=['sync', 'asgi'])
+    serve.add_argument('--workers', type=int, default=2)
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--slow', type=int, default=50, help='Concurrent slow clients')
+    serve.add_argument('--slow-size', default='16KB', help='Markdown uploaded by each slow client')
+    serve.add_argument('--slow-chunk', type=int, default=1024, help='Bytes per slow send/receive')
+    serve.add_argument('--slow-delay', type=float, default=0.2, help='Seconds between slow sends/receives')
+    serve.add_argument('--fast', type=int, default=4, help='Concurrent fast clients')
+    serve.add_argument('--duration', type=float, default=30)
+    serve.add_argument('--output', help='Write JSON results here instead of stdout')
+    serve.set_defaults(func=bench_serve)
+
+    compare = subparsers.add_parser('compare', help='Exit non-zero when results regressed against a baseline')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.10, help='Allowed relative slowdown (0.10 = 10%%)')
+    compare.add_argument('--min-seconds', type=float, default=0.001)
+    compare.set_defaults(func=bench_compare)
+
+    dispatch = subparsers.add_parser('dispatch', help='Parse and layout lines/sec on a mixed document')
+    dispatch.add_argument('--lines', type=int, default=50000)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    inline = subparsers.add_parser('inline', help='Inline formatter on pathological marker runs')
+    inline.add_argument('--size', type=int, default=10000)
+    inline.set_defaults(func=bench_inline)
+
+    size = subparsers.add_parser('size', help='PDF output size on the standard corpora')
+    size.add_argument('--corpora', nargs='+', choices=sorted(CORPORA), default=list(CORPORA))
+    size.add_argument('--sizes', nargs='+', default=['1KB', '64KB'])
+    size.add_argument('--seed', type=int, default=0)
+    size.add_argument('--output', help='Write JSON results here instead of stdout')
+    size.set_defaults(func=bench_size)
+
+    layout = subparsers.add_parser('layout', help='fpdf calls per page when laying out prose')
+    layout.add_argument('--size', default='256KB')
+    layout.add_argument('--seed', type=int, default=0)
+    layout.set_defaults(func=bench_layout)
+
+    clean = subparsers.add_parser('clean', help='clean_text throughput on ASCII, CJK and emoji text')
+    clean.add_argument('--lines', type=int, default=20000)
+    clean.set_defaults(func=bench_clean)
+
+    memory = subparsers.add_parser('memory', help='Peak parser memory on a large input file')
+    memory.add_argument('--mb', type=int, default=100)
+    memory.add_argument('--skip-eager', action='store_true', help='Only measure the streaming parser')
+    memory.set_defaults(func=bench_memory)
+
+    batch = subparsers.add_parser('batch', help='Batch conversion throughput by pool size')
+    batch.add_argument('--docs', type=int, default=32)
+    batch.add_argument('--lines', type=int, default=200)
+    batch.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    batch.set_defaults(func=bench_batch)
+
+    preview = subparsers.add_parser('preview', help='Incremental preview refresh after small edits')
+    preview.add_argument('--size', default='300KB')
+    preview.add_argument('--edits', type=int, default=20)
+    preview.add_argument('--seed', type=int, default=0)
+    preview.set_defaults(func=bench_preview)
+
+    table = subparsers.add_parser('table', help='Rows/sec laying out a large pipe table')
+    table.add_argument('--rows', type=int, default=10000)
+    table.add_argument('--columns', type=int, default=5)
+    table.add_argument('--seed', type=int, default=0)
+    table.set_defaults(func=bench_table)
+
+    code = subparsers.add_parser('code', help='Lines/sec laying out a long highlighted code block')
+    code.add_argument('--lines', type=int, default=20000)
+    code.add_argument('--language', default='python', help="Fence info string; '' for plain text")
+    code.add_argument('--seed', type=int, default=0)
+    code.set_defaults(func=bench_code)
+
+    parallel = subparsers.add_parser('parallel', help='Parallel chapter layout speedup and output check')
+    parallel.add_argument('--chapters', type=int, default=40)
+    parallel.add_argument('--size', default='2MB')
+    parallel.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parallel.add_argument('--seed', type=int, default=0)
+    parallel.set_defaults(func=bench_parallel)
+
+    startup = subparsers.add_parser('startup', help='gunicorn boot time and per-worker memory, with and without --preload')
+    startup.add_argument('--workers', type=int, default=4)
+    startup.add_argument('--mode', nargs='+', choices=['default', 'preload'], default=['default', 'preload'])
+    startup.add_argument('--port', type=int, default=8775)
+    startup.add_argument('--settle', type=float, default=3, help='Seconds to wait before measuring memory')
+    startup.set_defaults(func=bench_startup)
+
+    parse = subparsers.add_parser('parse', help='Parser MB/s on the standard corpora')
+    parse.add_argument('--corpora', nargs='+', choices=sorted(CORPORA), default=['code', 'lists', 'prose'])
+    parse.add_argument('--size', default='8MB')
+    parse.add_argument('--repeat', type=int, default=3)
+    parse.add_argument('--seed', type=int, default=0)
+    parse.set_defaults(func=bench_parse)
+
+    cli = subparsers.add_parser('cli', help='markdownforge command: full build, no-op rebuild and a few edits')
+    cli.add_argument('--files', type=int, default=2000)
+    cli.add_argument('--size', default='2KB', help='Size of each markdown file')
+    cli.add_argument('--edits', type=int, default=10, help='Files changed before the last rebuild')
+    cli.add_argument('--jobs', type=int, default=None, help='Render processes (default: one per core)')
+    cli.add_argument('--seed', type=int, default=0)
+    cli.set_defaults(func=bench_cli)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,471 @@
 from fpdf import FPDF
+from fpdf.php import UTF8ToUTF16BE
+from fpdf.ttfonts import TTFontFile
+from dataclasses import dataclass, replace
+from enum import Enum
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate, chain
+import logging
 import re
 import os
+import struct
+import threading
+import time
+import unicodedata
+import zlib
+from collections import deque
+
+from highlight import highlight
+from images import IMAGE_ROOT, ImageError, load_image, prefetch
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever a change alters the generated PDF, so cached output is not reused
+RENDERER_VERSION = "10"
+
+# Unicode font embedded in every generated PDF
+FONT_FAMILY = "NotoSans"
+FONT_FILE = "NotoSans-Regular.ttf"
+FONT_STYLES = ("", "B", "I", "BI")
+
+# Write PDF 1.5 object streams and a cross-reference stream instead of a
+# plain xref table; smaller, but not readable by PDF 1.4-only software
+PDF_OBJECT_STREAMS = os.environ.get('PDF_OBJECT_STREAMS', '') == '1'
+
+# Objects packed into each object stream
+OBJECT_STREAM_SIZE = 100
+
+# Sections parsed ahead of layout, so their images decode in the meantime
+IMAGE_LOOKAHEAD = 8
+
+# Parsed font metrics shared by every PDF instance in this process
+_font_registry = {}
+_font_registry_lock = threading.Lock()
+
+def resolve_font_path(font_path=FONT_FILE):
+    """Return the first existing location of the font file."""
+    possible_paths = [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), font_path),  # Current project directory
+        os.path.join(os.getcwd(), font_path),                                 # Current working directory
+        font_path                                                             # Direct path
+    ]
+    font_full_path = next((path for path in possible_paths if os.path.exists(path)), None)
+    if not font_full_path:
+        raise FileNotFoundError(f"Font file not found in any of the following locations: {possible_paths}")
+    return font_full_path
+
+def _load_font_metrics(ttf_path):
+    # Same metrics fpdf's add_font(uni=True) computes, without its pickle cache
+    ttf = TTFontFile()
+    ttf.getMetrics(ttf_path)
+    ttf.fh.close()
+    return {
+        'name': re.sub('[ ()]', '', ttf.fullName),
+        'type': 'TTF',
+        'desc': {
+            'Ascent': int(round(ttf.ascent, 0)),
+            'Descent': int(round(ttf.descent, 0)),
+            'CapHeight': int(round(ttf.capHeight, 0)),
+            'Flags': ttf.flags,
+            'FontBBox': "[%s %s %s %s]" % tuple(int(round(v, 0)) for v in ttf.bbox),
+            'ItalicAngle': int(ttf.italicAngle),
+            'StemV': int(round(ttf.stemV, 0)),
+            'MissingWidth': int(round(ttf.defaultWidth, 0)),
+        },
+        'up': round(ttf.underlinePosition),
+        'ut': round(ttf.underlineThickness),
+        'cw': ttf.charWidths,
+        'ttffile': ttf_path,
+        'originalsize': os.stat(ttf_path).st_size,
+    }
+
+def get_font_metrics(family=FONT_FAMILY, font_path=FONT_FILE):
+    """Return the shared metrics for a font, parsing the TTF on first use only."""
+    key = (family.lower(), font_path)
+    font = _font_registry.get(key)
+    if font is None:
+        with _font_registry_lock:
+            font = _font_registry.get(key)
+            if font is None:
+                font = _load_font_metrics(resolve_font_path(font_path))
+                _font_registry[key] = font
+    return font
+
+def warm_up_fonts():
+    """Load every registered font up front, e.g. from gunicorn's post_fork hook."""
+    get_font_metrics(FONT_FAMILY, FONT_FILE)
+
+class BlockType(Enum):
+    TEXT = "text"
+    BULLET = "bullet"
+    NUMBERED = "numbered"
+    HEADING = "heading"
+    LINK = "link"
+    IMAGE = "image"
+    CODE = "code"
+    QUOTE = "quote"
+    HR = "hr"
+
+@dataclass(slots=True)
+class Block:
+    """A single classified content line produced by parse_markdown."""
+    type: BlockType
+    text: str = ""
+    level: int = 0      # Indent level for list items, heading level for headings
+    number: str = ""    # Item number for numbered lists
+    target: str = ""    # Image source; text is then the alt text
+
+@dataclass(slots=True)
+class PipelineStats:
+    """Stage timings and document counters for one conversion.
+
+    Stage times are exclusive: layout is the time build_pdf spent in fpdf
+    after parsing, cleaning and inline formatting are taken out.
+    """
+    clean_seconds: float = 0.0
+    parse_seconds: float = 0.0
+    inline_seconds: float = 0.0
+    layout_seconds: float = 0.0
+    output_seconds: float = 0.0
+    bytes_in: int = 0
+    lines: int = 0
+    sections: int = 0
+    pages: int = 0
+    bytes_out: int = 0
+
+# Stats of the conversion running on this thread, for the inline formatter
+_active = threading.local()
+
+class _GlyphSubset(list):
+    """fpdf's list of code points used with a font, keeping each one only once.
+
+    fpdf appends every character it renders, which made the list as long as
+    the document and writing the font widths quadratic.
+    """
+
+    def __init__(self, codepoints=()):
+        super().__init__()
+        self._seen = set()
+        self.extend(codepoints)
+
+    def append(self, codepoint):
+        if codepoint not in self._seen:
+            self._seen.add(codepoint)
+            super().append(codepoint)
+
+    def extend(self, codepoints):
+        for codepoint in codepoints:
+            self.append(codepoint)
+
+    def __contains__(self, codepoint):
+        return codepoint in self._seen
+
+class _PageRangeDone(BaseException):
+    """Raised by add_page past the last requested page to end layout early.
+
+    A BaseException, so the per-line error handling lets it through.
+    """
+
+class PageOutOfRange(ValueError):
+    """The requested pages start after the end of the document."""
+
+def _unique_fonts(fonts):
+    # Font styles registered by attach_font share one font object
+    unique = {}
+    for fontkey, font in fonts.items():
+        if all(font is not other for other in unique.values()):
+            unique[fontkey] = font
+    return unique
 
 class PDF(FPDF):
+    object_streams = PDF_OBJECT_STREAMS
+    page_streams = None
+    # When a dict, footer records each page's length and layout state in it
+    # before drawing, so footers can be redrawn with other page numbers
+    footer_states = None
+    # (first, last) pages to lay out and write, 1-based and inclusive; last may be None
+    page_range = None
+    # Directory local images must be inside, and the one relative paths start from if image_base is None
+    image_root = IMAGE_ROOT
+    image_base = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Image loads started by prefetch_image, by source
+        self.image_loads = {}
+
+    def attach_font(self, family=FONT_FAMILY, styles=FONT_STYLES, font_path=FONT_FILE):
+        """Register a font from the shared registry instead of calling add_font.
+
+        Every style gets the same font object: they all come from one TTF, so
+        the document embeds a single subset of it.
+        """
+        font = get_font_metrics(family, font_path)
+        shared = None
+        for style in styles:
+            fontkey = family.lower() + style
+            if fontkey in self.fonts:
+                continue
+            if shared is None:
+                # The subset list is filled in as glyphs are used, so it must be per document
+                subset = self._new_subset()
+                shared = {
+                    'i': len(self.fonts) + 1, 'type': font['type'],
+                    'name': font['name'], 'desc': font['desc'],
+                    'up': font['up'], 'ut': font['ut'],
+                    'cw': font['cw'],
+                    'ttffile': font['ttffile'], 'fontkey': fontkey,
+                    'subset': subset, 'unifilename': None,
+                }
+                self.font_files[fontkey] = {'length1': font['originalsize'],
+                                            'type': "TTF", 'ttffile': font['ttffile']}
+                self.font_files[font['ttffile']] = {'type': "TTF"}
+            self.fonts[fontkey] = shared
+
+    def _new_subset(self):
+        return _GlyphSubset(range(0, 57) if hasattr(self, 'str_alias_nb_pages') else range(0, 32))
+
+    def layout_state(self):
+        """Position, page, font and colours: everything layout changes except
+        the page contents and the document-wide fonts, images and links."""
+        return {name: value for name, value in vars(self).items() if not isinstance(value, (dict, list))}
+
+    def restore_layout_state(self, state):
+        vars(self).update(state)
+        self.current_font = self.fonts.get(self.font_family + self.font_style, {})
+
+    def add_page(self, orientation=''):
+        if self.page_range is None:
+            return super().add_page(orientation)
+        first, last = self.page_range
+        if last is not None and self.page >= last:
+            raise _PageRangeDone()
+        super().add_page(orientation)
+        if self.page == first:
+            # Only glyphs used from here on go into the embedded subsets
+            for font in _unique_fonts(self.fonts).values():
+                if font['type'] == 'TTF':
+                    font['subset'] = self._new_subset()
+        if 1 < self.page <= first:
+            # Earlier pages are laid out for their length only
+            self.pages[self.page - 1] = ''
+
+    def _putpages(self):
+        # fpdf's, writing only the pages in page_range and reusing compressed
+        # page contents from page_streams when it is set (a preview keeps it
+        # across versions of a document)
+        first = self.page_range[0] if self.page_range else 1
+        kept = range(first, self.page + 1)
+        if hasattr(self, 'str_alias_nb_pages'):
+            alias = UTF8ToUTF16BE(self.str_alias_nb_pages, False)
+            count = UTF8ToUTF16BE(str(self.page), False)
+            for n in kept:
+                self.pages[n] = self.pages[n].replace(alias, count).replace(self.str_alias_nb_pages, str(self.page))
+        if self.def_orientation == 'P':
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+        streams = {}
+        for n in kept:
+            self._newobj()
+            self._out('<</Type /Page')
+            self._out('/Parent 1 0 R')
+            if n in self.orientation_changes:
+                self._out('/MediaBox [0 0 %.2f %.2f]' % (h_pt, w_pt))
+            self._out('/Resources 2 0 R')
+            if n in self.page_links:
+                annots = '/Annots ['
+                for pl in self.page_links[n]:
+                    rect = '%.2f %.2f %.2f %.2f' % (pl[0], pl[1], pl[0] + pl[2], pl[1] - pl[3])
+                    annots += '<</Type /Annot /Subtype /Link /Rect [' + rect + '] /Border [0 0 0] '
+                    if isinstance(pl[4], str):
+                        annots += '/A <</S /URI /URI ' + self._textstring(pl[4]) + '>>>>'
+                    elif self.links[pl[4]][0] >= first:
+                        link = self.links[pl[4]]
+                        h = w_pt if link[0] in self.orientation_changes else h_pt
+                        annots += '/Dest [%d 0 R /XYZ 0 %.2f null]>>' % (1 + 2 * (link[0] - first + 1),
+                                                                         h - link[1] * self.k)
+                    else:
+                        annots += '>>'  # Its target page was left out
+                self._out(annots + ']')
+            if self.pdf_version > '1.3':
+                self._out('/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>')
+            self._out('/Contents ' + str(self.n + 1) + ' 0 R>>')
+            self._out('endobj')
+            content = self.pages[n]
+            if not self.compress:
+                stream = content
+            elif self.page_streams is not None and content in self.page_streams:
+                stream = self.page_streams[content]
+            else:
+                stream = zlib.compress(content.encode('latin-1'))
+            streams[content] = stream
+            self._newobj()
+            self._out('<<' + ('/Filter /FlateDecode ' if self.compress else '') + '/Length ' + str(len(stream)) + '>>')
+            self._putstream(stream)
+            self._out('endobj')
+        if self.page_streams is not None and self.compress:
+            self.page_streams.clear()
+            self.page_streams.update(streams)
+        # Pages root
+        self.offsets[1] = len(self.buffer)
+        self._out('1 0 obj')
+        self._out('<</Type /Pages')
+        self._out('/Kids [' + ''.join(f'{3 + 2 * i} 0 R ' for i in range(len(kept))) + ']')
+        self._out('/Count ' + str(len(kept)))
+        self._out('/MediaBox [0 0 %.2f %.2f]' % (w_pt, h_pt))
+        self._out('>>')
+        self._out('endobj')
+
+    def _putresourcedict(self):
+        # List each shared font object once
+        fonts = self.fonts
+        self.fonts = _unique_fonts(fonts)
+        try:
+            super()._putresourcedict()
+        finally:
+            self.fonts = fonts
+
+    def _putfonts(self):
+        # fpdf writes the core fonts (Courier); TrueType fonts are written below
+        fonts = _unique_fonts(self.fonts)
+        all_fonts = self.fonts
+        self.fonts = {fontkey: font for fontkey, font in fonts.items() if font['type'] != 'TTF'}
+        try:
+            super()._putfonts()
+        finally:
+            self.fonts = all_fonts
+        for font in fonts.values():
+            if font['type'] == 'TTF':
+                self._put_ttf_font(font)
+
+    def _put_compressed_stream(self, data, dictionary=''):
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        if self.compress:
+            data = zlib.compress(data)
+            dictionary += '/Filter /FlateDecode '
+        self._out(f'<<{dictionary}/Length {len(data)}>>')
+        self._putstream(data)
+
+    def _put_ttf_font(self, font):
+        """Write an embedded TrueType font subset, as fpdf does, with every stream compressed."""
+        font['n'] = self.n + 1
+        fontname = 'MPDFAA+' + font['name']
+        codepoints = tuple(sorted(cid for cid in font['subset'] if cid))
+        fontstream, cidtogid = _font_subset(font['ttffile'], codepoints)
+
+        # Type0 font
+        self._newobj()
+        self._out('<</Type /Font /Subtype /Type0 /BaseFont /' + fontname + ' /Encoding /Identity-H')
+        self._out(f'/DescendantFonts [{self.n + 1} 0 R] /ToUnicode {self.n + 2} 0 R>>')
+        self._out('endobj')
+
+        # CIDFontType2 with widths for the code points actually used
+        self._newobj()
+        self._out('<</Type /Font /Subtype /CIDFontType2 /BaseFont /' + fontname)
+        self._out(f'/CIDSystemInfo {self.n + 2} 0 R /FontDescriptor {self.n + 3} 0 R')
+        if font['desc'].get('MissingWidth'):
+            self._out('/DW %d' % font['desc']['MissingWidth'])
+        self._out('/W [' + _cid_widths(font['cw'], codepoints) + ']')
+        self._out(f'/CIDToGIDMap {self.n + 4} 0 R>>')
+        self._out('endobj')
+
+        # ToUnicode: code points are used as CIDs, so the map is the identity
+        self._newobj()
+        self._put_compressed_stream(
+            "/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+            "/CIDSystemInfo\n<</Registry (Adobe)\n/Ordering (UCS)\n/Supplement 0\n>> def\n"
+            "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n"
+            "1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+            "1 beginbfrange\n<0000> <FFFF> <0000>\nendbfrange\n"
+            "endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend")
+        self._out('endobj')
+
+        # CIDSystemInfo
+        self._newobj()
+        self._out('<</Registry (Adobe) /Ordering (UCS) /Supplement 0>>')
+        self._out('endobj')
+
+        # Font descriptor
+        self._newobj()
+        descriptor = ['<</Type /FontDescriptor /FontName /' + fontname]
+        for key in ('Ascent', 'Descent', 'CapHeight', 'Flags', 'FontBBox', 'ItalicAngle', 'StemV', 'MissingWidth'):
+            value = font['desc'][key]
+            if key == 'Flags':
+                value = (value | 4) & ~32  # Symbolic, not non-symbolic
+            descriptor.append(f' /{key} {value}')
+        self._out(''.join(descriptor) + f' /FontFile2 {self.n + 2} 0 R>>')
+        self._out('endobj')
+
+        # CIDToGIDMap
+        self._newobj()
+        self._put_compressed_stream(cidtogid)
+        self._out('endobj')
+
+        # Font program
+        self._newobj()
+        self._put_compressed_stream(fontstream, f'/Length1 {len(fontstream)} ')
+        self._out('endobj')
+
+    def _enddoc(self):
+        if self.object_streams:
+            self.pdf_version = max(self.pdf_version, '1.5')
+        super()._enddoc()
+        if self.object_streams:
+            self._pack_objects()
+
+    def _pack_objects(self):
+        """Rewrite the finished document with its non-stream objects inside
+        compressed object streams and a cross-reference stream instead of the
+        xref table (PDF 1.5)."""
+        buffer = self.buffer
+        xref_start = buffer.rindex('\nxref\n') + 1
+        order = sorted(range(1, self.n + 1), key=self.offsets.__getitem__)
+        ends = [self.offsets[number] for number in order[1:]] + [xref_start]
+
+        out = [buffer[:self.offsets[order[0]]]]  # Header
+        length = len(out[0])
+        entries = {0: (0, 0, 65535)}
+        packed = []
+        for number, end in zip(order, ends):
+            text = buffer[self.offsets[number]:end]
+            body = text[text.index('\n') + 1:text.rindex('endobj')]
+            if body.rstrip().endswith('endstream'):
+                entries[number] = (1, length, 0)
+                out.append(text)
+                length += len(text)
+            else:
+                stream_number = self.n + 1 + len(packed) // OBJECT_STREAM_SIZE
+                entries[number] = (2, stream_number, len(packed) % OBJECT_STREAM_SIZE)
+                packed.append((number, body))
+
+        stream_number = self.n
+        for first in range(0, len(packed), OBJECT_STREAM_SIZE):
+            stream_number += 1
+            index, data, offset = [], [], 0
+            for number, body in packed[first:first + OBJECT_STREAM_SIZE]:
+                index.append(f'{number} {offset}')
+                data.append(body)
+                offset += len(body)
+            header = ' '.join(index) + '\n'
+            stream = zlib.compress((header + ''.join(data)).encode('latin-1')).decode('latin-1')
+            text = (f'{stream_number} 0 obj\n<</Type /ObjStm /N {len(index)} /First {len(header)} '
+                    f'/Filter /FlateDecode /Length {len(stream)}>>\nstream\n{stream}\nendstream\nendobj\n')
+            entries[stream_number] = (1, length, 0)
+            out.append(text)
+            length += len(text)
+
+        xref_number = stream_number + 1
+        entries[xref_number] = (1, length, 0)
+        rows = b''.join(struct.pack('>BIH', *entries[number]) for number in range(xref_number + 1))
+        stream = zlib.compress(rows).decode('latin-1')
+        out.append(f'{xref_number} 0 obj\n<</Type /XRef /Size {xref_number + 1} /W [1 4 2] '
+                   f'/Root {self.n} 0 R /Info {self.n - 1} 0 R /Filter /FlateDecode /Length {len(stream)}>>\n'
+                   f'stream\n{stream}\nendstream\nendobj\nstartxref\n{length}\n%%EOF\n')
+        self.buffer = ''.join(out)
+
     def header(self):
         # Add a header with better styling
         self.set_font("NotoSans", "B", 16)
@@ -12,12 +475,31 @@ class PDF(FPDF):
         self.ln(10)
 
     def footer(self):
+        if self.footer_states is not None:
+            self.footer_states[self.page] = (len(self.pages[self.page]), self.layout_state())
         # Add a footer with page numbers
         self.set_y(-15)
         self.set_font("NotoSans", "I", 8)
         self.set_text_color(128, 128, 128)  # Gray color
         self.cell(0, 10, f"Page {self.page_no()}", align="C")
 
+    def reset_style(self):
+        """Set the font, colours and line width every chapter starts with."""
+        self.set_font(FONT_FAMILY, "", BODY_FONT_SIZE)
+        self.set_text_color(0, 0, 0)
+        self.set_fill_color(255, 255, 255)
+        self.set_draw_color(0, 0, 0)
+        self.set_line_width(0.2)
+
+    def start_chapter(self):
+        """Start a chapter on a new page, from the reset style.
+
+        A chapter's pages then do not depend on anything laid out before
+        it, which is what lets parallel.py lay chapters out separately.
+        """
+        self.reset_style()
+        self.add_page(self.cur_orientation)
+
     def chapter_title(self, title, level=1):
         # Format titles based on heading level
         if level == 1:
@@ -41,13 +523,55 @@ class PDF(FPDF):
         self.multi_cell(0, 6, body)
         self.ln()
     
-    def add_code_block(self, code):
-        self.set_font("Courier", "", 9)
+    def add_code_block(self, lines, first=True, last=True):
+        """Lay out highlighted code lines (see highlight.highlight), or one
+        part of a long block, on a gray background.
+
+        Lines too long for the page wrap at the last column; the block breaks
+        between pages at any line.
+        """
+        self.set_font("Courier", "", CODE_FONT_SIZE)
         self.set_fill_color(240, 240, 240)  # Light gray background
-        self.multi_cell(0, 6, code, fill=True)
-        self.ln(5)
+        text_color = self.text_color
+        width = self.w - self.l_margin - self.r_margin
+        char_width = self.get_string_width(' ')
+        columns = max(1, int((width - 2 * self.c_margin) / char_width))
+        
+        # Where a new page's content starts, below the header
+        top = self.t_margin + 10
+        page = []
+        for runs in lines:
+            for row in _code_rows(runs, columns):
+                # A block starting at the foot of a page moves to the next one whole
+                if (self.y + (len(page) + 1) * CODE_LINE_HEIGHT > self.page_break_trigger
+                        and (page or self.y > top)):
+                    self._code_rows(page, width, char_width)
+                    page = []
+                    self.add_page(self.cur_orientation)
+                page.append(row)
+        self._code_rows(page, width, char_width)
+        
+        self.text_color = text_color
+        self.color_flag = self.fill_color != self.text_color
+        if last:
+            self.ln(5)
         self.set_font("NotoSans", "", 10)  # Reset font
 
+    def _code_rows(self, rows, width, char_width):
+        # One background rectangle, then each row's runs, switching colour only between runs
+        if not rows:
+            return
+        self.rect(self.l_margin, self.y, width, len(rows) * CODE_LINE_HEIGHT, 'F')
+        color = None
+        for row in rows:
+            self.set_x(self.l_margin)
+            for run_color, text in row:
+                if run_color != color:
+                    self.set_text_color(*run_color)
+                    color = run_color
+                self.cell(len(text) * char_width, CODE_LINE_HEIGHT, text)
+            self.ln(CODE_LINE_HEIGHT)
+
     def add_bullet_point(self, text, indent_level=0, number=None):
         """Add a bullet point or numbered item with proper indentation"""
         indent = 5 + (indent_level * 5)  # 5mm per indent level
@@ -74,6 +598,179 @@ class PDF(FPDF):
         self.set_x(x_pos + indent + bullet_offset)  # Add space after bullet/number
         self.multi_cell(self.w - (x_pos + indent + bullet_offset) - 10, 6, text)  # -10 for right margin
 
+    def add_quote(self, formatted_parts, level=1):
+        """Add a line of a block quote: gray text indented behind one bar per nesting level"""
+        indent = 5 * level + 2
+        # Never narrower than a few words, however deep the quote
+        width = max(self.w - 20 - self.l_margin - indent, MIN_QUOTE_WIDTH)
+        lines = wrap_formatted_text(self, formatted_parts, width) or [[]]
+        text_color = self.text_color
+        self.set_text_color(85, 85, 85)
+        self.set_draw_color(200, 200, 200)
+        self.set_line_width(0.8)
+        family = FONT_FAMILY.lower()
+        for line in lines:
+            # Break the page before drawing the bars, which cell() would not move along
+            if self.y + LINE_HEIGHT > self.page_break_trigger:
+                self.add_page(self.cur_orientation)
+                self.set_draw_color(200, 200, 200)
+                self.set_line_width(0.8)
+            for bar in range(level):
+                x = self.l_margin + 1 + 5 * bar
+                self.line(x, self.y, x, self.y + LINE_HEIGHT)
+            self.set_x(self.l_margin + indent)
+            for style, text, width in line:
+                if self.font_family != family or self.font_style != style or self.font_size_pt != BODY_FONT_SIZE:
+                    self.set_font(FONT_FAMILY, style, BODY_FONT_SIZE)
+                self.cell(width, LINE_HEIGHT, text, 0, 0)
+            self.ln(LINE_HEIGHT)
+        self.text_color = text_color
+        self.color_flag = self.fill_color != self.text_color
+
+    def add_link_text(self, formatted_parts, target):
+        """Add a line of underlined link text that opens target when clicked"""
+        text_color = self.text_color
+        self.set_text_color(*LINK_COLOR)
+        for line in wrap_formatted_text(self, formatted_parts, self.w - 20 - self.get_x()):
+            for style, text, width in line:
+                # The underline is drawn by cell(), so every run sets it again
+                self.set_font(FONT_FAMILY, style + "U", BODY_FONT_SIZE)
+                self.cell(width, LINE_HEIGHT, text, 0, 0, link=target)
+            self.ln()
+        self.text_color = text_color
+        self.color_flag = self.fill_color != self.text_color
+        self.set_font(FONT_FAMILY, "", BODY_FONT_SIZE)  # Reset font, without the underline
+
+    def _image_box(self):
+        # Largest image that fits between the margins and below the header
+        return self.w - self.l_margin - self.r_margin, self.page_break_trigger - self.t_margin - 10
+
+    def prefetch_image(self, source):
+        """Start loading an image in the background ahead of add_image."""
+        if source not in self.image_loads:
+            self.image_loads[source] = prefetch(source, *self._image_box(), root=self.image_root,
+                                               base=self.image_base)
+
+    def add_image(self, source, alt=''):
+        """Add an image on its own line, shrunk to fit the page, or its alt text if it cannot be loaded."""
+        try:
+            if source in self.image_loads:
+                key, width, height, info = self.image_loads[source].result()
+            else:
+                key, width, height, info = load_image(source, *self._image_box(), root=self.image_root,
+                                                      base=self.image_base)
+        except ImageError as e:
+            logger.warning(f"Image {source[:80]!r} not rendered: {e}")
+            self.set_font("NotoSans", "I", 10)
+            self.set_text_color(128, 128, 128)
+            self.multi_cell(0, 6, f"[{alt or 'image'}]")
+            return
+
+        if self.y + height > self.page_break_trigger and not self.in_footer and self.accept_page_break():
+            self.add_page(self.cur_orientation)
+        # Pages before page_range are discarded, so the image is not embedded for them
+        if self.page_range is None or self.page >= self.page_range[0]:
+            if key not in self.images:
+                # A copy: fpdf records object numbers in it, and info is shared between documents
+                self.images[key] = dict(info, i=len(self.images) + 1)
+            self._out('q %.2f 0 0 %.2f %.2f %.2f cm /I%d Do Q' % (
+                width * self.k, height * self.k, self.l_margin * self.k,
+                (self.h - (self.y + height)) * self.k, self.images[key]['i']))
+        self.y += height
+        self.ln(4)
+
+    def _putimages(self):
+        # fpdf's deletes each image's data once written; keep it, it is
+        # shared with the image cache (and a preview writes its PDF again)
+        for info in sorted(self.images.values(), key=lambda info: info['i']):
+            self._putimage(info)
+
+    def add_table(self, header, rows, align, first=True, last=True):
+        """Lay out a pipe table, or one part of a long one, row by row.
+
+        Column widths are measured on the first part and kept for the rest
+        (table_widths is part of the layout state); the header row is
+        repeated at the top of every page the table continues on.
+        """
+        if first:
+            self.ln(2)
+            self.table_widths = table_column_widths(self, header, rows,
+                                                    self.w - self.l_margin - self.r_margin)
+        widths = self.table_widths
+        header_lines = wrap_table_row(self, header, widths, header=True)
+        
+        colors = self.draw_color, self.fill_color, self.text_color, self.line_width
+        self.set_draw_color(200, 200, 200)
+        self.set_fill_color(240, 240, 240)
+        self.set_text_color(0, 0, 0)
+        self.set_line_width(0.2)
+        if first:
+            self._table_row(header_lines, widths, align, None, fill=True)
+        for row in rows:
+            self._table_row(wrap_table_row(self, row, widths), widths, align, header_lines)
+        
+        # Restore colours the way add_page does
+        draw_color, fill_color, self.text_color, line_width = colors
+        if self.draw_color != draw_color:
+            self.draw_color = draw_color
+            self._out(draw_color)
+        if self.fill_color != fill_color:
+            self.fill_color = fill_color
+            self._out(fill_color)
+        self.color_flag = self.fill_color != self.text_color
+        self.set_line_width(line_width)
+        if last:
+            self.ln(4)
+
+    def _table_row(self, cells, widths, align, header_lines, fill=False):
+        """Draw one row of wrapped cells (see wrap_table_row).
+
+        A row that does not fit in the space left moves to the next page; one
+        taller than a whole page is split between pages. header_lines, if
+        given, is drawn again at the top of each new page.
+        """
+        lines = max(1, max(map(len, cells)))
+        header_height = 0
+        if header_lines is not None:
+            header_height = max(1, max(map(len, header_lines))) * TABLE_LINE_HEIGHT + 2 * TABLE_PADDING
+        # Lines of a row that fit on a new page, below the page header and table header
+        page_lines = int((self.page_break_trigger - self.t_margin - 10 - header_height - 2 * TABLE_PADDING)
+                         / TABLE_LINE_HEIGHT)
+        done = 0
+        new_page = False
+        while done < lines:
+            count = min(lines - done, int((self.page_break_trigger - self.y - 2 * TABLE_PADDING) / TABLE_LINE_HEIGHT))
+            if count < lines - done and done == 0 and lines <= page_lines and not new_page:
+                count = 0  # The whole row fits on the next page
+            if count < 1 and new_page:
+                count = 1  # Page too short for even one line: overflow rather than loop
+            if count > 0:
+                self._table_cells(cells, widths, align, done, count, fill)
+                done += count
+            if done < lines:
+                self.add_page(self.cur_orientation)
+                new_page = True
+                if header_lines is not None:
+                    self._table_row(header_lines, widths, align, None, fill=True)
+
+    def _table_cells(self, cells, widths, align, start, count, fill):
+        # Lines start to start + count of every cell, with cell borders
+        x, y = self.l_margin, self.y
+        height = count * TABLE_LINE_HEIGHT + 2 * TABLE_PADDING
+        family = FONT_FAMILY.lower()
+        for lines, width, alignment in zip(cells, widths, align):
+            self.rect(x, y, width, height, 'DF' if fill else 'D')
+            for number, line in enumerate(lines[start:start + count]):
+                free = width - 2 * (TABLE_PADDING + self.c_margin) - sum(run[2] for run in line)
+                offset = free if alignment == 'right' else free / 2 if alignment == 'center' else 0
+                self.set_xy(x + TABLE_PADDING + offset, y + TABLE_PADDING + number * TABLE_LINE_HEIGHT)
+                for style, text, run_width in line:
+                    if self.font_family != family or self.font_style != style or self.font_size_pt != TABLE_FONT_SIZE:
+                        self.set_font(FONT_FAMILY, style, TABLE_FONT_SIZE)
+                    self.cell(run_width, TABLE_LINE_HEIGHT, text)
+            x += width
+        self.set_xy(self.l_margin, y + height)
+
     def add_horizontal_line(self):
         """Add a horizontal line across the page"""
         self.ln(2)  # Add some space above the line
@@ -82,83 +779,240 @@ class PDF(FPDF):
         self.line(10, self.get_y(), self.w - 10, self.get_y())
         self.ln(5)  # Add some space below the line
 
-# Helper function to process text formatting
-def process_text_formatting(text):
-    # We'll store formatting instructions instead of inserting HTML tags
+@lru_cache(maxsize=32)
+def _font_subset(ttffile, codepoints):
+    """The font program for a subset and its CIDToGIDMap; documents built
+    from the same characters (and every preview of one) share the result."""
+    ttf = TTFontFile()
+    fontstream = ttf.makeSubset(ttffile, list(codepoints))
+    cidtogid = bytearray(256 * 256 * 2)
+    for code, glyph in ttf.codeToGlyph.items():
+        if code < 256 * 256:
+            cidtogid[code * 2:code * 2 + 2] = glyph.to_bytes(2, 'big')
+    return fontstream, bytes(cidtogid)
+
+def _cid_widths(cw, codepoints):
+    """/W array entries for the given sorted code points, consecutive ones grouped."""
+    groups = []
+    for cid in codepoints:
+        width = cw[cid] if cid < len(cw) else 0
+        if not width:
+            continue  # Left to /DW
+        if width == 65535:
+            width = 0
+        if groups and groups[-1][0] + len(groups[-1][1]) == cid:
+            groups[-1][1].append(str(width))
+        else:
+            groups.append((cid, [str(width)]))
+    return ' '.join(f"{start} [{' '.join(widths)}]" for start, widths in groups)
+
+# Inline emphasis markers, longest first so ***x*** wins over **x** and *x*.
+# Unmatched markers are left in the surrounding plain text.
+INLINE_FORMAT_RE = re.compile(r'\*\*\*(.+?)\*\*\*|\*\*(.*?)\*\*|\*([^*]+)\*|_([^_]*)_')
+INLINE_STYLES = ('BI', 'B', 'I', 'I')  # Style for each alternative's group above
+# The cache counts entries, not bytes, so longer lines are tokenized every time
+INLINE_CACHE_MAX_CHARS = 1024
+
+@lru_cache(maxsize=4096)
+def _tokenize_inline(text):
     result = []
-    i = 0
-    while i < len(text):
-        # Check for bold text
-        if text[i:i+2] == '**' and i+2 < len(text):
-            # Find closing **
-            end = text.find('**', i+2)
-            if end != -1:
-                result.append(('B', text[i+2:end]))
-                i = end + 2
-                continue
-        
-        # Check for italic text
-        elif (text[i] == '_' or text[i] == '*') and i+1 < len(text):
-            marker = text[i]
-            # Find closing marker
-            end = text.find(marker, i+1)
-            if end != -1 and text[i:i+2] != '**':  # Avoid confusing with bold
-                result.append(('I', text[i+1:end]))
-                i = end + 1
-                continue
-        
-        # Regular text
-        if i < len(text):
-            # Collect regular text until next formatting marker
-            start = i
-            while i < len(text):
-                if ((text[i:i+2] == '**') or 
-                    (text[i] == '_' and i+1 < len(text)) or 
-                    (text[i] == '*' and i+1 < len(text) and text[i:i+2] != '**')):
-                    break
-                i += 1
-            if start < i:
-                result.append(('', text[start:i]))
-            continue
-        
-        i += 1
+    pos = 0
+    for match in INLINE_FORMAT_RE.finditer(text):
+        if match.start() > pos:
+            result.append(('', text[pos:match.start()]))
+        group = match.lastindex
+        result.append((INLINE_STYLES[group - 1], match.group(group)))
+        pos = match.end()
+    if pos < len(text):
+        result.append(('', text[pos:]))
     
     # Encode each part to handle unsupported characters
-    return [(style, text.encode('utf-8', 'replace').decode('utf-8')) for style, text in result]
+    return tuple((style, part.encode('utf-8', 'replace').decode('utf-8')) for style, part in result)
 
-# Modified version of chapter_body to handle formatted text
-def render_formatted_text(pdf, formatted_parts):
-    x_position = pdf.get_x()
-    y_position = pdf.get_y()
+# Helper function to process text formatting
+def process_text_formatting(text):
+    """Split text into (style, text) runs in a single pass; repeated short lines are cached."""
+    tokenize = _tokenize_inline if len(text) <= INLINE_CACHE_MAX_CHARS else _tokenize_inline.__wrapped__
+    stats = getattr(_active, 'stats', None)
+    if stats is None:
+        return list(tokenize(text))
+    start = time.perf_counter()
+    parts = list(tokenize(text))
+    stats.inline_seconds += time.perf_counter() - start
+    return parts
+
+# Body text set by render_formatted_text
+BODY_FONT_SIZE = 10
+LINE_HEIGHT = 6
+LINK_COLOR = (0, 102, 204)  # Blue
+MIN_QUOTE_WIDTH = 40  # mm
+
+# Where the next line starts after a break at a space
+NON_SPACE_RE = re.compile(r'[^ ]')
+
+def _glyph_widths(pdf, style):
+    """Return the (character widths, missing width) table of a body font style."""
+    font = pdf.fonts[FONT_FAMILY.lower() + style]
+    return font['cw'], font['desc'].get('MissingWidth') or 500
+
+def _char_widths(widths, text):
+    """Width of each character of text in font units (1/1000 of the font size), like get_string_width."""
+    cw, missing = widths
+    if not text or ord(max(text)) < len(cw):
+        return map(cw.__getitem__, map(ord, text))
+    return (cw[c] if c < len(cw) else missing for c in map(ord, text))
+
+def wrap_formatted_text(pdf, formatted_parts, max_width, font_size=BODY_FONT_SIZE):
+    """Greedily break (style, text) runs into lines no wider than max_width.
+
+    Lines break at spaces, which are dropped at the break; a word wider than
+    a whole line is broken between characters. Each line is a list of
+    [style, text, width] runs, with neighbouring runs of the same style
+    merged so it needs the fewest font switches.
+    """
+    scale = font_size / pdf.k / 1000
+    runs = [(style, text) for style, text in formatted_parts if text]
+    if not runs:
+        return []
     
-    for style, text in formatted_parts:
-        if not text:  # Skip empty text
-            continue
-            
-        # Set the appropriate font style
-        if style == 'B':
-            pdf.set_font("NotoSans", "B", 10)
-        elif style == 'I':
-            pdf.set_font("NotoSans", "I", 10)
-        elif style == 'BI':  # Handle bold and italic
-            pdf.set_font("NotoSans", "BI", 10)
+    # Running width before every character, so any slice is measured by a subtraction
+    tables = {}
+    offsets = []    # Start of each run in text
+    widths = []
+    text = ''
+    for style, run_text in runs:
+        if style not in tables:
+            tables[style] = _glyph_widths(pdf, style)
+        offsets.append(len(text))
+        widths.append(_char_widths(tables[style], run_text))
+        text += run_text
+    advance = [0]
+    advance.extend(accumulate(chain.from_iterable(widths)))
+    limit = max_width / scale
+    
+    lines = []
+    start = 0
+    while start < len(text):
+        # The furthest end such that text[start:end] still fits
+        end = bisect_right(advance, advance[start] + limit) - 1
+        if end >= len(text):
+            end = next_start = len(text)
         else:
-            pdf.set_font("NotoSans", "", 10)
-        
-        width = pdf.get_string_width(text)
-        
-        # Check if we need to wrap to next line
-        if x_position + width > pdf.w - 20:
-            pdf.ln()
-            x_position = pdf.get_x()
-            y_position = pdf.get_y()
+            space = text.rfind(' ', start, end + 1)
+            line_end = len(text[start:space].rstrip(' ')) + start if space > start else start
+            if line_end > start:
+                next_start = NON_SPACE_RE.search(text, space)
+                next_start = next_start.start() if next_start else len(text)
+                end = line_end
+            else:
+                # No space to break at: split the word, keeping at least one character per line
+                end = next_start = max(end, start + 1)
         
-        # Render the text segment with the appropriate style
-        pdf.set_xy(x_position, y_position)
-        pdf.cell(width, 6, text, 0, 0)
-        x_position += width
+        line = []
+        run = bisect_right(offsets, start) - 1
+        position = start
+        while position < end:
+            run_end = min(end, offsets[run + 1] if run + 1 < len(offsets) else len(text))
+            style = runs[run][0]
+            width = (advance[run_end] - advance[position]) * scale
+            if line and line[-1][0] == style:
+                line[-1][1] += text[position:run_end]
+                line[-1][2] += width
+            else:
+                line.append([style, text[position:run_end], width])
+            position = run_end
+            run += 1
+        lines.append(line)
+        start = next_start
+    return lines
+
+# Modified version of chapter_body to handle formatted text
+def render_formatted_text(pdf, formatted_parts):
+    # Same right edge as before: 20mm in from the edge of the page
+    lines = wrap_formatted_text(pdf, formatted_parts, pdf.w - 20 - pdf.get_x())
+    family = FONT_FAMILY.lower()
     
-    pdf.ln()  # Move to next line after processing all parts
+    for line in lines:
+        for style, text, width in line:
+            # set_font is only needed where the style changes
+            if pdf.font_family != family or pdf.font_style != style or pdf.font_size_pt != BODY_FONT_SIZE:
+                pdf.set_font(FONT_FAMILY, style, BODY_FONT_SIZE)
+            pdf.cell(width, LINE_HEIGHT, text, 0, 0)
+        pdf.ln()
+    
+    if not lines:
+        pdf.ln()
+
+# Fenced code blocks, in Courier
+CODE_FONT_SIZE = 9
+CODE_LINE_HEIGHT = 6
+CODE_TAB_SIZE = 4
+
+def _code_rows(runs, columns):
+    """Split a highlighted line into rows of at most columns characters."""
+    if sum(len(text) for _, text in runs) <= columns:
+        return [runs]
+    rows = [[]]
+    free = columns
+    for color, text in runs:
+        while text:
+            if not free:
+                rows.append([])
+                free = columns
+            rows[-1].append((color, text[:free]))
+            text = text[free:]
+            free -= len(rows[-1][-1][1])
+    return rows
+
+# Pipe tables
+TABLE_FONT_SIZE = 9
+TABLE_LINE_HEIGHT = 5
+TABLE_PADDING = 1  # Around cell text, on top of fpdf's cell margin
+
+def _table_parts(pdf, text, header=False):
+    parts = process_text_formatting(text)
+    if header:
+        # Header cells are bold, keeping any italics
+        parts = [('B' + style.replace('B', ''), part) for style, part in parts]
+    return parts
+
+def table_column_widths(pdf, header, rows, total):
+    """Column widths for a table no wider than total.
+
+    Every cell is measured once, unwrapped. When the natural widths do not
+    fit, columns narrower than an equal share keep theirs and the others
+    share the rest in proportion to their natural width.
+    """
+    scale = TABLE_FONT_SIZE / pdf.k / 1000
+    extra = 2 * (TABLE_PADDING + pdf.c_margin)
+    natural = [0] * len(header)
+    for row, is_header in chain(((header, True),), ((row, False) for row in rows)):
+        for column, cell in enumerate(row):
+            width = sum(sum(_char_widths(_glyph_widths(pdf, style), text))
+                        for style, text in _table_parts(pdf, cell, is_header))
+            if width > natural[column]:
+                natural[column] = width
+    natural = [width * scale + extra for width in natural]
+    if sum(natural) <= total:
+        return tuple(natural)
+    
+    fixed = {}
+    while len(fixed) < len(natural):
+        share = (total - sum(fixed.values())) / (len(natural) - len(fixed))
+        narrow = {column: width for column, width in enumerate(natural)
+                  if column not in fixed and width <= share}
+        if not narrow:
+            break
+        fixed.update(narrow)
+    rest = total - sum(fixed.values())
+    flexible = sum(width for column, width in enumerate(natural) if column not in fixed) or 1
+    return tuple(fixed.get(column, width * rest / flexible) for column, width in enumerate(natural))
+
+def wrap_table_row(pdf, cells, widths, header=False):
+    """The wrapped lines of each cell of a row, at its column's width."""
+    extra = 2 * (TABLE_PADDING + pdf.c_margin)
+    return [wrap_formatted_text(pdf, _table_parts(pdf, cell, header), width - extra, TABLE_FONT_SIZE)
+            for cell, width in zip(cells, widths)]
 
 # Process text with proper formatting for bullet points
 def format_bullet_text(text):
@@ -169,72 +1023,511 @@ def format_bullet_text(text):
         formatted_text += part
     return formatted_text
 
-# Parse markdown content
-def parse_markdown(content):
-    sections = []
-    lines = content.split("\n")
+# Render a single content block, one function per block type
+def render_text_block(pdf, block):
+    # Only process non-empty lines
+    if block.text.strip():
+        # Get the parts with style information
+        formatted_parts = process_text_formatting(block.text)
+        # Render the text with proper formatting
+        render_formatted_text(pdf, formatted_parts)
+
+def render_bullet_block(pdf, block):
+    # Format the bullet text without HTML tags
+    pdf.add_bullet_point(format_bullet_text(block.text), block.level)
+
+def render_numbered_block(pdf, block):
+    # Format the numbered text without HTML tags
+    pdf.add_bullet_point(format_bullet_text(block.text), block.level, block.number)
+
+def render_link_block(pdf, block):
+    # A link without text shows its target
+    pdf.add_link_text(process_text_formatting(block.text or block.target), block.target)
+
+def render_image_block(pdf, block):
+    pdf.add_image(block.target, block.text)
+
+def render_quote_block(pdf, block):
+    pdf.add_quote(process_text_formatting(block.text), block.level)
+
+def render_hr_block(pdf, block):
+    pdf.add_horizontal_line()
+
+# HEADING and CODE lines start sections in parse_markdown and never reach a renderer
+BLOCK_RENDERERS = {
+    BlockType.TEXT: render_text_block,
+    BlockType.BULLET: render_bullet_block,
+    BlockType.NUMBERED: render_numbered_block,
+    BlockType.LINK: render_link_block,
+    BlockType.IMAGE: render_image_block,
+    BlockType.QUOTE: render_quote_block,
+    BlockType.HR: render_hr_block,
+}
+
+def render_block(pdf, block):
+    BLOCK_RENDERERS[block.type](pdf, block)
+
+# Split markdown source into lines without materializing the whole list
+def iter_lines(source):
+    """Yield lines from a string or any iterable of str/bytes lines, like str.split("\\n")."""
+    if isinstance(source, str):
+        start = 0
+        while True:
+            end = source.find("\n", start)
+            if end == -1:
+                yield source[start:]
+                return
+            yield source[start:end]
+            start = end + 1
     
+    line = ""
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        yield line[:-1] if line.endswith("\n") else line
+    # split() yields a final empty line after a trailing newline (or for empty input)
+    if not line or line.endswith("\n"):
+        yield ""
+
+# A line holding just an image: ![alt](source) or ![alt](source "title")
+IMAGE_LINE_RE = re.compile(r'^\s*!\[([^\]]*)\]\(\s*(\S+?)(?:\s+"[^"]*")?\s*\)\s*$')
+
+# GFM pipe tables: a header row, a delimiter row like |---|:--:|, then rows
+TABLE_DELIMITER_RE = re.compile(r'^\s*\|?\s*:?-+:?\s*(?:\|\s*:?-+:?\s*)*\|?\s*$')
+TABLE_CELL_RE = re.compile(r'(?<!\\)\|')
+# Rows per table section; a longer table is yielded in parts of this size
+TABLE_CHUNK_ROWS = 256
+
+def split_table_row(line, columns=None):
+    """Cells of a pipe table row, padded or cut to columns if given."""
+    line = line.strip()
+    if line.startswith('|'):
+        line = line[1:]
+    if line.endswith('|') and not line.endswith('\\|'):
+        line = line[:-1]
+    cells = [cell.strip().replace('\\|', '|') for cell in TABLE_CELL_RE.split(line)]
+    if columns is not None:
+        cells = cells[:columns] + [''] * (columns - len(cells))
+    return cells
+
+def _table_alignments(delimiter):
+    alignments = []
+    for cell in split_table_row(delimiter):
+        if cell.startswith(':') and cell.endswith(':'):
+            alignments.append('center')
+        elif cell.endswith(':'):
+            alignments.append('right')
+        else:
+            alignments.append('left')
+    return alignments
+
+def _table_section(title, level, header, align, first):
+    return {"title": title, "level": level, "content": [], "type": "table",
+            "header": header, "align": align, "first": first, "last": False}
+
+# Lines per code section; a longer code block is yielded in parts of this size
+CODE_CHUNK_LINES = 256
+
+def _code_section(title, level, language, first):
+    return {"title": title, "level": level, "content": [], "type": "code",
+            "language": language, "first": first, "last": False}
+
+# Line patterns, each matched against a line from its first non-space character
+HEADING_RE = re.compile(r'(#{1,6})\s+(.+)')
+BULLET_RE = re.compile(r'[-*+]\s+(.+)')
+NUMBERED_RE = re.compile(r'(\d+)\.\s+(.+)')
+# A line holding just a link: [text](target) or [text](target "title")
+LINK_LINE_RE = re.compile(r'^\s*\[([^\]]*)\]\(\s*(\S+?)(?:\s+"[^"]*")?\s*\)\s*$')
+
+def _heading_line(line, content):
+    # Only a # in the first column starts a heading
+    match = HEADING_RE.fullmatch(line) if len(content) == len(line) else None
+    return Block(BlockType.HEADING, match.group(2), len(match.group(1))) if match else None
+
+def _bullet_line(line, content):
+    match = BULLET_RE.fullmatch(content)
+    return Block(BlockType.BULLET, match.group(1), len(line) - len(content)) if match else None
+
+def _rule_or_bullet_line(line, content):
+    # ---, *** or ___ alone on a line
+    stripped = content.rstrip()
+    if len(stripped) >= 3 and not stripped.strip(stripped[0]):
+        return Block(BlockType.HR)
+    return _bullet_line(line, content)
+
+def _fence_line(line, content):
+    # The info string after the fence names the language
+    return Block(BlockType.CODE, content[3:].strip()) if content.startswith("```") else None
+
+def _image_line(line, content):
+    match = IMAGE_LINE_RE.match(content)
+    return Block(BlockType.IMAGE, match.group(1), target=match.group(2)) if match else None
+
+def _link_line(line, content):
+    match = LINK_LINE_RE.match(content)
+    return Block(BlockType.LINK, match.group(1), target=match.group(2)) if match else None
+
+# Deeper quotes are drawn at this depth, which still leaves most of the line for text
+MAX_QUOTE_DEPTH = 8
+
+def _quote_line(line, content):
+    # One level per >, each followed by at most one space: "> > text" is nested twice
+    level = 0
+    start = 0
+    while content.startswith(">", start):
+        level += 1
+        start += 2 if content.startswith("> ", start) else 1
+    return Block(BlockType.QUOTE, content[start:], min(level, MAX_QUOTE_DEPTH))
+
+# classify_line's handler for each first non-space character; a handler
+# returns None when the line is plain text after all
+LINE_CLASSIFIERS = {
+    "#": _heading_line,
+    "-": _rule_or_bullet_line,
+    "*": _rule_or_bullet_line,
+    "_": _rule_or_bullet_line,
+    "+": _bullet_line,
+    "`": _fence_line,
+    "!": _image_line,
+    "[": _link_line,
+    ">": _quote_line,
+}
+
+def classify_line(line):
+    """The Block for one line outside code blocks and tables.
+
+    Besides content blocks this returns HR, HEADING (text and level of the
+    heading) and CODE blocks (an opening fence, text its info string),
+    which iter_sections turns into sections of their own.
+    """
+    content = line.lstrip()
+    if content:
+        first = content[0]
+        classify = LINE_CLASSIFIERS.get(first)
+        if classify is not None:
+            block = classify(line, content)
+            if block is not None:
+                return block
+        elif first.isdecimal():
+            match = NUMBERED_RE.fullmatch(content)
+            if match:
+                return Block(BlockType.NUMBERED, match.group(2), len(line) - len(content), match.group(1))
+    return Block(BlockType.TEXT, line)
+
+# Parse markdown content, yielding each section as soon as it is complete
+def iter_sections(source):
     current_section = {"title": "", "level": 0, "content": [], "type": "text"}
-    in_code_block = False
-    code_content = []
+    code = None  # The code section being filled, while inside a fenced code block
+    table = None  # The table section being filled, while inside a table
     
-    for line in lines:
-        # Check for horizontal rule
-        if re.match(r'^-{3,}$|^\*{3,}$|^_{3,}$', line.strip()):
+    for line in iter_lines(source):
+        if code is not None:
+            # Inside a code block only the closing fence means anything
+            if "```" in line and line.strip() == "```":
+                code["last"] = True
+                yield code
+                code = None
+            else:
+                # A full part is only yielded once another line shows it is not the last
+                if len(code["content"]) == CODE_CHUNK_LINES:
+                    yield code
+                    code = _code_section("", 0, code["language"], False)
+                code["content"].append(line)
+            continue
+        
+        if table is not None:
+            if '|' in line:
+                # A full part is only yielded once another row shows it is not the last
+                if len(table["content"]) == TABLE_CHUNK_ROWS:
+                    yield table
+                    table = _table_section("", 0, table["header"], table["align"], False)
+                table["content"].append(split_table_row(line, len(table["header"])))
+                continue
+            table["last"] = True
+            yield table
+            table = None
+        
+        block = classify_line(line)
+        kind = block.type
+        if kind is BlockType.HR:
             # Add current section if it has content
             if current_section["content"]:
-                sections.append(current_section)
+                yield current_section
                 current_section = {"title": "", "level": 0, "content": [], "type": "text"}
             
             # Add a horizontal rule section
-            sections.append({"title": "", "level": 0, "content": [], "type": "hr"})
-            continue
-        
-        # Check for headings
-        heading_match = re.match(r'^(#{1,6})\s+(.+)$', line)
-        
-        if in_code_block:
-            if line.strip() == "```":
-                current_section = {"title": "", "level": 0, "content": code_content, "type": "code"}
-                sections.append(current_section)
-                code_content = []
-                in_code_block = False
-                current_section = {"title": "", "level": 0, "content": [], "type": "text"}
+            yield {"title": "", "level": 0, "content": [], "type": "hr"}
+        elif kind is BlockType.CODE:
+            if current_section["content"]:
+                yield current_section
+                code = _code_section("", 0, block.text, True)
             else:
-                code_content.append(line)
-        elif line.strip() == "```" or line.strip().startswith("```"):
-            in_code_block = True
-        elif heading_match:
+                # A heading right above the code block becomes its title
+                code = _code_section(current_section["title"], current_section["level"], block.text, True)
+            current_section = {"title": "", "level": 0, "content": [], "type": "text"}
+        elif kind is BlockType.HEADING:
             # If we have content in the current section, add it to sections
             if current_section["content"]:
-                sections.append(current_section)
+                yield current_section
             
             # Create a new section with this heading
-            level = len(heading_match.group(1))
-            title = heading_match.group(2)
-            current_section = {"title": title, "level": level, "content": [], "type": "text"}
-        else:
-            # Check if the line is a bullet point
-            bullet_match = re.match(r'^(\s*[-*+])\s+(.+)$', line)
-            # Check if the line is a numbered list item
-            numbered_match = re.match(r'^(\s*)(\d+)\.\s+(.+)$', line)
-            
-            if bullet_match:
-                # Mark bullet points with a special prefix that we'll process later
-                indent_level = len(bullet_match.group(1)) - 1  # -1 accounts for the bullet character
-                bullet_text = bullet_match.group(2)
-                current_section["content"].append(f"__BULLET__{indent_level}__" + bullet_text)
-            elif numbered_match:
-                # Mark numbered items with a special prefix
-                indent_level = len(numbered_match.group(1))
-                number = numbered_match.group(2)
-                numbered_text = numbered_match.group(3)
-                current_section["content"].append(f"__NUMBERED__{indent_level}__{number}__" + numbered_text)
+            current_section = {"title": block.text, "level": block.level, "content": [], "type": "text"}
+        elif ('|' in line and current_section["content"] and current_section["content"][-1].type is BlockType.TEXT
+              and '|' in current_section["content"][-1].text and TABLE_DELIMITER_RE.match(line)
+              and len(split_table_row(line)) == len(split_table_row(current_section["content"][-1].text))):
+            # The previous line was the header row of a table
+            header = split_table_row(current_section["content"].pop().text)
+            if current_section["content"]:
+                yield current_section
+                table = _table_section("", 0, header, _table_alignments(line), True)
             else:
-                current_section["content"].append(line)
+                # A heading right above the table becomes its title
+                table = _table_section(current_section["title"], current_section["level"],
+                                       header, _table_alignments(line), True)
+            current_section = {"title": "", "level": 0, "content": [], "type": "text"}
+        else:
+            current_section["content"].append(block)
     
     # Add the last section
+    if code is not None:
+        # An unclosed fence runs to the end of the document
+        code["last"] = True
+        yield code
+    if table is not None:
+        table["last"] = True
+        yield table
     if current_section["content"]:
-        sections.append(current_section)
+        yield current_section
+
+def parse_markdown(content):
+    return list(iter_sections(content))
+
+def _is_control_char(codepoint):
+    return unicodedata.category(chr(codepoint))[0] == 'C'
+
+class _ControlCharTable(dict):
+    """str.translate table deleting characters of category C (control, format,
+    surrogate, private use, unassigned), filled in per code point on first use.
+
+    Once max_entries code points are known, others are looked up every time
+    instead of stored, so an input of every character cannot grow it further.
+    """
+    max_entries = 65536
+
+    def __missing__(self, codepoint):
+        value = None if _is_control_char(codepoint) else codepoint
+        if len(self) < self.max_entries:
+            self[codepoint] = value
+        return value
+
+_CONTROL_CHARS = _ControlCharTable()
+
+def clean_text(text):
+    """Remove invisible or unsupported characters from the text."""
+    # Printable text has no category C characters, which covers almost every line
+    if text.isprintable():
+        return text
+    return text.translate(_CONTROL_CHARS)
+
+def _count_input(content, stats):
+    """Record input size in stats, passing an iterable of lines through unchanged."""
+    if isinstance(content, str):
+        stats.bytes_in = len(content) if content.isascii() else len(content.encode('utf-8'))
+        stats.lines = content.count("\n") + (not content.endswith("\n"))
+        return content
+    return _counted_lines(content, stats)
+
+def _counted_lines(lines, stats):
+    for line in lines:
+        stats.lines += 1
+        stats.bytes_in += len(line) if isinstance(line, bytes) or line.isascii() else len(line.encode('utf-8'))
+        yield line
+
+def _timed_sections(sections, stats):
+    # Parsing is lazy, so its time is the time spent waiting for the next section
+    while True:
+        start = time.perf_counter()
+        section = next(sections, None)
+        stats.parse_seconds += time.perf_counter() - start
+        if section is None:
+            return
+        yield section
+
+def _timed_clean(text, stats):
+    if stats is None:
+        return clean_text(text)
+    start = time.perf_counter()
+    text = clean_text(text)
+    stats.clean_seconds += time.perf_counter() - start
+    return text
+
+def _code_line(line, stats):
+    # Cleaned line by line: clean_text drops tabs and newlines
+    line = _timed_clean(line.expandtabs(CODE_TAB_SIZE), stats)
+    if not line.isascii():
+        # Courier only has Latin-1 glyphs
+        line = line.encode('latin-1', 'replace').decode('latin-1')
+    return line
+
+def new_pdf():
+    """A PDF with the body font attached and its first page started."""
+    # Create PDF with better styling
+    pdf = PDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    
+    # Add a Unicode-compatible font (parsed once per process, see warm_up_fonts)
+    try:
+        pdf.attach_font()
+    except FileNotFoundError as e:
+        logger.error(str(e))
+        raise
     
-    return sections
\ No newline at end of file
+    pdf.add_page()
+    return pdf
+
+def render_section(pdf, section, stats=None):
+    """Lay out one parsed section; the section itself is left unchanged."""
+    if section["title"]:
+        title = _timed_clean(section["title"], stats)
+        formatted_title = process_text_formatting(title)
+        title = ''.join(part[1] for part in formatted_title)
+        pdf.chapter_title(title, section["level"])
+    if section["type"] == "code":
+        lines = [_code_line(line, stats) for line in section["content"]]
+        if section["first"]:
+            pdf.code_state = None
+        lines, pdf.code_state = highlight(lines, section["language"], pdf.code_state)
+        pdf.add_code_block(lines, section["first"], section["last"])
+    elif section["type"] == "hr":
+        pdf.add_horizontal_line()
+    elif section["type"] == "table":
+        header = [_timed_clean(cell, stats) for cell in section["header"]]
+        rows = [[_timed_clean(cell, stats) for cell in row] for row in section["content"]]
+        pdf.add_table(header, rows, section["align"], section["first"], section["last"])
+    else:
+        for block in section["content"]:
+            try:
+                # Clean the line of text
+                text = _timed_clean(block.text, stats)
+                if text is not block.text:
+                    block = replace(block, text=text)
+                render_block(pdf, block)
+            except Exception as e:
+                logger.error(f"Error processing line '{block.text}': {str(e)}")
+                raise
+
+def starts_chapter(section, chapter_level):
+    """Whether a section's heading starts a new chapter (see PDF.start_chapter)."""
+    return 1 <= section["level"] <= chapter_level
+
+def _prefetch_images(pdf, sections, lookahead=IMAGE_LOOKAHEAD):
+    """Yield the sections, starting the image loads of the next few while
+    the current one is laid out."""
+    pending = deque()
+    for section in sections:
+        for block in section["content"] if section["type"] == "text" else ():
+            if block.type is BlockType.IMAGE:
+                pdf.prefetch_image(block.target)
+        pending.append(section)
+        if len(pending) > lookahead:
+            yield pending.popleft()
+    yield from pending
+
+def build_pdf(content, progress=None, stats=None, pages=None, chapter_level=None):
+    """Parse markdown content and lay it out on a new PDF, without writing it.
+
+    content may be a string or any iterable of lines (an open file, an upload
+    stream); sections are rendered as soon as the parser yields them.
+    progress, if given, is called with the number of sections rendered so far.
+    stats, a PipelineStats, is filled in with stage timings and counters.
+    pages, a (first, last) page range, stops parsing and layout once page
+    last is full and leaves the other pages out of the PDF.
+    chapter_level, if given, starts every heading of that level or above
+    (1 for # headings) on a new page, as parallel.py does.
+    """
+    start = time.perf_counter()
+    
+    # Parse markdown content lazily
+    if stats is not None:
+        sections = _timed_sections(iter_sections(_count_input(content, stats)), stats)
+    else:
+        sections = iter_sections(content)
+    
+    pdf = new_pdf()
+    sections = _prefetch_images(pdf, sections)
+    if pages is not None:
+        first, last = pages
+        if first < 1 or (last is not None and last < first):
+            raise ValueError(f'Invalid page range {first}-{last or ""}')
+        pdf.page_range = (first, last)
+    
+    # Process each section
+    _active.stats = stats
+    try:
+        for sections_done, section in enumerate(sections, 1):
+            if chapter_level and sections_done > 1 and starts_chapter(section, chapter_level):
+                pdf.start_chapter()
+            render_section(pdf, section, stats)
+            if stats is not None:
+                stats.sections = sections_done
+            if progress:
+                progress(sections_done)
+    except _PageRangeDone:
+        pass  # The rest of the document is neither parsed nor laid out
+    except Exception as e:
+        logger.error(f'Error processing section: {str(e)}')
+        raise Exception(f'Error processing section: {str(e)}')
+    finally:
+        _active.stats = None
+
+    if pages is not None and pdf.page < pages[0]:
+        raise PageOutOfRange(f'Page {pages[0]} requested but the document has {pdf.page} pages')
+    if stats is not None:
+        stats.pages = pdf.page
+        stats.layout_seconds = (time.perf_counter() - start - stats.parse_seconds
+                                - stats.clean_seconds - stats.inline_seconds)
+    return pdf
+
+def generate_pdf_from_content(content, progress=None, stats=None, pages=None, chapter_level=None):
+    """Helper function to generate PDF bytes from markdown content"""
+    pdf = build_pdf(content, progress, stats, pages, chapter_level)
+    
+    # fpdf 1.7 builds the whole document as a latin-1 str in memory
+    start = time.perf_counter()
+    data = pdf.output(dest='S').encode('latin-1')
+    if stats is not None:
+        stats.output_seconds = time.perf_counter() - start
+        stats.bytes_out = len(data)
+    return data
+
+# Exercises every block type except images, whose decoding starts threads
+WARM_UP_DOCUMENT = """# Warm-up
+Some **bold**, *italic* and ***both***.
+- A bullet
+1. A numbered item
+> A quote
+[A link](https://example.com)
+```python
+def f(x):  # comment
+    return "x" * 2
+```
+| Column | Other |
+|:-------|------:|
+| a | b |
+---
+"""
+
+_warmed_up = False
+
+def warm_up():
+    """Load fonts and lay out a small document once, so the regexes, caches
+    and font metrics fpdf and the parser build on first use already exist.
+
+    Called by a gunicorn --preload master before it forks, the workers then
+    share all of it copy-on-write; on later calls it only loads the fonts.
+    """
+    global _warmed_up
+    warm_up_fonts()
+    if not _warmed_up:
+        generate_pdf_from_content(WARM_UP_DOCUMENT)
+        _warmed_up = True
@@ -0,0 +1,43 @@
+# Gunicorn picks this file up automatically when started with `gunicorn app:app`
+import inspect
+import os
+import shutil
+
+# Workers and their render processes share metrics through files in this
+# directory; it must be set before prometheus_client is first imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics'))
+
+def _reset_metrics_dir():
+    # Samples left over from a previous run would be counted again
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+# Done while the config loads: with --preload the app (and its metrics) is
+# imported before on_starting runs
+_reset_metrics_dir()
+
+def when_ready(server):
+    # With --preload the master has imported the app: build the fonts, regexes
+    # and caches once here for all workers to share
+    if server.cfg.preload_app:
+        from app import preload
+        preload()
+
+def post_fork(server, worker):
+    # Parse the embedded fonts once per worker, before the first request arrives
+    # (already done when preloaded)
+    from generate_pdf import warm_up
+    warm_up()
+
+def post_worker_init(worker):
+    from app import render_engine, start_cleanup_scheduler
+    if 'RENDER_PROCESSES' not in os.environ and worker.cfg.workers != render_engine.web_workers:
+        worker.log.warning('%d workers but render pools sized for WEB_CONCURRENCY=%d; set WEB_CONCURRENCY '
+                           'instead of --workers, or RENDER_PROCESSES', worker.cfg.workers, render_engine.web_workers)
+    # asgi.py's lifespan startup does the rest under UvicornWorker, where worker.wsgi is the ASGI app
+    if inspect.iscoroutinefunction(worker.wsgi):
+        return
+    # Start this worker's render pool so its processes are warm for the first large document
+    render_engine.start()
+    start_cleanup_scheduler()
@@ -0,0 +1,213 @@
+"""Syntax highlighting for fenced code blocks.
+
+Code is tokenized one line at a time with a regular expression per language;
+the only state carried from one line to the next is the multi-line comment
+or string still open at its end, so a block of any length can be highlighted
+in parts. Neighbouring tokens of the same colour are merged into one run, so
+a line costs as few text runs (and colour switches) as possible in the PDF.
+Highlighted parts are cached by a hash of their lines, language and starting
+state: the same code in another document, or another version of the same
+document, is tokenized once.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Highlighted lines kept in memory, in whole parts of code blocks
+HIGHLIGHT_CACHE_LINES = int(os.environ.get('HIGHLIGHT_CACHE_LINES', 16384))
+
+# Token colours (RGB)
+PLAIN = (36, 41, 46)
+KEYWORD = (215, 58, 73)
+BUILTIN = (111, 66, 193)
+STRING = (3, 47, 98)
+NUMBER = (0, 92, 197)
+COMMENT = (106, 115, 125)
+
+NUMBER_PATTERN = r'\b(?:0[xX][0-9a-fA-F_]+|\d[\d_]*(?:\.\d+)?(?:[eE][+-]?\d+)?)\b'
+IDENTIFIER_PATTERN = r'[A-Za-z_$][\w$]*'
+
+class Language:
+    """Tokenizer rules for one language.
+
+    line_comment starts a comment running to the end of the line; blocks are
+    (open, close, colour) delimiters of comments or strings that may span
+    lines; strings are patterns of single-line string literals.
+    """
+
+    def __init__(self, name, keywords=(), builtins=(), line_comment=None, blocks=(),
+                 strings=(r'"(?:[^"\\]|\\.)*"?', r"'(?:[^'\\]|\\.)*'?"), ignore_case=False):
+        self.name = name
+        self.keywords = frozenset(word.lower() if ignore_case else word for word in keywords)
+        self.builtins = frozenset(word.lower() if ignore_case else word for word in builtins)
+        self.blocks = tuple(blocks)
+        self.ignore_case = ignore_case
+        # Group names say what matched; block openers come first so """ is not read as ""
+        alternatives = [f'(?P<b{index}>{re.escape(opening)})' for index, (opening, _, _) in enumerate(self.blocks)]
+        if line_comment:
+            alternatives.append(f'(?P<comment>{re.escape(line_comment)}.*)')
+        alternatives.extend(f'(?P<string{index}>{pattern})' for index, pattern in enumerate(strings))
+        alternatives.append(f'(?P<number>{NUMBER_PATTERN})')
+        alternatives.append(f'(?P<word>{IDENTIFIER_PATTERN})')
+        self.pattern = re.compile('|'.join(alternatives))
+
+    def tokenize(self, line, state=None):
+        """Return ((colour, text) runs, state) for one line; state is the
+        index of the block still open at the end of the line, or None."""
+        runs = []
+        position = 0
+        if state is not None:
+            position = self._close(line, 0, state, runs)
+            if position is None:
+                return runs, state
+        search = self.pattern.search
+        while True:
+            match = search(line, position)
+            if match is None:
+                break
+            if match.start() > position:
+                _append(runs, PLAIN, line[position:match.start()])
+            kind = match.lastgroup
+            if kind == 'word':
+                word = match.group()
+                key = word.lower() if self.ignore_case else word
+                colour = KEYWORD if key in self.keywords else BUILTIN if key in self.builtins else PLAIN
+                _append(runs, colour, word)
+            elif kind[0] == 'b':
+                index = int(kind[1:])
+                _append(runs, self.blocks[index][2], match.group())
+                position = self._close(line, match.end(), index, runs)
+                if position is None:
+                    return runs, index
+                continue
+            else:
+                _append(runs, COMMENT if kind == 'comment' else NUMBER if kind == 'number' else STRING, match.group())
+            position = match.end()
+        if position < len(line):
+            _append(runs, PLAIN, line[position:])
+        return runs, None
+
+    def _close(self, line, position, index, runs):
+        # Runs up to the end of block index; the position after it, or None if it stays open
+        closing, colour = self.blocks[index][1:]
+        end = line.find(closing, position)
+        if end == -1:
+            _append(runs, colour, line[position:])
+            return None
+        end += len(closing)
+        _append(runs, colour, line[position:end])
+        return end
+
+def _append(runs, colour, text):
+    if not text:
+        return
+    if runs and runs[-1][0] == colour:
+        runs[-1] = (colour, runs[-1][1] + text)
+    else:
+        runs.append((colour, text))
+
+C_FAMILY_KEYWORDS = """auto break case catch class const continue default delete do else enum explicit
+extern final finally for friend goto if implements import inline interface namespace new operator override
+package private protected public register return sizeof static struct super switch template this throw throws
+try typedef typename union using virtual volatile while fn let mut impl trait pub use mod match loop crate
+func go defer chan select range type var val fun when object""".split()
+C_FAMILY_BUILTINS = """bool boolean byte char double float int long short signed unsigned void string String
+size_t uint8_t int32_t int64_t uint32_t uint64_t i32 i64 u8 u32 u64 usize f32 f64 str true false null nullptr
+NULL nil None Some Ok Err self Self""".split()
+C_FAMILY_BLOCKS = (('/*', '*/', COMMENT),)
+
+LANGUAGES = {language.name: language for language in (
+    Language('python',
+             keywords="""and as assert async await break class continue def del elif else except finally for
+             from global if import in is lambda match case nonlocal not or pass raise return try while with
+             yield""".split(),
+             builtins="""True False None self cls print len range str int float bool list dict set tuple
+             object type isinstance super open enumerate zip map filter sorted min max sum any all
+             Exception ValueError TypeError KeyError""".split(),
+             line_comment='#', blocks=(('"""', '"""', STRING), ("'''", "'''", STRING))),
+    Language('javascript',
+             keywords="""async await break case catch class const continue debugger default delete do else
+             export extends finally for from function if import in instanceof let new of return static super
+             switch this throw try typeof var void while with yield interface type enum implements
+             public private protected readonly as""".split(),
+             builtins="""true false null undefined NaN Infinity console window document Math JSON Object
+             Array String Number Boolean Promise Map Set Error require module exports""".split(),
+             line_comment='//', blocks=C_FAMILY_BLOCKS,
+             strings=(r'"(?:[^"\\]|\\.)*"?', r"'(?:[^'\\]|\\.)*'?", r'`(?:[^`\\]|\\.)*`?')),
+    Language('c', keywords=C_FAMILY_KEYWORDS, builtins=C_FAMILY_BUILTINS,
+             line_comment='//', blocks=C_FAMILY_BLOCKS),
+    Language('bash',
+             keywords="""if then else elif fi case esac for while until do done in function return local
+             export readonly select time""".split(),
+             builtins="""echo printf cd pwd read set unset source exit test true false shift eval exec
+             alias sudo grep sed awk cat ls rm cp mv mkdir chmod curl pip python git docker""".split(),
+             line_comment='#'),
+    Language('sql',
+             keywords="""select from where and or not insert into values update set delete create table
+             drop alter add index view join inner left right outer full on as group by order having limit
+             offset union all distinct case when then else end is null like in between exists primary
+             key foreign references default begin commit rollback with returning""".split(),
+             builtins="""count sum avg min max coalesce cast int integer varchar text boolean date
+             timestamp serial true false""".split(),
+             line_comment='--', blocks=C_FAMILY_BLOCKS, strings=(r"'(?:[^']|'')*'?", r'"[^"]*"?'),
+             ignore_case=True),
+    Language('json', builtins=('true', 'false', 'null'), strings=(r'"(?:[^"\\]|\\.)*"?',)),
+    Language('yaml', builtins="""true false yes no on off null""".split(), line_comment='#'),
+)}
+
+# Info strings that name the same language
+ALIASES = {
+    'py': 'python', 'python3': 'python', 'py3': 'python',
+    'js': 'javascript', 'jsx': 'javascript', 'ts': 'javascript', 'tsx': 'javascript',
+    'typescript': 'javascript', 'node': 'javascript',
+    'cpp': 'c', 'c++': 'c', 'cc': 'c', 'h': 'c', 'hpp': 'c', 'java': 'c', 'cs': 'c', 'csharp': 'c',
+    'go': 'c', 'golang': 'c', 'rust': 'c', 'rs': 'c', 'kotlin': 'c', 'kt': 'c', 'swift': 'c',
+    'scala': 'c', 'php': 'c',
+    'sh': 'bash', 'shell': 'bash', 'zsh': 'bash', 'console': 'bash', 'dockerfile': 'bash',
+    'postgresql': 'sql', 'mysql': 'sql', 'sqlite': 'sql',
+    'jsonc': 'json', 'yml': 'yaml', 'toml': 'yaml', 'ini': 'yaml',
+}
+
+def get_language(info):
+    """The Language for a fence info string like "python" or "js title=x", or None."""
+    name = info.split(None, 1)[0].lower() if info and info.strip() else ''
+    return LANGUAGES.get(ALIASES.get(name, name))
+
+_cache = OrderedDict()  # (digest, language, state) -> (lines, state)
+_cache_lines = 0
+_cache_lock = threading.Lock()
+
+def highlight(lines, info='', state=None):
+    """Highlight consecutive lines of a code block.
+
+    state is the one returned for the lines before these (None at the start
+    of a block). Returns (lines, state), each line a tuple of (colour, text)
+    runs; code in an unknown language is one PLAIN run per line.
+    """
+    global _cache_lines
+    language = get_language(info)
+    if language is None:
+        return tuple(((PLAIN, line),) if line else () for line in lines), None
+    digest = hashlib.blake2b('\n'.join(lines).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    key = (digest, language.name, state)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            return cached
+    result = []
+    for line in lines:
+        runs, state = language.tokenize(line, state)
+        result.append(tuple(runs))
+    cached = tuple(result), state
+    if len(result) <= HIGHLIGHT_CACHE_LINES:
+        with _cache_lock:
+            if key not in _cache:
+                _cache[key] = cached
+                _cache_lines += len(result)
+            # Evict least recently used parts until we fit again
+            while _cache_lines > HIGHLIGHT_CACHE_LINES:
+                _cache_lines -= len(_cache.popitem(last=False)[1][0])
+    return cached
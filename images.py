@@ -0,0 +1,222 @@
+"""Images for markdown ![alt](src) lines: local files and data URIs.
+
+Images are decoded with Pillow and scaled down to IMAGE_DPI at the size they
+are shown, so a 20 megapixel screenshot costs a few hundred kilobytes in the
+PDF rather than tens of megabytes. Decoded images are kept in a process-wide
+LRU keyed by a hash of the encoded bytes and the scaled size: a logo used on
+every page, or by every document, is read, decoded and compressed once.
+Loading runs on a small thread pool while the document is laid out.
+"""
+import base64
+import binascii
+import hashlib
+import io
+import math
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+# Local image paths are resolved inside this directory; without it only
+# data: URIs are rendered (a server must not read arbitrary files)
+IMAGE_ROOT = os.environ.get('IMAGE_ROOT') or None
+# Resolution images are scaled down to, at the size they appear on the page
+IMAGE_DPI = int(os.environ.get('IMAGE_DPI', 150))
+IMAGE_CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', 64 * 1024 * 1024))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 32 * 1024 * 1024))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 64 * 1000 * 1000))
+IMAGE_THREADS = int(os.environ.get('IMAGE_THREADS', 4))
+
+# Pixels are shown at this density unless that would not fit the page
+SOURCE_DPI = 96
+JPEG_QUALITY = 85
+
+# EXIF orientation, and the values of it that swap width and height
+ORIENTATION_TAG = 0x0112
+ROTATIONS = (5, 6, 7, 8)
+
+class ImageError(Exception):
+    """The image could not be read or decoded; the renderer shows its alt text instead."""
+
+class ImageCache:
+    """LRU of decoded images (fpdf image info dicts), bounded by their total size."""
+
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None else max_bytes // 4
+        self._entries = OrderedDict()  # key -> (size, info)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, info):
+        size = len(info['data']) + len(info.get('smask', b''))
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[0]
+            self._entries[key] = (size, info)
+            self._size += size
+            # Evict least recently used images until we fit again
+            while self._size > self.max_bytes:
+                self._size -= self._entries.popitem(last=False)[1][0]
+
+image_cache = ImageCache()
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def _pool():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # Threads do not survive a fork, so each process starts its own pool
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=IMAGE_THREADS, thread_name_prefix='image-decode')
+            _executor_pid = os.getpid()
+        return _executor
+
+def read_source(source, root=IMAGE_ROOT, base=None):
+    """Return the encoded bytes of a data: URI, or of a file inside root.
+
+    Relative paths start from base, a directory inside root (root itself by default).
+    """
+    if source.startswith('data:'):
+        header, comma, payload = source.partition(',')
+        if not comma or not header.endswith(';base64'):
+            raise ImageError('Only base64 data: URIs are supported')
+        try:
+            data = base64.b64decode(payload, validate=True)
+        except (binascii.Error, ValueError) as e:
+            raise ImageError(f'Invalid base64 data: {e}')
+    elif '://' in source:
+        raise ImageError('Remote images are not supported')
+    elif root is None:
+        raise ImageError('Local images are disabled (IMAGE_ROOT is not set)')
+    else:
+        root = os.path.realpath(root)
+        path = os.path.realpath(os.path.join(base or root, source))
+        if os.path.commonpath([root, path]) != root:
+            raise ImageError('Image path is outside the image directory')
+        try:
+            if os.path.getsize(path) > IMAGE_MAX_BYTES:
+                raise ImageError(f'Image is larger than {IMAGE_MAX_BYTES} bytes')
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            raise ImageError(f'Cannot read image: {e.strerror}')
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ImageError(f'Image is larger than {IMAGE_MAX_BYTES} bytes')
+    return data
+
+def display_size(pixel_width, pixel_height, max_width, max_height):
+    """Width and height in mm: SOURCE_DPI, shrunk to fit max_width x max_height."""
+    width = pixel_width * 25.4 / SOURCE_DPI
+    height = pixel_height * 25.4 / SOURCE_DPI
+    scale = min(1.0, max_width / width, max_height / height)
+    return width * scale, height * scale
+
+def _rows(raw, stride):
+    # PNG predictor data: every row starts with its filter type, 0 (None)
+    return b''.join(b'\0' + raw[start:start + stride] for start in range(0, len(raw), stride))
+
+def _normalize(image):
+    """Convert to RGB or L, with an alpha channel only when the image has one."""
+    transparent = 'transparency' in image.info
+    if image.mode in ('P', 'PA'):
+        return image.convert('RGBA' if transparent or image.mode == 'PA' else 'RGB')
+    if image.mode in ('1', 'I', 'I;16', 'F'):
+        image = image.convert('L')
+    if image.mode in ('L', 'RGB') and transparent:
+        return image.convert('LA' if image.mode == 'L' else 'RGBA')
+    if image.mode not in ('L', 'RGB', 'LA', 'RGBA'):
+        return image.convert('RGB')
+    return image
+
+def _flate(image, smask=None):
+    colors = len(image.getbands())
+    info = {'w': image.width, 'h': image.height, 'cs': 'DeviceRGB' if colors == 3 else 'DeviceGray',
+            'bpc': 8, 'f': 'FlateDecode',
+            'dp': f'/Predictor 15 /Colors {colors} /BitsPerComponent 8 /Columns {image.width}',
+            'data': zlib.compress(_rows(image.tobytes(), image.width * colors))}
+    if smask is not None:
+        # fpdf writes the soft mask with the same filter and a PNG predictor
+        info['smask'] = zlib.compress(_rows(smask.tobytes(), image.width))
+    return info
+
+def _encode(image, source_format, data, changed):
+    """fpdf image info for a decoded image; data is the original file, used
+    as is for a JPEG that did not have to be scaled, rotated or converted."""
+    if source_format == 'JPEG' and not changed and image.mode in ('RGB', 'L'):
+        return {'w': image.width, 'h': image.height, 'cs': 'DeviceRGB' if image.mode == 'RGB' else 'DeviceGray',
+                'bpc': 8, 'f': 'DCTDecode', 'data': data}
+    image = _normalize(image)
+    if image.mode in ('RGBA', 'LA'):
+        alpha = image.getchannel('A')
+        image = image.convert(image.mode[:-1])
+        if alpha.getextrema() != (255, 255):
+            return _flate(image, smask=alpha)
+    if source_format == 'JPEG':
+        # Photos stay JPEG: Flate would make them several times larger
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=JPEG_QUALITY)
+        return {'w': image.width, 'h': image.height, 'cs': 'DeviceRGB' if image.mode == 'RGB' else 'DeviceGray',
+                'bpc': 8, 'f': 'DCTDecode', 'data': out.getvalue()}
+    return _flate(image)
+
+def load_image(source, max_width, max_height, root=IMAGE_ROOT, base=None):
+    """Return (key, width, height, info) for an image source.
+
+    width and height are the size to draw it at in mm, at most max_width by
+    max_height. info is the decoded image in fpdf's format, shared through
+    the cache: copy it before fpdf adds per-document keys. key identifies
+    the image and its scaled size, for embedding each one once per document.
+    """
+    data = read_source(source, root, base)
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        # Only the header is read here; pixels are decoded on a cache miss
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > IMAGE_MAX_PIXELS:
+            raise ImageError(f'Image has more than {IMAGE_MAX_PIXELS} pixels')
+        orientation = image.getexif().get(ORIENTATION_TAG, 1)
+        rotated = orientation in ROTATIONS
+        pixel_width, pixel_height = (image.height, image.width) if rotated else image.size
+        width, height = display_size(pixel_width, pixel_height, max_width, max_height)
+        target = (max(1, math.ceil(width / 25.4 * IMAGE_DPI)), max(1, math.ceil(height / 25.4 * IMAGE_DPI)))
+        resized = target[0] < pixel_width
+        key = f'{digest}:{target[0]}x{target[1]}' if resized else digest
+
+        info = image_cache.get(key)
+        if info is None:
+            source_format = image.format
+            if resized and source_format == 'JPEG':
+                # Decode at the smallest 1/2, 1/4 or 1/8 scale that is still large enough
+                image.draft(image.mode, target[::-1] if rotated else target)
+            if orientation != 1:
+                image = ImageOps.exif_transpose(image)
+            if resized:
+                image = _normalize(image)
+                image.thumbnail(target, Image.Resampling.LANCZOS)
+            info = _encode(image, source_format, data, resized or orientation != 1)
+            image_cache.put(key, info)
+    except ImageError:
+        raise
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ImageError(f'Cannot decode image: {e}')
+    return key, width, height, info
+
+def prefetch(source, max_width, max_height, root=IMAGE_ROOT, base=None):
+    """Start load_image on the decode pool; returns a Future."""
+    return _pool().submit(load_image, source, max_width, max_height, root, base)
@@ -0,0 +1,131 @@
+"""Asynchronous conversion jobs for large documents.
+
+Job state lives in a SQLite database and inputs/results are plain files, all
+inside one directory, so every web worker and render process on the machine
+sees the same jobs without an external broker.
+"""
+import os
+import re
+import sqlite3
+import time
+import uuid
+
+from generate_pdf import iter_sections
+from render_engine import render_with_timeout
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Render processes write progress at most this often
+PROGRESS_INTERVAL = 0.5
+
+# Inputs, results and partly written results of jobs
+JOB_FILE_RE = re.compile(r'^([0-9a-f]{32})\.(?:md|pdf|pdf\.tmp)$')
+
+class JobStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.db_path = os.path.join(directory, 'jobs.sqlite3')
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                download_name TEXT NOT NULL,
+                sections_done INTEGER NOT NULL DEFAULT 0,
+                sections_total INTEGER,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )''')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def input_path(self, job_id):
+        return os.path.join(self.directory, job_id + '.md')
+
+    def result_path(self, job_id):
+        return os.path.join(self.directory, job_id + '.pdf')
+
+    def create(self, download_name):
+        """Record a new queued job and return its id; its input goes to input_path()."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT INTO jobs (id, status, download_name, created, updated) VALUES (?, ?, ?, ?, ?)',
+                       (job_id, QUEUED, download_name, now, now))
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as db:
+            db.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def expire(self, max_age):
+        """Delete jobs not updated for max_age seconds and, in one pass over
+        the directory, their files and results left over from crashed
+        renders. Returns the number of files removed."""
+        cutoff = time.time() - max_age
+        with self._connect() as db:
+            expired = {row[0] for row in db.execute('SELECT id FROM jobs WHERE updated < ?', (cutoff,))}
+            db.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in expired])
+        removed = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                match = JOB_FILE_RE.match(entry.name)
+                if match is None:
+                    continue  # The database, its WAL files and the cleanup lock
+                try:
+                    if match.group(1) in expired or (entry.name.endswith('.tmp')
+                                                     and entry.stat().st_mtime < cutoff):
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+def run_job(directory, job_id, timeout):
+    """Render one job; runs in a render process."""
+    store = JobStore(directory)
+    input_path = store.input_path(job_id)
+    try:
+        store.update(job_id, status=RUNNING)
+        # A cheap parse-only pass gives the total for progress reporting
+        with open(input_path, 'r', encoding='utf-8') as f:
+            store.update(job_id, sections_total=sum(1 for _ in iter_sections(f)))
+
+        last_report = [0.0]
+        def progress(sections_done):
+            now = time.monotonic()
+            if now - last_report[0] >= PROGRESS_INTERVAL:
+                last_report[0] = now
+                store.update(job_id, sections_done=sections_done)
+
+        with open(input_path, 'r', encoding='utf-8') as f:
+            pdf = render_with_timeout(f, timeout, progress)
+
+        # Publish the result atomically so a reader never sees a partial PDF
+        tmp_path = store.result_path(job_id) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf)
+        os.replace(tmp_path, store.result_path(job_id))
+        job = store.get(job_id)
+        store.update(job_id, status=DONE, sections_done=job['sections_total'] if job else 0)
+    except Exception as e:
+        store.update(job_id, status=FAILED, error=str(e))
+    finally:
+        try:
+            os.remove(input_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,41 @@
+"""Leader election between the processes of one machine, through a file lock.
+
+Every web worker calls elect() once it has booted. The first to lock the file
+runs the task; the others wait for the lock in a background thread. The
+kernel releases the lock when its holder exits, so when the leader dies or
+is recycled another worker takes over.
+
+The lock belongs to the open file, which fork() shares: processes forked by
+the leader would keep holding it. Render pools use forkserver or spawn, so
+their processes do not inherit it.
+"""
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so every process leads
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+def elect(lock_path, task, name='leader'):
+    """Run task() in a daemon thread once this process holds the lock on lock_path."""
+    def run():
+        if fcntl is not None:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            # Blocks until the current leader exits; the fd stays open, and
+            # the lock held, for the rest of this process's life
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.ftruncate(fd, 0)
+            os.write(fd, f'{os.getpid()}\n'.encode())
+        logger.info(f'Process {os.getpid()} is the {name}')
+        try:
+            task()
+        except Exception:
+            logger.exception(f'{name} task failed')
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,291 @@
+"""Command-line converter for whole trees of markdown files.
+
+Usage:
+    python -m markdownforge docs/ -o build/pdf [--jobs 8] [--force]
+    python -m markdownforge docs/ -o build/pdf --watch [--interval 1]
+    python -m markdownforge docs/ -o build/pdf --chapter-level 1
+
+Every .md, .markdown and .txt file under the input directory becomes a PDF
+at the same relative path under the output directory. Files are rendered
+in a pool of processes, one per available core, and read through mmap.
+
+A manifest in the output directory records the size, modification time
+and content hash of every source file, along with the renderer version.
+On the next run a file whose size and modification time are unchanged is
+skipped after one stat(). A touched file is hashed again and rendered only
+if its content changed. A new renderer version rebuilds everything. PDFs of
+deleted sources are removed. --watch repeats the scan every --interval
+seconds and re-renders only the files that changed.
+
+--chapter-level N starts every heading of level N or above (1 for #) on a
+new page. Chapters can then be laid out separately, so when there are
+fewer files to render than processes, as with one large manual, each
+file's chapters are spread over the pool instead (see parallel.py). The
+PDFs are the same either way.
+
+Local image paths are relative to each markdown file's own directory, and
+may point anywhere inside the input directory (or --image-root), so a
+shared ../images folder works.
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from generate_pdf import PDF, RENDERER_VERSION, generate_pdf_from_content, warm_up
+from parallel import generate_pdf_parallel
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown', '.txt')
+MANIFEST_NAME = '.markdownforge-manifest.json'
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not on Linux
+        return os.cpu_count() or 1
+
+@contextmanager
+def open_mapped(path):
+    """The contents of a file as a read-only mmap (b'' for an empty file, which cannot be mapped)."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+def hash_file(path):
+    with open_mapped(path) as data:
+        return hashlib.sha256(data).hexdigest()
+
+def find_sources(input_dir, output_dir):
+    """(relative path, stat) of every markdown file under input_dir, sorted;
+    hidden directories and output_dir are skipped."""
+    output_dir = os.path.realpath(output_dir)
+    sources = []
+    stack = [input_dir]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if os.path.realpath(entry.path) != output_dir:
+                        stack.append(entry.path)
+                elif entry.name.lower().endswith(MARKDOWN_EXTENSIONS):
+                    sources.append((os.path.relpath(entry.path, input_dir).replace(os.sep, '/'), entry.stat()))
+    sources.sort()
+    return sources
+
+def output_names(paths):
+    # One PDF name per source, made unique when a.md and a.txt both exist
+    used = set()
+    names = {}
+    for path in paths:
+        base = path.rsplit('.', 1)[0]
+        candidate = base + '.pdf'
+        n = 2
+        while candidate in used:
+            candidate = f'{base}-{n}.pdf'
+            n += 1
+        used.add(candidate)
+        names[path] = candidate
+    return names
+
+def convert_file(source, output, chapter_level=None, workers=1, image_root=None):
+    """Render one markdown file to output; runs in a pool process, or with
+    workers > 1 lays its chapters out in that many processes of its own.
+    Images are read from inside image_root (default: the file's directory)."""
+    start = time.perf_counter()
+    # Each process renders one file at a time, so the class defaults are safe to set here
+    PDF.image_base = os.path.dirname(os.path.abspath(source))
+    PDF.image_root = image_root or PDF.image_base
+    with open_mapped(source) as data:
+        # Lines are decoded one at a time as the parser asks for them
+        lines = iter(data.readline, b'') if data else ''
+        if workers > 1:
+            pdf = generate_pdf_parallel(lines, workers, chapter_level, PDF.image_root, PDF.image_base)
+        else:
+            pdf = generate_pdf_from_content(lines, chapter_level=chapter_level)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    tmp_path = f'{output}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(pdf)
+    os.replace(tmp_path, output)
+    return time.perf_counter() - start
+
+class Manifest:
+    """The record of what was rendered from which source, in the output directory."""
+
+    def __init__(self, output_dir, chapter_level=None):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.chapter_level = chapter_level
+        self.files = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        # PDFs from another renderer version or chapter level are all stale
+        if data.get('renderer') == RENDERER_VERSION and data.get('chapter_level') == chapter_level:
+            self.files = data.get('files', {})
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'renderer': RENDERER_VERSION, 'chapter_level': self.chapter_level, 'files': self.files},
+                      f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+class Builder:
+    """Incremental conversion of input_dir into output_dir."""
+
+    def __init__(self, input_dir, output_dir, jobs=None, force=False, chapter_level=None, image_root=None):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.image_root = os.path.abspath(image_root or input_dir)
+        self.jobs = jobs or available_cores()
+        self.force = force
+        self.chapter_level = chapter_level
+        self.manifest = Manifest(output_dir, chapter_level)
+        self.dirty = False  # The manifest differs from the saved one
+        self._executor = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def plan(self):
+        """Return (files to render as {path: entry}, number unchanged) and
+        drop the PDFs of sources that no longer exist."""
+        sources = find_sources(self.input_dir, self.output_dir)
+        names = output_names(path for path, _ in sources)
+        known = self.manifest.files
+        stale = {}
+        unchanged = 0
+        for path, stat in sources:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'output': names[path]}
+            old = known.get(path)
+            if (not self.force and old and old['output'] == entry['output']
+                    and os.path.exists(os.path.join(self.output_dir, entry['output']))):
+                if old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+                    unchanged += 1
+                    continue
+                # Touched but maybe not edited (a checkout, a save without changes)
+                entry['hash'] = hash_file(os.path.join(self.input_dir, path))
+                if entry['hash'] == old['hash']:
+                    known[path] = entry
+                    self.dirty = True
+                    unchanged += 1
+                    continue
+            else:
+                # Hashed before rendering, so an edit made meanwhile is seen next time
+                entry['hash'] = hash_file(os.path.join(self.input_dir, path))
+            stale[path] = entry
+
+        # PDFs no source renders to any more: of deleted sources, or of ones whose name changed
+        outputs = set(names.values())
+        orphans = [known.pop(path)['output'] for path in [path for path in known if path not in names]]
+        orphans.extend(known[path]['output'] for path in stale if path in known)
+        for output in orphans:
+            self.dirty = True
+            if output not in outputs:
+                try:
+                    os.remove(os.path.join(self.output_dir, output))
+                except FileNotFoundError:
+                    pass
+        return stale, unchanged
+
+    def build(self):
+        """Render every changed source; returns (rendered, unchanged, failed) counts."""
+        stale, unchanged = self.plan()
+        rendered = failed = 0
+        try:
+            for path, entry, result in self._render(stale):
+                self.dirty = True
+                if isinstance(result, Exception):
+                    failed += 1
+                    # Left out of the manifest, so the next run tries again
+                    self.manifest.files.pop(path, None)
+                    print(f'error  {path}: {result}', file=sys.stderr)
+                else:
+                    rendered += 1
+                    self.manifest.files[path] = entry
+                    print(f'built  {path} -> {entry["output"]} ({result:.2f}s)')
+        finally:
+            if self.dirty:
+                os.makedirs(self.output_dir, exist_ok=True)
+                self.manifest.save()
+                self.dirty = False
+        return rendered, unchanged, failed
+
+    def _render(self, stale):
+        # Yields (path, entry, seconds or exception) as each file finishes
+        tasks = [(path, entry, os.path.join(self.input_dir, path), os.path.join(self.output_dir, entry['output']))
+                 for path, entry in stale.items()]
+        if self.jobs == 1 or len(tasks) == 1 or (self.chapter_level and len(tasks) < self.jobs):
+            # Too few files for a process each: their chapters are shared out instead, if they have any
+            workers = self.jobs if self.chapter_level else 1
+            for path, entry, source, output in tasks:
+                try:
+                    yield path, entry, convert_file(source, output, self.chapter_level, workers, self.image_root)
+                except Exception as e:
+                    yield path, entry, e
+            return
+        if self._executor is None and tasks:
+            self._executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=warm_up)
+        futures = {self._executor.submit(convert_file, source, output, self.chapter_level, 1, self.image_root):
+                   (path, entry)
+                   for path, entry, source, output in tasks}
+        for future in as_completed(futures):
+            path, entry = futures[future]
+            try:
+                yield path, entry, future.result()
+            except Exception as e:
+                yield path, entry, e
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='markdownforge', description='Convert a tree of markdown files to PDFs.')
+    parser.add_argument('input', help='directory of markdown files')
+    parser.add_argument('-o', '--output', required=True, help='directory the PDFs are written to')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='render processes (default: one per available core)')
+    parser.add_argument('--force', action='store_true', help='render every file, changed or not')
+    parser.add_argument('--watch', action='store_true', help='keep running and re-render files as they change')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between scans in --watch mode')
+    parser.add_argument('--image-root', default=None, metavar='DIR',
+                        help='directory local images may be read from (default: the input directory)')
+    parser.add_argument('--chapter-level', type=int, choices=range(1, 7), default=None, metavar='N',
+                        help='start every heading of level N or above on a new page, which lets one '
+                             'large file be laid out on all --jobs processes')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input):
+        parser.error(f'{args.input} is not a directory')
+    builder = Builder(args.input, args.output, args.jobs, args.force, args.chapter_level, args.image_root)
+    try:
+        start = time.perf_counter()
+        rendered, unchanged, failed = builder.build()
+        print(f'{rendered} built, {unchanged} unchanged, {failed} failed in {time.perf_counter() - start:.2f}s')
+        if not args.watch:
+            return 1 if failed else 0
+        builder.force = False
+        print(f'Watching {args.input} for changes (Ctrl+C to stop)')
+        while True:
+            time.sleep(args.interval)
+            rendered, unchanged, failed = builder.build()
+            if rendered or failed:
+                print(f'{rendered} built, {failed} failed')
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        builder.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
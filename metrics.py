@@ -0,0 +1,59 @@
+"""Prometheus metrics for the conversion pipeline.
+
+Conversions run in web workers and in render processes alike. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it) every process
+writes its samples to files in that directory and /metrics adds them up;
+without it, metrics only cover the process serving /metrics.
+"""
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Histogram, generate_latest, multiprocess)
+
+STAGES = ('clean', 'parse', 'inline', 'layout', 'output')
+
+# Stage times span sub-millisecond lines to multi-minute documents
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (1024, 8 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2,
+                16 * 1024 ** 2, 64 * 1024 ** 2)
+
+STAGE_SECONDS = Histogram('markdownforge_stage_seconds', 'Time spent in each conversion stage',
+                          ['stage'], buckets=STAGE_BUCKETS)
+CONVERSION_SECONDS = Histogram('markdownforge_conversion_seconds', 'Total time per conversion',
+                               buckets=STAGE_BUCKETS)
+INPUT_SIZE = Histogram('markdownforge_input_size_bytes', 'Markdown size per conversion',
+                       buckets=SIZE_BUCKETS)
+CONVERSIONS = Counter('markdownforge_conversions', 'Conversions by outcome', ['status'])
+INPUT_BYTES = Counter('markdownforge_input_bytes', 'Markdown bytes converted')
+LINES = Counter('markdownforge_lines', 'Markdown lines converted')
+SECTIONS = Counter('markdownforge_sections', 'Sections rendered')
+PAGES = Counter('markdownforge_pages', 'PDF pages produced')
+OUTPUT_BYTES = Counter('markdownforge_output_bytes', 'PDF bytes produced')
+
+def record_conversion(stats):
+    """Add one successful conversion's PipelineStats to the metrics."""
+    total = 0.0
+    for stage in STAGES:
+        seconds = getattr(stats, stage + '_seconds')
+        STAGE_SECONDS.labels(stage).observe(seconds)
+        total += seconds
+    CONVERSION_SECONDS.observe(total)
+    INPUT_SIZE.observe(stats.bytes_in)
+    CONVERSIONS.labels('ok').inc()
+    INPUT_BYTES.inc(stats.bytes_in)
+    LINES.inc(stats.lines)
+    SECTIONS.inc(stats.sections)
+    PAGES.inc(stats.pages)
+    OUTPUT_BYTES.inc(stats.bytes_out)
+
+def record_failure(status='error'):
+    CONVERSIONS.labels(status).inc()
+
+def latest():
+    """Return (body, content type) of the current metrics in Prometheus text format."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
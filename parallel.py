@@ -0,0 +1,182 @@
+"""Parallel layout of long documents, one group of chapters per process.
+
+fpdf is pure Python, so a 300-page manual is laid out on one core. Here the
+parsed sections are split into chapters at headings of chapter_level or
+above, and each chapter starts on a new page from the reset style (see
+PDF.start_chapter): its pages then only depend on its own sections, so
+groups of chapters are laid out in a process pool at the same time.
+
+The pages of every group are joined into one document. Image numbers are
+made document-wide, the font subsets are merged into one, and every footer
+is redrawn from the layout state it was first drawn in, with the page's final
+number. The result is the same PDF, byte for byte, as
+build_pdf(content, chapter_level=chapter_level) laying the document out in
+order; the grouping only decides which process does the work.
+"""
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from generate_pdf import (PDF, _prefetch_images, new_pdf, parse_markdown, render_section,
+                          starts_chapter, warm_up_fonts)
+
+# Chapter groups per worker, so a few long chapters do not leave processes idle
+GROUPS_PER_WORKER = 4
+
+# An image drawn by add_image; the number is the image's position in the document
+IMAGE_DRAW_RE = re.compile(r'^(q [-\d.]+ 0 0 [-\d.]+ [-\d.]+ [-\d.]+ cm /I)(\d+)( Do Q)$', re.M)
+
+_executor = None
+_executor_pid = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+def _pool(workers):
+    global _executor, _executor_pid, _executor_workers
+    with _executor_lock:
+        # A pool inherited across fork has no live workers, so each process gets its own
+        if _executor is None or _executor_pid != os.getpid() or _executor_workers != workers:
+            if _executor is not None and _executor_pid == os.getpid():
+                _executor.shutdown(wait=False)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=warm_up_fonts)
+            _executor_pid = os.getpid()
+            _executor_workers = workers
+        return _executor
+
+def split_chapters(sections, chapter_level=1):
+    """Split parsed sections into chapters, each starting at a heading of
+    chapter_level or above (except the first, which starts the document)."""
+    chapters = []
+    for section in sections:
+        if not chapters or starts_chapter(section, chapter_level):
+            chapters.append([])
+        chapters[-1].append(section)
+    return chapters
+
+def _group_chapters(chapters, groups):
+    """Split chapters into at most groups runs of consecutive chapters of similar size."""
+    sizes = [sum(len(section["content"]) + 1 for section in chapter) for chapter in chapters]
+    target = sum(sizes) / groups
+    result = [[]]
+    size = 0
+    for chapter, chapter_size in zip(chapters, sizes):
+        if result[-1] and size >= target and len(result) < groups:
+            result.append([])
+            size = 0
+        result[-1].append(chapter)
+        size += chapter_size
+    return result
+
+def layout_chapters(chapters, first, last, image_root=None, image_base=None):
+    """Lay out consecutive chapters on a new PDF; runs in a pool process.
+
+    first: the chapters start the document. last: they end it. Otherwise
+    the chapters start on page 2, after a page that only stands in for
+    whatever came before them, and end the way the next chapter's
+    start_chapter would end their last page. image_root and image_base, if
+    given, replace PDF's, which pool processes do not inherit.
+    """
+    pdf = new_pdf()
+    if image_root is not None:
+        pdf.image_root = image_root
+    if image_base is not None:
+        pdf.image_base = image_base
+    pdf.footer_states = {}
+    sections = _prefetch_images(pdf, (section for chapter in chapters for section in chapter))
+    starts = {id(chapter[0]) for chapter in chapters[0 if not first else 1:]}
+    for section in sections:
+        if id(section) in starts:
+            pdf.start_chapter()
+        render_section(pdf, section)
+    if not last:
+        pdf.reset_style()
+    # The last page's footer is drawn once the document is put together
+    pdf.footer_states[pdf.page] = (len(pdf.pages[pdf.page]), pdf.layout_state())
+
+    skip = 0 if first else 1
+    font = pdf.fonts[next(key for key, font in pdf.fonts.items() if font['type'] == 'TTF')]
+    return {
+        'pages': [pdf.pages[number] for number in range(1 + skip, pdf.page + 1)],
+        'footers': [pdf.footer_states[number] for number in range(1 + skip, pdf.page + 1)],
+        'page_links': {number - skip: links for number, links in pdf.page_links.items() if number > skip},
+        'links': {number: (page - skip, y) for number, (page, y) in pdf.links.items()},
+        'images': pdf.images,
+        'core_fonts': [key for key, font in pdf.fonts.items() if font['type'] == 'core'],
+        'subset': list(font['subset']),
+    }
+
+def merge_layouts(layouts):
+    """Join the pages of layout_chapters results into one PDF, ready for output()."""
+    pdf = PDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.attach_font()
+    font = next(font for font in pdf.fonts.values() if font['type'] == 'TTF')
+    for layout in layouts:
+        for key in layout['core_fonts']:
+            if key not in pdf.fonts:
+                family = key.rstrip('BI')
+                pdf.set_font(family, key[len(family):])
+        font['subset'].extend(layout['subset'])
+
+    total = sum(len(layout['pages']) for layout in layouts)
+    page = 0
+    for layout in layouts:
+        offset = page
+        # Images are numbered in the order the document first uses them
+        numbers = {}
+        for key, info in sorted(layout['images'].items(), key=lambda item: item[1]['i']):
+            if key not in pdf.images:
+                pdf.images[key] = dict(info, i=len(pdf.images) + 1)
+            numbers[info['i']] = pdf.images[key]['i']
+        renumber = any(local != number for local, number in numbers.items())
+
+        for content, (length, state) in zip(layout['pages'], layout['footers']):
+            page += 1
+            content = content[:length]
+            if renumber:
+                content = IMAGE_DRAW_RE.sub(lambda m: f"{m.group(1)}{numbers[int(m.group(2))]}{m.group(3)}",
+                                            content)
+            pdf.restore_layout_state(state)
+            pdf.page = page
+            pdf.pages[page] = content
+            # The last page stays open: output() draws its footer and closes the document
+            if page < total:
+                pdf.in_footer = 1
+                pdf.footer()
+                pdf.in_footer = 0
+
+        links = {}
+        for number, (link_page, y) in layout['links'].items():
+            links[number] = len(pdf.links) + 1
+            pdf.links[links[number]] = (link_page + offset, y)
+        for number, page_links in layout['page_links'].items():
+            pdf.page_links[number + offset] = [
+                link[:4] + (links[link[4]] if isinstance(link[4], int) else link[4],) for link in page_links]
+    return pdf
+
+def build_pdf_parallel(content, workers=None, chapter_level=1, image_root=None, image_base=None):
+    """Parse markdown content and lay it out in a pool of workers processes
+    (default: one per core). The PDF is the same as
+    build_pdf(content, chapter_level=chapter_level) gives.
+    """
+    workers = workers or os.cpu_count() or 1
+    chapters = split_chapters(parse_markdown(content), chapter_level)
+    groups = _group_chapters(chapters, workers * GROUPS_PER_WORKER) if chapters else [[]]
+    firsts = [index == 0 for index in range(len(groups))]
+    lasts = [index == len(groups) - 1 for index in range(len(groups))]
+    roots = [image_root] * len(groups)
+    bases = [image_base] * len(groups)
+    if workers == 1 or len(groups) == 1:
+        layouts = list(map(layout_chapters, groups, firsts, lasts, roots, bases))
+    else:
+        layouts = list(_pool(workers).map(layout_chapters, groups, firsts, lasts, roots, bases))
+    return merge_layouts(layouts)
+
+def generate_pdf_parallel(content, workers=None, chapter_level=1, image_root=None, image_base=None):
+    """PDF bytes for markdown content, laid out by build_pdf_parallel."""
+    return build_pdf_parallel(content, workers, chapter_level, image_root,
+                              image_base).output(dest='S').encode('latin-1')
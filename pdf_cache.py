@@ -0,0 +1,178 @@
+"""Content-addressed cache of rendered PDFs.
+
+Entries are keyed by cache_key(): a hash of the normalized markdown, the
+renderer version and the render options, so a key never goes stale and
+doubles as a strong ETag. MemoryCache is a per-process LRU; DiskCache is a
+directory shared by every worker, written through atomic renames.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from generate_pdf import RENDERER_VERSION, iter_lines
+
+def cache_key(source, options=None):
+    """Hash markdown (a string or iterable of lines) with the renderer version and options."""
+    digest = hashlib.sha256()
+    digest.update(f"{RENDERER_VERSION}\n{json.dumps(options or {}, sort_keys=True)}\n".encode('utf-8'))
+    for line in iter_lines(source):
+        # CRLF and LF documents render identically, so they share a key
+        digest.update(line.rstrip('\r').encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+class MemoryCache:
+    """Per-process LRU of PDF bytes, bounded by total size and entry age."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_age=3600, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None else max_bytes // 8
+        self._entries = OrderedDict()  # key -> (created, data)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.max_age:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, data):
+        if len(data) > self.max_item_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time(), data)
+            self._size += len(data)
+            # Evict least recently used entries until we fit again
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def evict(self):
+        """Drop expired entries; returns the number removed."""
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            expired = [key for key, (created, _) in self._entries.items() if created < cutoff]
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+    def _remove(self, key):
+        _, data = self._entries.pop(key)
+        self._size -= len(data)
+
+class DiskCache:
+    """PDF files in a directory shared by all workers, evicted by age then size.
+
+    Files are written under a temporary name and renamed into place, so a
+    reader in another process never sees a partial PDF.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, max_age=24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + '.pdf')
+
+    def get(self, key):
+        """The cached PDF opened for reading, or None.
+
+        An open file stays readable after another worker evicts it, where a
+        path could be gone by the time it is opened.
+        """
+        path = self.path_for(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            # Touch the file so size-based eviction treats it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return f
+
+    def put(self, key, data):
+        tmp_path = os.path.join(self.directory, f'.{key}.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        path = self.path_for(key)
+        os.replace(tmp_path, path)
+        return path
+
+    def evict(self):
+        """Remove files past max_age, then the oldest until under max_bytes."""
+        now = time.time()
+        removed = 0
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if now - stat.st_mtime > self.max_age:
+                        os.remove(entry.path)
+                        removed += 1
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    # Already removed by another worker
+                    continue
+
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+class TieredCache:
+    """Memory tier in front of a shared disk tier.
+
+    get() returns PDF bytes (memory hit), an open binary file the caller
+    must close (disk hit) or None.
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            return data
+        f = self.disk.get(key)
+        if f is not None and os.fstat(f.fileno()).st_size <= self.memory.max_item_bytes:
+            with f:
+                data = f.read()
+            self.memory.put(key, data)
+            return data
+        return f
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        return self.disk.put(key, data)
+
+    def evict(self):
+        return self.memory.evict() + self.disk.evict()
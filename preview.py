@@ -0,0 +1,171 @@
+"""Incremental PDF rendering for live preview.
+
+A preview session keeps the laid-out PDF of the last version of a document,
+its parsed sections and a checkpoint of the layout state before every
+section. When a new version arrives only the sections from the first changed
+one onwards are laid out again, starting from that checkpoint. As soon as
+the layout after an edited section matches the old layout at the same point
+of the unchanged tail (same page, position, font and colours), the rest is
+identical too, so the old pages are spliced back in instead of being
+re-rendered. Typing in one paragraph of a long document therefore costs a
+parse, a section or two of layout and the PDF output.
+
+Sessions live in the memory of one process; a request that lands on another
+worker just starts a new session with a full render.
+
+Previews are laid out in the web worker, where SIGALRM cannot interrupt
+them, so the timeout is checked after every section instead.
+"""
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from generate_pdf import new_pdf, parse_markdown, render_section
+from render_engine import RenderTimeout
+
+def _check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise RenderTimeout('Rendering took too long')
+
+class PreviewSession:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.used = time.monotonic()
+        self.sections = []
+        # Layout before each section and after the last one, as
+        # (layout state, length of the current page, links on the current page)
+        self.checkpoints = []
+        self.pdf = None
+
+    def render(self, content, timeout=None):
+        """Render a new version of the document; returns (PDF bytes, sections laid out).
+
+        Raises RenderTimeout once layout has taken more than timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        sections = parse_markdown(content)
+        try:
+            if self.pdf is None:
+                rendered = self._render_all(sections, deadline)
+            else:
+                rendered = self._render_changes(sections, deadline)
+        except Exception:
+            # A half-rendered document cannot be resumed from
+            self.pdf = None
+            self.sections = []
+            self.checkpoints = []
+            raise
+        self.sections = sections
+        return self._output(), rendered
+
+    def _checkpoint(self):
+        pdf = self.pdf
+        return (pdf.layout_state(), len(pdf.pages[pdf.page]), len(pdf.page_links.get(pdf.page, ())))
+
+    def _render_all(self, sections, deadline=None):
+        self.pdf = new_pdf()
+        self.pdf.page_streams = {}
+        self.checkpoints = [self._checkpoint()]
+        for section in sections:
+            render_section(self.pdf, section)
+            self.checkpoints.append(self._checkpoint())
+            _check_deadline(deadline)
+        return len(sections)
+
+    def _render_changes(self, sections, deadline=None):
+        old_sections, old_checkpoints, pdf = self.sections, self.checkpoints, self.pdf
+        limit = min(len(sections), len(old_sections))
+        prefix = 0
+        while prefix < limit and sections[prefix] == old_sections[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < limit - prefix and sections[-1 - suffix] == old_sections[-1 - suffix]:
+            suffix += 1
+
+        # Pages as they were before the first changed section
+        old_pages, old_links = pdf.pages, pdf.page_links
+        state, length, links = old_checkpoints[prefix]
+        page = state['page']
+        pdf.pages = {number: old_pages[number] for number in range(1, page)}
+        pdf.pages[page] = old_pages[page][:length]
+        pdf.page_links = {number: list(old_links[number]) for number in old_links if number < page}
+        if links:
+            pdf.page_links[page] = old_links[page][:links]
+        pdf.restore_layout_state(state)
+        self.checkpoints = old_checkpoints[:prefix + 1]
+
+        # Old checkpoint index = new checkpoint index - shift, within the unchanged tail
+        shift = len(sections) - len(old_sections)
+        for index in range(prefix, len(sections)):
+            render_section(pdf, sections[index])
+            self.checkpoints.append(self._checkpoint())
+            _check_deadline(deadline)
+            aligned = index + 1 - shift
+            if index + 1 < len(sections) - suffix or aligned >= len(old_checkpoints) - 1:
+                continue
+            if self.checkpoints[-1][0] == old_checkpoints[aligned][0]:
+                self._splice(old_pages, old_links, old_checkpoints, aligned)
+                return index + 1 - prefix
+        return len(sections) - prefix
+
+    def _splice(self, old_pages, old_links, old_checkpoints, aligned):
+        """Continue with the old layout from old checkpoint `aligned`, which
+        matches the current layout state."""
+        pdf = self.pdf
+        _, old_length, old_link_count = old_checkpoints[aligned]
+        page = pdf.page
+        length_delta = len(pdf.pages[page]) - old_length
+        link_delta = len(pdf.page_links.get(page, ())) - old_link_count
+
+        pdf.pages[page] += old_pages[page][old_length:]
+        if old_links.get(page, ())[old_link_count:]:
+            pdf.page_links.setdefault(page, []).extend(old_links[page][old_link_count:])
+        final_state = old_checkpoints[-1][0]
+        for number in range(page + 1, final_state['page'] + 1):
+            pdf.pages[number] = old_pages[number]
+            if number in old_links:
+                pdf.page_links[number] = old_links[number]
+
+        for state, length, links in old_checkpoints[aligned + 1:]:
+            if state['page'] == page:
+                length += length_delta
+                links += link_delta
+            self.checkpoints.append((state, length, links))
+        pdf.restore_layout_state(final_state)
+
+    def _output(self):
+        # Closing adds the footer and writes the file: do it on a copy so the
+        # session's pages stay open for the next edit
+        pdf = copy.copy(self.pdf)
+        pdf.pages = dict(self.pdf.pages)
+        pdf.offsets = {}
+        return pdf.output(dest='S').encode('latin-1')
+
+class PreviewStore:
+    """Per-process preview sessions, dropped when idle for max_age seconds
+    or when more than max_sessions are open (least recently used first)."""
+
+    def __init__(self, max_sessions=32, max_age=600):
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def session(self, session_id=None):
+        """Return (session id, session), starting a new session if session_id is unknown or expired."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, session in self._sessions.items() if now - session.used > self.max_age]
+            for key in expired:
+                del self._sessions[key]
+            session = self._sessions.get(session_id)
+            if session is None:
+                session_id = uuid.uuid4().hex
+                session = self._sessions[session_id] = PreviewSession()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            session.used = now
+            return session_id, session
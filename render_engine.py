@@ -0,0 +1,270 @@
+"""Bounded process pool for CPU-bound PDF rendering.
+
+fpdf is pure Python, so rendering a large document inline would pin the web
+worker that received it. RenderEngine renders small documents inline and
+sends everything else to a pool of pre-warmed processes, with a cap on jobs
+in flight, a per-job timeout and cancellation of queued jobs whose client
+has gone away. Background work (jobs, batches) waits for a slot of the same
+cap and never takes every process, so interactive renders are not stuck
+behind it.
+"""
+import collections
+import io
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from generate_pdf import PipelineStats, generate_pdf_from_content, warm_up_fonts
+
+class EngineBusy(Exception):
+    """Raised when the pool already has its maximum number of jobs in flight."""
+
+    def __init__(self, retry_after):
+        super().__init__('Render queue is full, please retry later')
+        self.retry_after = retry_after
+
+class RenderTimeout(Exception):
+    """Raised when a job runs longer than the engine's timeout."""
+
+class RenderCancelled(Exception):
+    """Raised when the caller stopped waiting before the job was finished."""
+
+def _init_worker():
+    # Fonts are parsed once per render process, before the first job
+    warm_up_fonts()
+
+def render_pdf(content, progress=None, stats=None, pages=None):
+    """generate_pdf_from_content, with the conversion recorded in the metrics."""
+    if stats is None:
+        stats = PipelineStats()
+    try:
+        pdf = generate_pdf_from_content(content, progress, stats, pages)
+    except Exception:
+        metrics.record_failure()
+        raise
+    metrics.record_conversion(stats)
+    return pdf
+
+def _call_with_timeout(timeout, fn, *args):
+    # Run fn(*args) in the current (worker) process, giving up after timeout seconds
+    expired = []
+
+    def on_alarm(signum, frame):
+        expired.append(True)
+        raise RenderTimeout('Rendering took too long')
+
+    # Interrupt the job inside the worker so a runaway document frees its process
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, on_alarm)
+        signal.alarm(timeout)
+    try:
+        return fn(*args)
+    except Exception:
+        # build_pdf wraps errors from the renderer, so restore the real cause
+        if expired:
+            raise RenderTimeout('Rendering took too long') from None
+        raise
+    finally:
+        if hasattr(signal, 'SIGALRM'):
+            signal.alarm(0)
+
+def render_with_timeout(content, timeout, progress=None, pages=None):
+    """Render in the current (worker) process, giving up after timeout seconds."""
+    return _call_with_timeout(timeout, render_pdf, content, progress, None, pages)
+
+def _profile(content, limit):
+    # Only needed here, so workers do not import them at startup
+    import cProfile
+    import pstats
+
+    stats = PipelineStats()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        render_pdf(content, stats=stats)
+    finally:
+        profiler.disable()
+
+    report = io.StringIO()
+    report.write(f'{stats.bytes_in} bytes, {stats.lines} lines, {stats.sections} sections '
+                 f'-> {stats.pages} pages, {stats.bytes_out} bytes\n')
+    for stage in metrics.STAGES:
+        report.write(f'{stage:8} {getattr(stats, stage + "_seconds") * 1000:10.1f} ms\n')
+    report.write('\n')
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(limit)
+    return report.getvalue()
+
+def profile_with_timeout(content, timeout, limit):
+    """Render under cProfile in the current (worker) process, giving up after
+    timeout seconds; returns the stage timings and the top limit functions as text."""
+    return _call_with_timeout(timeout, _profile, content, limit)
+
+def _mp_context():
+    # Workers must not inherit the web server's threads or sockets
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+class RenderEngine:
+    def __init__(self, max_workers=None, max_queue=None, timeout=120,
+                 inline_bytes=64 * 1024, retry_after=5, poll_interval=0.5, web_workers=1,
+                 max_background=None, max_backlog=64):
+        # Every web worker has a pool of its own, so by default they share out the cores
+        self.web_workers = web_workers
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 1) // web_workers)
+        # Jobs allowed to wait for a free process, on top of the running ones
+        self.max_queue = self.max_workers if max_queue is None else max_queue
+        self.timeout = timeout
+        self.inline_bytes = inline_bytes
+        self.retry_after = retry_after
+        self.poll_interval = poll_interval
+        # Processes background work may hold at once; with more than one, one is kept for interactive renders
+        self.max_background = max_background or max(1, self.max_workers - 1)
+        # Background work allowed to wait for a slot before more is refused
+        self.max_backlog = max_backlog
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._backlog = collections.deque()
+        self._background_running = 0
+        self._background_lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Create the pool in this process and spawn its workers ahead of the first job."""
+        with self._lock:
+            # A pool inherited across fork has no live workers, so each process gets its own
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=_mp_context(),
+                                                     initializer=_init_worker)
+                self._pid = os.getpid()
+                for _ in range(self.max_workers):
+                    self._executor.submit(warm_up_fonts)
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, fn, *args):
+        """Queue fn as background work, which waits for a slot rather than failing
+        fast, and return a Future for its result.
+
+        At most max_background calls are in the pool at once; EngineBusy is
+        raised when max_backlog calls are already waiting.
+        """
+        future = Future()
+        with self._background_lock:
+            if len(self._backlog) >= self.max_backlog:
+                raise EngineBusy(self.retry_after)
+            self._backlog.append((future, fn, args))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        # Move waiting background work into the pool while it may take slots
+        while True:
+            with self._background_lock:
+                if not self._backlog or self._background_running >= self.max_background:
+                    return
+                if not self._slots.acquire(blocking=False):
+                    return
+                future, fn, args = self._backlog.popleft()
+                # Cancelled while waiting (a batch whose client went away)
+                if not future.set_running_or_notify_cancel():
+                    self._slots.release()
+                    continue
+                self._background_running += 1
+            try:
+                try:
+                    pooled = self.start().submit(fn, *args)
+                except BrokenProcessPool:
+                    self.shutdown()
+                    pooled = self.start().submit(fn, *args)
+            except BaseException as e:
+                self._background_done()
+                future.set_exception(e)
+                continue
+            pooled.add_done_callback(lambda pooled, future=future: self._background_finished(pooled, future))
+
+    def _background_done(self):
+        with self._background_lock:
+            self._background_running -= 1
+        self._slots.release()
+
+    def _background_finished(self, pooled, future):
+        self._background_done()
+        try:
+            future.set_result(pooled.result())
+        except BaseException as e:
+            future.set_exception(e)
+        self._dispatch()
+
+    def _release(self):
+        # A slot freed by an interactive render may be waited for by background work
+        self._slots.release()
+        self._dispatch()
+
+    def render(self, content, size=None, is_cancelled=None, pages=None):
+        """Render markdown to PDF bytes, inline when small and in the pool otherwise.
+
+        content is a string or an iterable of lines; size is its length when it
+        is not a string. is_cancelled is polled while a pooled job is waiting.
+        pages is an optional (first, last) page range, as for build_pdf.
+        """
+        if size is None:
+            size = len(content)
+        if size <= self.inline_bytes:
+            return render_pdf(content, pages=pages)
+
+        if not isinstance(content, str):
+            # Worker processes need the document itself, not a stream handle
+            content = ''.join(content)
+        return self._run(is_cancelled, render_with_timeout, content, self.timeout, None, pages)
+
+    def profile(self, content, limit, is_cancelled=None):
+        """Render markdown under cProfile in the pool, whatever its size, and
+        return the profile_with_timeout report."""
+        if not isinstance(content, str):
+            content = ''.join(content)
+        return self._run(is_cancelled, profile_with_timeout, content, self.timeout, limit)
+
+    def _run(self, is_cancelled, fn, *args):
+        # Run fn in the pool within the cap on jobs in flight and wait for its result
+        if not self._slots.acquire(blocking=False):
+            raise EngineBusy(self.retry_after)
+        try:
+            future = self.start().submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self.shutdown()
+            raise
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot stays taken until the worker is really done with the job
+        future.add_done_callback(lambda f: self._release())
+
+        # The worker enforces the timeout itself; this only covers time spent queued
+        deadline = time.monotonic() + self.timeout * 2
+        while True:
+            try:
+                return future.result(timeout=self.poll_interval)
+            except FutureTimeoutError:
+                if is_cancelled is not None and is_cancelled():
+                    # Queued jobs are dropped; a running job finishes on its own
+                    future.cancel()
+                    raise RenderCancelled('Client disconnected')
+                if time.monotonic() > deadline:
+                    future.cancel()
+                    raise RenderTimeout('Rendering took too long')
+            except BrokenProcessPool:
+                self.shutdown()
+                raise